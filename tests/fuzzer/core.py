@@ -16,6 +16,7 @@ import aiohttp
 from yarl import URL
 
 from utils import context
+from utils.proxy.stats import STATS_PORT, get_proxy_host
 
 from tests.fuzzer.corpus import get_corpus
 from tests.fuzzer.request_mutator import get_mutator
@@ -203,6 +204,35 @@ class Fuzzer:
                 if session:
                     await session.close()
 
+    async def watch_proxy_stats(self, interval=1):
+        """ Feed backend metrics with the activity of the agent interface, read on the proxy stats endpoint """
+
+        previous = {}
+
+        async with aiohttp.ClientSession(loop=self.loop) as session:
+            while not self.finished:
+                try:
+                    async with session.get(f"http://{get_proxy_host()}:{STATS_PORT}/stats") as resp:
+                        stats = await resp.json()
+                except aiohttp.client_exceptions.ClientError:
+                    self.logger.info("Can't connect to proxy stats")
+                else:
+                    paths = stats["interfaces"].get("agent", {}).get("paths", {})
+                    for path, path_stats in paths.items():
+                        last = previous.get(path, {"messages": 0, "request_bytes": 0})
+                        if path_stats["messages"] != last["messages"]:
+                            self.backend_requests_stack.append(
+                                {
+                                    "path": path,
+                                    "messages": path_stats["messages"] - last["messages"],
+                                    "request_bytes": path_stats["request_bytes"] - last["request_bytes"],
+                                }
+                            )
+
+                        previous[path] = path_stats
+
+                await asyncio.sleep(interval)
+
     async def _run(self):
         try:
             await self.wait_for_first_response()
@@ -220,6 +250,10 @@ class Fuzzer:
         tasks.add(task)
         task.add_done_callback(tasks.remove)
 
+        task = self.loop.create_task(self.watch_proxy_stats())
+        tasks.add(task)
+        task.add_done_callback(tasks.remove)
+
         self.report.value("Target library", str(self.weblog.library))
         self.report.value("Weblog variant", self.weblog.weblog_variant)
         self.report.value("Corpus", self.corpus)
@@ -384,15 +418,17 @@ class Fuzzer:
                     f.write(text)
 
     def update_backend_metrics(self, data):
-        path, request = data["path"], data["request"]
+        """ data is the activity on one backend path, since the previous proxy stats """
+
+        path = data["path"]
 
-        self.backend_requests_size.update(request["length"])
+        self.backend_requests_size.update(data["request_bytes"])
 
         if path not in self.backend_requests:
             self.report.signal("New backend requests", path)
             self._add_backend_request(path, path.split("/")[-1])
 
-        self.backend_requests[path].update()
+        self.backend_requests[path].update(data["messages"])
 
         # for exception in get_agent_exceptions(data):
         #     payload = exception.get("payload", {})
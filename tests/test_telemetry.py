@@ -50,7 +50,7 @@ class Test_Telemetry:
             validator(data)
 
     def validate_agent_telemetry_data(self, validator, success_by_default=False):
-        telemetry_data = list(interfaces.agent.get_telemetry_data())
+        telemetry_data = list(interfaces.agent.get_telemetry_data(flatten_message_batches=False))
 
         if len(telemetry_data) == 0 and not success_by_default:
             raise Exception("No telemetry data to validate on")
@@ -0,0 +1,185 @@
+import os
+import random
+from types import SimpleNamespace
+
+import msgpack
+import pytest
+from utils.interfaces._backend import _BackendInterfaceValidator
+from utils.interfaces._backend_poller import BackendPoller, Lookup
+from utils.interfaces._backend_stand_in import BackendStandIn, run_in_thread
+from utils.interfaces._library.core import LibraryInterfaceValidator
+from utils.proxy.capture_store import CaptureWriter, encode_body, encode_record, get_capture_folder
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+RID = "A" * 36
+
+
+def _on_response(lookup, host, status_code, content, headers):  # pylint: disable=unused-argument
+    return {"path": lookup.path, "response": {"status_code": status_code}}
+
+
+def _is_ready(data):
+    return data["response"]["status_code"] == 200
+
+
+def _get_trace_message(i, trace_id, rid=RID):
+    meta = {"http.request.headers.user-agent": f"system_tests rid/{rid}"}
+    traces = [[{"trace_id": trace_id, "span_id": 1, "parent_id": 0, "meta": meta, "metrics": {"_dd.top_level": 1.0}}]]
+
+    data = {
+        "log_filename": f"{i:05d}__v0.4_traces.json",
+        "path": "/v0.4/traces",
+        "request": {"headers": [["Content-Type", "application/msgpack"]]},
+        "response": {"headers": [], "status_code": 200},
+    }
+    encode_body(data["request"], msgpack.packb(traces))
+    encode_body(data["response"], b"")
+
+    return data
+
+
+class Test_BackendPoller:
+    def test_main(self):
+        """ Lookups are polled concurrently, until the backend has ingested their trace """
+
+        stand_in = BackendStandIn(latency=0.01)
+        stand_in.add_trace(1, RID)
+        stand_in.add_trace(2, RID, ingestion_delay=0.3)
+
+        with run_in_thread(stand_in) as host:
+            poller = BackendPoller(host, {}, _on_response, rng=random.Random(0))
+            result = poller.poll(
+                [
+                    Lookup("GET", "/api/v1/trace/1", _is_ready),
+                    Lookup("GET", "/api/v1/trace/2", _is_ready),
+                    Lookup("GET", "/api/v1/trace/3", _is_ready, retries=2, sleep_interval_multiplier=0.1),
+                    Lookup("GET", "/api/v1/trace/3", _is_ready, retries=1, required=False),
+                ]
+            )
+
+        assert result[0]["response"]["status_code"] == 200
+        assert result[1]["response"]["status_code"] == 200
+        assert isinstance(result[2], ValueError)
+        assert result[3]["response"]["status_code"] == 404
+        assert stand_in.request_count == 1 + 2 + 2 + 1
+
+    def test_delay(self):
+        """ The first request of a lookup can be delayed, until the backend is expected to have ingested it """
+
+        stand_in = BackendStandIn(ingestion_delay=0.3)
+        stand_in.add_trace(1, RID)
+
+        with run_in_thread(stand_in) as host:
+            poller = BackendPoller(host, {}, _on_response)
+            result = poller.poll([Lookup("GET", "/api/v1/trace/1", _is_ready, retries=1, delay=0.5)])
+
+        assert result[0]["response"]["status_code"] == 200
+        assert stand_in.request_count == 1
+
+    def test_rate_limit(self):
+        """ All lookups pause when the backend rate limits them """
+
+        stand_in = BackendStandIn(rate_limit=2, rate_limit_reset=1)
+        for trace_id in range(4):
+            stand_in.add_trace(trace_id, RID)
+
+        with run_in_thread(stand_in) as host:
+            poller = BackendPoller(host, {}, _on_response, jitter=0)
+            result = poller.poll([Lookup("GET", f"/api/v1/trace/{trace_id}", _is_ready) for trace_id in range(4)])
+
+        assert [data["response"]["status_code"] for data in result] == [200] * 4
+        assert stand_in.rate_limited_count > 0
+
+    def test_interface(self, monkeypatch, tmp_path):
+        """ Traces of a request, and spans are fetched from the backend """
+
+        monkeypatch.setenv("DD_API_KEY", "api-key")
+        monkeypatch.setenv("DD_APPLICATION_KEY", "app-key")
+        monkeypatch.setattr(_BackendInterfaceValidator, "_log_folder", str(tmp_path))
+
+        stand_in = BackendStandIn()
+        stand_in.add_trace(1, RID, span_count=2)
+        stand_in.add_trace(2, RID)
+
+        backend = _BackendInterfaceValidator(library_interface=None)
+        backend.rid_to_library_trace_ids = {RID: [1, 2]}
+        request = SimpleNamespace(request=SimpleNamespace(headers={"User-Agent": f"system_tests rid/{RID}"}))
+
+        with run_in_thread(stand_in) as host:
+            backend.dd_site_url = host
+
+            try:
+                traces = backend.assert_library_traces_exist(request, min_traces_len=2)
+                poller = backend._poller
+                spans = backend.assert_request_spans_exist(request, query_filter="service:weblog", min_spans_len=3)
+                assert backend._poller is poller  # one pooled session for all lookups
+            finally:
+                backend.stop_polling()
+
+        assert backend._poller is None
+        assert [trace["trace_id"] for trace in traces] == ["1", "2"]
+        assert len(spans) == 3
+        assert len(os.listdir(backend._log_folder)) >= 3
+
+    def test_prefetch(self, monkeypatch, tmp_path):
+        """ Once prefetch starts, rid -> trace ids is built as the library sends traces, and these traces are polled
+            right away """
+
+        monkeypatch.setenv("DD_API_KEY", "api-key")
+        monkeypatch.setenv("DD_APPLICATION_KEY", "app-key")
+        monkeypatch.setattr(_BackendInterfaceValidator, "_log_folder", str(tmp_path))
+
+        stand_in = BackendStandIn()
+        stand_in.add_trace(1, RID)
+        stand_in.add_trace(2, RID)
+
+        library = LibraryInterfaceValidator("library")
+        library.ingest_data(_get_trace_message(0, 1))
+
+        backend = _BackendInterfaceValidator(library_interface=library)
+        backend.prefetch_delay = 0.1
+        assert not library._rid_index.has_listeners  # traces are not deserialized as they are received
+
+        with run_in_thread(stand_in) as host:
+            backend.dd_site_url = host
+            backend.start_prefetch()
+
+            try:
+                assert backend.rid_to_library_trace_ids == {RID: [1]}
+                library.ingest_data(_get_trace_message(1, 2))
+                library.ingest_data(_get_trace_message(2, 1))  # same trace, sent again
+                assert backend.rid_to_library_trace_ids == {RID: [1, 2]}
+
+                for future in backend._prefetched.values():
+                    future.result(timeout=10)
+                assert stand_in.request_count == 2
+
+                request = SimpleNamespace(request=SimpleNamespace(headers={"User-Agent": f"system_tests rid/{RID}"}))
+                traces = backend.assert_library_traces_exist(request, min_traces_len=2)
+            finally:
+                backend.stop_polling()
+
+        assert [trace["trace_id"] for trace in traces] == ["1", "2"]
+        assert stand_in.request_count == 2  # prefetched traces are not polled again
+
+    def test_replay(self, monkeypatch, tmp_path):
+        """ In replay, rid -> trace ids is built from the library traces loaded from logs """
+
+        monkeypatch.setattr(LibraryInterfaceValidator, "_log_folder", str(tmp_path / "library"))
+        monkeypatch.setattr(_BackendInterfaceValidator, "_log_folder", str(tmp_path / "backend"))
+
+        (tmp_path / "backend").mkdir()
+        writer = CaptureWriter(get_capture_folder(str(tmp_path / "library")))
+        writer.append(encode_record(_get_trace_message(0, 1)))
+        writer.append(encode_record(_get_trace_message(1, 2, rid="B" * 36)))
+        writer.close()
+
+        library = LibraryInterfaceValidator("library")
+        library.load_data_from_logs()
+
+        backend = _BackendInterfaceValidator(library_interface=library)
+        backend.load_data_from_logs()
+
+        assert backend.rid_to_library_trace_ids == {RID: [1], "B" * 36: [2]}
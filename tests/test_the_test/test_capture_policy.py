@@ -0,0 +1,48 @@
+import pytest
+from utils.proxy._deserializer import materialize
+from utils.proxy.capture_policy import CapturePolicy
+from utils.proxy.capture_store import encode_body
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+class Test_CapturePolicy:
+    def test_rules(self):
+        """ First matching rule wins, default is full """
+
+        policy = CapturePolicy(
+            [
+                {"interface": "agent", "path": "/api/v2/profile", "policy": "headers-only"},
+                {"path": "/profiling/.*", "policy": "drop"},
+                {"interface": "library", "policy": "raw-only"},
+            ]
+        )
+
+        assert policy.get("agent", "/api/v2/profile") == "headers-only"
+        assert policy.get("agent", "/api/v2/profile/x") == "full"
+        assert policy.get("agent", "/profiling/v1/input") == "drop"
+        assert policy.get("library", "/profiling/v1/input") == "drop"
+        assert policy.get("library", "/v0.4/traces") == "raw-only"
+
+        with pytest.raises(ValueError):
+            CapturePolicy([{"policy": "everything"}])
+
+    def test_materialize(self):
+        data = {
+            "log_filename": "00000__telemetry.json",
+            "path": "/telemetry",
+            "capture_policy": "raw-only",
+            "request": {"headers": [["Content-Type", "application/json"]]},
+            "response": {"headers": [], "status_code": 200},
+        }
+        encode_body(data["request"], b'{"a": 1}')
+        encode_body(data["response"], b"")
+
+        materialize(data, "library")
+        assert data["request"]["content"] == b'{"a": 1}'
+
+        data["capture_policy"] = "headers-only"
+        data["request"]["body"] = None
+        materialize(data, "library")
+        assert data["request"]["content"] is None
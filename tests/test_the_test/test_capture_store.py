@@ -0,0 +1,56 @@
+import json
+import os
+
+import pytest
+from utils.proxy.capture_store import CaptureReader, CaptureWriter, encode_record, export_to_files, get_capture_folder
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+def _get_message(folder, i):
+    return {"log_filename": f"{folder}/{i:05d}__v0.4_traces.json", "path": "/v0.4/traces", "content": b"raw"}
+
+
+class Test_CaptureStore:
+    def test_rotation(self, tmp_path):
+        """ Records are read back in order, across segments """
+
+        writer = CaptureWriter(get_capture_folder(str(tmp_path)), segment_max_size=100)
+        for i in range(10):
+            writer.append(encode_record(_get_message(tmp_path, i)))
+        writer.close()
+
+        reader = CaptureReader(get_capture_folder(str(tmp_path)))
+        assert len(reader.get_segments()) > 1
+        assert [data["log_filename"] for data in reader] == [_get_message(tmp_path, i)["log_filename"] for i in range(10)]
+
+    def test_incremental_read(self, tmp_path):
+        """ Reader only returns new and complete records """
+
+        writer = CaptureWriter(get_capture_folder(str(tmp_path)), segment_max_size=100)
+        reader = CaptureReader(get_capture_folder(str(tmp_path)))
+
+        assert reader.read_new() == []
+
+        writer.append(encode_record(_get_message(tmp_path, 0)))
+        writer.append(encode_record(_get_message(tmp_path, 1)))
+        assert len(reader.read_new()) == 2
+        assert reader.read_new() == []
+
+        # simulate a record being written
+        with open(os.path.join(get_capture_folder(str(tmp_path)), reader.get_segments()[-1]), "ab") as f:
+            f.write(b"\x00\x00\x01")
+
+        assert reader.read_new() == []
+
+    def test_export(self, tmp_path):
+        """ Export restores the one-file-per-message layout """
+
+        writer = CaptureWriter(get_capture_folder(str(tmp_path)))
+        writer.append(encode_record(_get_message(tmp_path, 0)))
+        writer.close()
+
+        assert export_to_files(str(tmp_path)) == 1
+
+        with open(f"{tmp_path}/00000__v0.4_traces.json", encoding="utf-8") as f:
+            assert json.load(f)["content"] == "b'raw'"
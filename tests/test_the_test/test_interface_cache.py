@@ -0,0 +1,51 @@
+import pytest
+from utils.interfaces._core import ProxyBasedInterfaceValidator
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+class Test_InterfaceCache:
+    def test_main(self):
+        """ Results are computed once per generation, least recently used ones are evicted """
+
+        interface = ProxyBasedInterfaceValidator("cache_test")
+        interface.cache_size = 2
+        calls = []
+
+        def compute(key):
+            def function():
+                calls.append(key)
+                return interface.get_message_count()
+
+            return interface._get_cached(key, function)
+
+        assert compute("a") == 0
+        assert compute("a") == 0
+        assert calls == ["a"]
+
+        interface.ingest_data({"log_filename": "00001__info.json", "path": "/info"})
+        assert compute("a") == 1
+        assert calls == ["a", "a"]
+
+        compute("b")
+        compute("a")
+        compute("c")  # evicts b
+        compute("a")
+        compute("b")
+        assert calls == ["a", "a", "b", "c", "b"]
+        assert interface.get_cache_stats() == {"hits": 3, "misses": 5, "size": 2}
+
+    def test_errors(self):
+        """ Errors are not cached """
+
+        interface = ProxyBasedInterfaceValidator("cache_test")
+
+        def fail():
+            raise ValueError("fail")
+
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                interface._get_cached("key", fail)
+
+        assert interface.get_cache_stats()["misses"] == 2
@@ -0,0 +1,62 @@
+import msgpack
+import pytest
+from utils.interfaces._core import ProxyBasedInterfaceValidator
+from utils.proxy.capture_store import encode_body
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+def _get_message(i, path, content_type, content):
+    data = {
+        "log_filename": f"{i:05d}_{path.replace('/', '_')}.json",
+        "path": path,
+        "request": {"headers": [["Content-Type", content_type]]},
+        "response": {"headers": [], "status_code": 200},
+    }
+
+    encode_body(data["request"], content)
+    encode_body(data["response"], b"")
+
+    return data
+
+
+class Test_LazyDeserialization:
+    def test_main(self):
+        """ Bodies are only deserialized when read """
+
+        interface = ProxyBasedInterfaceValidator("library")
+        interface.ingest_data(_get_message(0, "/v0.4/traces", "application/msgpack", msgpack.packb([[{"span_id": 1}]])))
+        interface.ingest_data(_get_message(1, "/telemetry", "application/json", b'{"request_type": "app-started"}'))
+
+        traces = list(interface.get_data(path_filters="/v0.4/traces"))
+        assert traces[0]["request"]["content"] == [[{"span_id": 1}]]
+        assert "body" not in traces[0]["request"]
+
+        telemetry = interface._data_list[1]
+        assert "content" not in telemetry["request"]
+        assert telemetry["request"]["content_type"] == "application/json"
+
+        interface.check_deserialization_errors()
+
+        assert list(interface.get_data(path_filters="/telemetry"))[0]["request"]["content"] == {
+            "request_type": "app-started"
+        }
+
+    def test_error(self):
+        """ Deserialization errors are reported when the message is read """
+
+        interface = ProxyBasedInterfaceValidator("library")
+        interface.ingest_data(_get_message(0, "/telemetry", "application/json", b"{not json"))
+
+        with pytest.raises(ValueError):
+            list(interface.get_data())
+
+    def test_session_error(self):
+        """ Messages not read by any test are deserialized when deserialization errors are checked """
+
+        interface = ProxyBasedInterfaceValidator("library")
+        interface.ingest_data(_get_message(0, "/telemetry", "application/json", b"{not json"))
+
+        with pytest.raises(pytest.exit.Exception, match="00000__telemetry.json"):
+            interface.check_deserialization_errors()
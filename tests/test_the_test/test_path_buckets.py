@@ -0,0 +1,45 @@
+import pytest
+from utils.interfaces._core import ProxyBasedInterfaceValidator
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+def _get_message(i, path):
+    return {"log_filename": f"{i:05d}_{path.replace('/', '_')}.json", "path": path, "request": {}, "response": {}}
+
+
+class Test_PathBuckets:
+    def test_main(self):
+        """ Filtered messages keep the global order, including paths seen after the filter was first used """
+
+        interface = ProxyBasedInterfaceValidator("buckets_test")
+        for i, path in ((3, "/v0.5/traces"), (0, "/v0.4/traces"), (1, "/telemetry"), (2, "/v0.4/traces")):
+            interface.ingest_data(_get_message(i, path))
+
+        def get_indexes(path_filters):
+            return [int(data["log_filename"][:5]) for data in interface.get_data(path_filters=path_filters)]
+
+        assert get_indexes(r"/v0\.[45]/traces") == [0, 2, 3]
+        assert get_indexes(["/telemetry", "/v0.4/traces"]) == [0, 1, 2]
+        assert get_indexes(None) == [0, 1, 2, 3]
+
+        interface.ingest_data(_get_message(4, "/v0.6/traces"))
+        interface.ingest_data(_get_message(5, "/v0.5/traces"))
+        assert get_indexes(r"/v0\.[4-6]/traces") == [0, 2, 3, 4, 5]
+        assert get_indexes(r"/v0\.[45]/traces") == [0, 2, 3, 5]
+        assert get_indexes("/unknown") == []
+
+    def test_sequence_order(self):
+        """ Messages are ordered by sequence number, not by file name """
+
+        interface = ProxyBasedInterfaceValidator("buckets_test")
+        for i in (100000, 99999, 99998, 100001):
+            interface.ingest_data({"log_filename": f"logs/{i:05d}__info.json", "path": "/info"})
+
+        assert [data["log_filename"] for data in interface._data_list] == [
+            "logs/99998__info.json",
+            "logs/99999__info.json",
+            "logs/100000__info.json",
+            "logs/100001__info.json",
+        ]
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+
+import pytest
+from utils.proxy.stats import CaptureStats, StatsServer, get_proxy_stats
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+class Test_ProxyStats:
+    def test_main(self):
+        """ Stats are aggregated per interface and path, and served over HTTP """
+
+        stats = CaptureStats()
+        stats.on_message("library", "/v0.4/traces", 100, 10, scrub_time=0.1, write_time=0.01, queue_time=0.0002)
+        stats.on_message("library", "/v0.4/traces", 200, 10, scrub_time=0.1, write_time=0.01, queue_time=2)
+        stats.on_message("library", "/telemetry", 50, 0, scrub_time=0.1, write_time=0.01)
+
+        loop = asyncio.new_event_loop()
+        server = StatsServer(lambda: {"pipeline": {"backlog": 0}, "interfaces": stats.serialize()})
+        loop.run_until_complete(server.start(host="127.0.0.1", port=0))
+        port = server._server.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        try:
+            result = get_proxy_stats(port=port)
+        finally:
+            asyncio.run_coroutine_threadsafe(server.stop(), loop).result(timeout=5)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+        library = result["interfaces"]["library"]
+        assert library["messages"] == 3
+        assert library["bytes"] == 370
+        assert library["paths"]["/v0.4/traces"]["messages"] == 2
+        assert library["paths"]["/v0.4/traces"]["request_bytes"] == 300
+        assert library["last_message"] == library["paths"]["/telemetry"]["last_message"]
+
+        # histograms, with buckets in ms
+        queue = library["paths"]["/v0.4/traces"]["histograms"]["queue"]
+        assert queue["counts"][queue["bounds_ms"].index(0.25)] == 1
+        assert queue["counts"][queue["bounds_ms"].index(2500)] == 1
+        assert library["histograms"]["scrub"]["counts"][queue["bounds_ms"].index(100)] == 3
+        assert sum(library["histograms"]["write"]["counts"]) == 3
+
+        # server is stopped
+        assert get_proxy_stats(port=port) is None
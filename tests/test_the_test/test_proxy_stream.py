@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+import pytest
+from utils.interfaces._core import ProxyBasedInterfaceValidator
+from utils.interfaces._stream import ProxyStreamSubscriber
+from utils.proxy.capture_store import CaptureWriter, encode_record
+from utils.proxy.stats import StatsServer, get_proxy_stats
+from utils.proxy.stream import StreamPublisher
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+def _wait_until(condition, timeout=5):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            raise TimeoutError()
+        time.sleep(0.01)
+
+
+class Test_ProxyStream:
+    def test_push(self):
+        """ Messages published by the proxy are ingested by the subscribed interface """
+
+        loop = asyncio.new_event_loop()
+        publisher = StreamPublisher()
+        loop.run_until_complete(publisher.start(host="127.0.0.1", port=0))
+        port = publisher._server.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        interface = ProxyBasedInterfaceValidator("stream_test")
+        subscriber = ProxyStreamSubscriber([interface], port=port, retry_interval=0.01)
+        subscriber.start()
+
+        try:
+            _wait_until(lambda: len(publisher._writers) == 1)
+
+            for i in range(3):
+                payload = encode_record({"log_filename": f"{i:05d}__info.json", "path": "/info"})
+                loop.call_soon_threadsafe(publisher.publish, "stream_test", payload)
+
+            # other interfaces are ignored
+            loop.call_soon_threadsafe(publisher.publish, "other", encode_record({"log_filename": "x", "path": "/"}))
+
+            _wait_until(lambda: len(interface._data_list) == 3)
+            assert [data["log_filename"] for data in interface.get_data()] == [
+                "00000__info.json",
+                "00001__info.json",
+                "00002__info.json",
+            ]
+        finally:
+            subscriber.stop()
+            asyncio.run_coroutine_threadsafe(publisher.stop(), loop).result(timeout=5)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def test_catch_up(self, monkeypatch, tmp_path):
+        """ If the stream is not connected, wait_for_flush ingests messages from the capture store """
+
+        monkeypatch.setattr(ProxyBasedInterfaceValidator, "_log_folder", str(tmp_path))
+        interface = ProxyBasedInterfaceValidator("stream_catch_up")
+        writer = CaptureWriter(interface._capture_folder)
+        for i in range(3):
+            writer.append(encode_record({"log_filename": f"{i:05d}__info.json", "path": "/info"}))
+        writer.close()
+
+        stats = {"pipeline": {"backlog": 0}, "interfaces": {"stream_catch_up": {"messages": 3}}}
+        loop = asyncio.new_event_loop()
+        server = StatsServer(lambda: stats)
+        loop.run_until_complete(server.start(host="127.0.0.1", port=0))
+        stats_port = server._server.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        # nothing listens on the stream port
+        subscriber = ProxyStreamSubscriber([interface], host="127.0.0.1", port=1, retry_interval=0.01)
+
+        try:
+            with mock.patch("utils.interfaces._stream.get_proxy_stats", lambda host: get_proxy_stats(host, stats_port)):
+                assert subscriber.wait_for_flush(timeout=5)
+        finally:
+            asyncio.run_coroutine_threadsafe(server.stop(), loop).result(timeout=5)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+        assert interface.get_message_count() == 3
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+from utils.interfaces import _replay
+from utils.proxy.capture_store import CaptureWriter, encode_body, encode_record, get_capture_folder
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+def _get_message(folder, i):
+    data = {
+        "log_filename": f"{folder}/{i:05d}__telemetry.json",
+        "path": "/telemetry",
+        "request": {"headers": [["Content-Type", "application/json"]]},
+        "response": {"headers": [], "status_code": 200},
+    }
+    encode_body(data["request"], json.dumps({"seq_id": i}).encode())
+    encode_body(data["response"], b"")
+
+    return data
+
+
+class Test_ReplayLoader:
+    @pytest.mark.parametrize("max_workers", [1, 2])
+    def test_capture_store(self, max_workers, monkeypatch, tmp_path):
+        """ Messages are deserialized, and loaded in capture order, sequentially or in parallel """
+
+        monkeypatch.setattr(_replay, "MIN_PARALLEL_SIZE", 0)
+
+        folder = str(tmp_path)
+        writer = CaptureWriter(get_capture_folder(folder), segment_max_size=1000)
+        for i in range(20):
+            writer.append(encode_record(_get_message(tmp_path, i)))
+        writer.close()
+
+        messages = list(
+            _replay.load_messages(folder, get_capture_folder(folder), "library", max_workers=max_workers)
+        )
+
+        assert [data["request"]["content"]["seq_id"] for data in messages] == list(range(20))
+        assert "body" not in messages[0]["request"]
+
+    def test_files(self, monkeypatch, tmp_path):
+        """ Logs produced before the capture store are loaded in file name order """
+
+        monkeypatch.setattr(_replay, "FILES_PER_CHUNK", 3)
+
+        for i in (3, 1, 0, 2, 4):
+            data = _get_message(tmp_path, i)
+            with open(data["log_filename"], "w", encoding="utf-8") as f:
+                json.dump({"log_filename": data["log_filename"], "path": "/info", "request": {"content": i}}, f)
+
+        folder = str(tmp_path)
+        messages = list(_replay.load_messages(folder, get_capture_folder(folder), "library", 2))
+        assert [data["request"]["content"] for data in messages] == [0, 1, 2, 3, 4]
@@ -0,0 +1,80 @@
+import msgpack
+import pytest
+from utils.interfaces._library.core import LibraryInterfaceValidator
+from utils.proxy.capture_store import encode_body
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+RID = "A" * 36
+
+
+class _Request:
+    def __init__(self, rid):
+        self.request = self
+        self.headers = {"User-Agent": f"system_tests rid/{rid}"}
+
+
+def _get_span(span_id, rid=None):
+    meta = {"http.request.headers.user-agent": f"system_tests rid/{rid}"} if rid else {}
+    return {"span_id": span_id, "meta": meta, "metrics": {"_dd.top_level": 1.0}}
+
+
+def _get_message(i, traces):
+    data = {
+        "log_filename": f"{i:05d}__v0.4_traces.json",
+        "path": "/v0.4/traces",
+        "request": {"headers": [["Content-Type", "application/msgpack"]]},
+        "response": {"headers": [], "status_code": 200},
+    }
+    encode_body(data["request"], msgpack.packb(traces))
+    encode_body(data["response"], b"")
+
+    return data
+
+
+class Test_RidIndex:
+    def test_main(self):
+        """ Spans are found by rid, in message order, even if messages are ingested out of order """
+
+        interface = LibraryInterfaceValidator("library")
+        interface.ingest_data(_get_message(2, [[_get_span(5, RID)]]))
+        interface.ingest_data(_get_message(0, [[_get_span(1, RID), _get_span(2), _get_span(3, RID)]]))
+        interface.ingest_data(_get_message(1, [[_get_span(4, "B" * 36)]]))
+
+        request = _Request(RID)
+
+        assert [span["span_id"] for _, _, span in interface.get_spans(request=request)] == [1, 3, 5]
+        assert [span["span_id"] for _, _, span in interface.get_spans(request=request, full_trace=True)] == [
+            1,
+            2,
+            3,
+            5,
+        ]
+        assert [data["log_filename"] for data, _ in interface.get_traces(request=request)] == [
+            "00000__v0.4_traces.json",
+            "00002__v0.4_traces.json",
+        ]
+        assert len(list(interface.get_spans())) == 5
+
+    def test_error(self):
+        """ Messages that can't be deserialized fail lookups """
+
+        interface = LibraryInterfaceValidator("library")
+        data = _get_message(0, [])
+        encode_body(data["request"], b"\xc1")  # never used in msgpack
+        interface.ingest_data(data)
+
+        with pytest.raises(ValueError):
+            list(interface.get_spans(request=_Request(RID)))
+
+    def test_lazy(self):
+        """ Messages are deserialized by the first lookup, not when they are ingested """
+
+        interface = LibraryInterfaceValidator("library")
+        data = _get_message(0, [[_get_span(1, RID)]])
+        interface.ingest_data(data)
+
+        assert "content" not in data["request"]
+        assert [span["span_id"] for _, _, span in interface.get_spans(request=_Request(RID))] == [1]
+        assert "content" in data["request"]
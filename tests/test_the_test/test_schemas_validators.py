@@ -0,0 +1,99 @@
+import pytest
+from utils.interfaces import _schemas_validators
+from utils.interfaces._schemas_validators import SchemaValidator
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+def _get_message(i, content):
+    return {
+        "log_filename": f"{i:05d}_telemetry.json",
+        "path": "/telemetry/proxy/api/v2/apmtelemetry",
+        "request": {"content": content},
+    }
+
+
+VALID = {"api_version": "v2", "request_type": "app-started"}
+INVALID = {"api_version": "v3", "request_type": "app-started"}
+
+
+class Test_SchemaValidator:
+    @pytest.mark.parametrize("compiled", [True, False])
+    def test_main(self, compiled, monkeypatch):
+        """ Errors and allowed_errors are the same with or without code-generated validators """
+
+        if not compiled:
+            monkeypatch.setattr(_schemas_validators, "_is_plain_json", lambda content: False)
+
+        monkeypatch.setattr(_schemas_validators, "_errors_cache", {})
+
+        SchemaValidator("library").validate_all([_get_message(0, VALID), _get_message(1, VALID)])
+
+        with pytest.raises(ValueError, match="00002_telemetry.json"):
+            SchemaValidator("library").validate_all([_get_message(0, VALID), _get_message(2, INVALID)])
+
+        SchemaValidator("library", allowed_errors=[r"'v3' is not one of .* on instance \['api_version'\]"])(
+            _get_message(2, INVALID)
+        )
+
+        # one entry per distinct payload
+        assert len(_schemas_validators._errors_cache) == 2
+
+    def test_pool(self, monkeypatch):
+        """ Large batches are validated in a process pool, the first invalid message is reported """
+
+        monkeypatch.setattr(_schemas_validators, "_errors_cache", {})
+        monkeypatch.setattr(_schemas_validators, "MIN_PARALLEL_MESSAGES", 2)
+
+        data_list = [_get_message(i, dict(VALID, seq_id=i)) for i in range(20)]
+        data_list[15] = _get_message(15, INVALID)
+        data_list[17] = _get_message(17, INVALID)
+
+        with pytest.raises(ValueError, match="00015_telemetry.json"):
+            SchemaValidator("library").validate_all(data_list, max_workers=2)
+
+        assert len(_schemas_validators._errors_cache) == 16  # results are cached until the first invalid message
+
+    @pytest.mark.parametrize("compiled", [True, False])
+    def test_format(self, compiled, monkeypatch):
+        """ Formats are checked the same way with or without code-generated validators """
+
+        if not compiled:
+            monkeypatch.setattr(_schemas_validators, "_is_plain_json", lambda content: False)
+
+        schema = {"$id": "/test/format.json", "properties": {"date": {"type": "string", "format": "date-time"}}}
+        monkeypatch.setattr(_schemas_validators, "_get_schemas_store", lambda: {schema["$id"]: schema})
+        _schemas_validators._get_compiled_validator.cache_clear()
+        _schemas_validators._get_schema_validator.cache_clear()
+
+        try:
+            assert _schemas_validators._get_compiled_validator(schema["$id"]) is not None
+            assert _schemas_validators._get_errors(schema["$id"], {"date": "2021-02-28T00:00:00Z"}) == []
+            assert _schemas_validators._get_errors(schema["$id"], {"date": "2021-02-30T00:00:00Z"}) == [
+                "'2021-02-30T00:00:00Z' is not a 'date-time' on instance ['date']"
+            ]
+        finally:
+            _schemas_validators._get_compiled_validator.cache_clear()
+            _schemas_validators._get_schema_validator.cache_clear()
+
+    def test_plain_json(self, monkeypatch):
+        """ Arrays are only validated by the code-generated validator if they are lists """
+
+        schema = {"$id": "/test/array.json", "properties": {"items": {"type": "array"}}}
+        monkeypatch.setattr(_schemas_validators, "_get_schemas_store", lambda: {schema["$id"]: schema})
+        _schemas_validators._get_compiled_validator.cache_clear()
+        _schemas_validators._get_schema_validator.cache_clear()
+
+        try:
+            assert _schemas_validators._is_plain_json({"items": [1, "a", None, {"b": 1.5, "c": True}]})
+            assert not _schemas_validators._is_plain_json({"items": [(1, 2)]})
+            assert not _schemas_validators._is_plain_json({"items": [b"bytes"]})
+
+            assert _schemas_validators._get_errors(schema["$id"], {"items": [1, 2]}) == []
+            assert _schemas_validators._get_errors(schema["$id"], {"items": (1, 2)}) == [
+                "(1, 2) is not of type 'array' on instance ['items']"
+            ]
+        finally:
+            _schemas_validators._get_compiled_validator.cache_clear()
+            _schemas_validators._get_schema_validator.cache_clear()
@@ -0,0 +1,68 @@
+import msgpack
+import pytest
+from utils.proxy.scrubber import REDACTED, Scrubber
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+API_KEY = "0123456789abcdef0123456789abcdef"
+APP_KEY = "fedcba9876543210fedcba9876543210fedcba98"
+
+
+class Test_Scrubber:
+    def test_bytes(self):
+        """ All secrets are removed from raw bodies, and length-prefixed encodings are still valid """
+
+        scrubber = Scrubber([API_KEY, APP_KEY, None])
+        payload = msgpack.packb([[{"meta": {"a": API_KEY, "b": f"x{APP_KEY}x", "c": "safe"}}]])
+
+        scrubbed = scrubber.scrub_bytes(payload)
+
+        assert len(scrubbed) == len(payload)
+        assert msgpack.unpackb(scrubbed) == [
+            [{"meta": {"a": REDACTED, "b": f"x{REDACTED}{REDACTED[:8]}x", "c": "safe"}}]
+        ]
+
+    def test_text_bodies(self):
+        """ Secrets of any length are replaced by the full marker in textual bodies, not by a fragment of it """
+
+        scrubber = Scrubber([API_KEY, APP_KEY])
+        payload = f'{{"app_key": "{APP_KEY}", "api_key": "{API_KEY}"}}'.encode("utf-8")
+
+        assert scrubber.scrub_body(payload, "application/json; charset=utf-8") == (
+            f'{{"app_key": "{REDACTED}", "api_key": "{REDACTED}"}}'.encode("utf-8")
+        )
+
+        # unknown content types may be length-prefixed encodings
+        assert scrubber.scrub_body(payload, "application/msgpack") == (
+            f'{{"app_key": "{REDACTED}{REDACTED[:8]}", "api_key": "{REDACTED}"}}'.encode("utf-8")
+        )
+        assert len(scrubber.scrub_body(payload, None)) == len(payload)
+
+    def test_metadata(self):
+        """ Headers and other metadata are scrubbed """
+
+        scrubber = Scrubber([API_KEY])
+        data = {"path": "/api/v2/series", "request": {"headers": [("DD-API-KEY", API_KEY)], "length": 12}}
+
+        assert scrubber.scrub_metadata(data) == {
+            "path": "/api/v2/series",
+            "request": {"headers": [["DD-API-KEY", REDACTED]], "length": 12},
+        }
+
+    def test_metadata_long_secret(self):
+        """ A 40-char key in headers or query is replaced by the full marker """
+
+        scrubber = Scrubber([APP_KEY])
+        data = {"query": f"application_key={APP_KEY}", "request": {"headers": [("DD-APPLICATION-KEY", APP_KEY)]}}
+
+        assert scrubber.scrub_metadata(data) == {
+            "query": f"application_key={REDACTED}",
+            "request": {"headers": [["DD-APPLICATION-KEY", REDACTED]]},
+        }
+
+    def test_no_secret(self):
+        scrubber = Scrubber([None, ""])
+
+        assert scrubber.scrub_bytes(b"content") == b"content"
+        assert scrubber.scrub_str("content") == "content"
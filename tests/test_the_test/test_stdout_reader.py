@@ -1,6 +1,8 @@
 import os
+import re
+
 import pytest
-from utils.interfaces._logs import _LibraryStdout
+from utils.interfaces._logs import _LibraryStdout, _PostgresStdout, _get_line_matcher, _get_required_literal
 
 
 pytestmark = pytest.mark.scenario("TEST_THE_TEST")
@@ -25,3 +27,114 @@ class Test_Main:
         stdout.assert_presence(r"AppSec initial \d+\.\d+\.\d+", level="INFO")
 
         stdout.assert_presence(r"some.*file", level="DEBUG")
+
+    def test_incremental_reader(self):
+        """ Logs are parsed as they are written, the last entry is completed by the final read """
+
+        os.makedirs("logs_test_the_test/docker/postgres", exist_ok=True)
+        filename = "logs_test_the_test/docker/postgres/stdout.log"
+        lines = [
+            "2023-01-01 00:00:00.000 UTC [1] LOG:  first\n",
+            "\n",
+            "  continuation\n",
+            "2023-01-01 00:00:01.000 UTC [1] ERROR:  second ",
+            "été\n",
+            "2023-01-01 00:00:02.000 UTC [1] LOG:  third",
+        ]
+
+        stdout = _PostgresStdout()
+        stdout.configure(False)
+
+        with open(filename, "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(line)
+                f.flush()
+                stdout.read_new_logs()
+
+        # the second entry may still be continued
+        assert [data["raw"] for data in stdout.get_data()] == [
+            "2023-01-01 00:00:00.000 UTC [1] LOG:  first\n  continuation\n"
+        ]
+
+        stdout.load_data()
+
+        data = list(stdout.get_data())
+        assert [d["message"] for d in data] == ["first", "second été", "third"]
+        assert data[1]["level"] == "ERROR"
+        assert data[2]["raw"] == "2023-01-01 00:00:02.000 UTC [1] LOG:  third\n"
+
+    def test_indexed_lookups(self):
+        """ Log entries are found by level, rid and trace id """
+
+        rid = "A" * 36
+        os.makedirs("logs_test_the_test/docker/weblog", exist_ok=True)
+        with open("logs_test_the_test/docker/weblog/stdout.log", "w", encoding="utf-8") as f:
+            f.write(f"[dd.trace 2021-11-29 17:10:22:203 +0000] [main] DEBUG com.klass - rid/{rid} dd.trace_id=12\n")
+            f.write(f"[dd.trace 2021-11-29 17:10:22:204 +0000] [main] INFO com.klass - rid/{rid} dd.trace_id=12\n")
+            f.write("[dd.trace 2021-11-29 17:10:22:205 +0000] [main] DEBUG com.other - dd.trace_id: 13\n")
+
+        stdout = _LibraryStdout()
+        stdout.configure(False)
+        stdout.load_data()
+
+        assert len(list(stdout.get_data())) == 3
+        assert [data["message"] for data in stdout.get_data(rid=rid, level="INFO")] == [
+            f"rid/{rid} dd.trace_id=12"
+        ]
+        assert len(list(stdout.get_data(trace_id="12"))) == 2
+        assert [data["klass"] for data in stdout.get_data(trace_id="13")] == ["com.other"]
+        assert len(list(stdout.get_data(level="ERROR"))) == 0
+
+        stdout.assert_presence(r"dd\.trace_id: \d+", klass="com.other")
+        stdout.assert_presence(r"dd\.trace_id", level="^INF", klass=r"klass$")
+        assert [data["level"] for data in stdout._get_candidates(r"trace_id", level="DEBUG")] == ["DEBUG", "DEBUG"]
+        assert stdout._get_candidates(r"trace_id=13", level="DEBUG") == []
+        with pytest.raises(ValueError):
+            stdout.assert_presence(r"dd\.trace_id: \d+", klass="com.klass")
+        stdout.assert_absence(r"trace_id=1[3-9]")
+
+    def test_required_literal(self):
+        assert _get_required_literal(r"AppSec initial \d+\.\d+\.\d+") == "AppSec initial "
+        assert _get_required_literal(r"[A-Za-z]+\.[A-Za-z]*Exception") == "Exception"
+        assert _get_required_literal(r"System\.Exception") == "System.Exception"
+        assert _get_required_literal(r"colou?r was (red|blue)") == "r was "
+        assert _get_required_literal(r"ab{2}c") == "a"
+        assert _get_required_literal(r"first|second") == ""
+        assert _get_required_literal(r"(?i)exception") == ""
+
+    @pytest.mark.parametrize(
+        "pattern, literal",
+        [
+            (r"abc\x41defg", "defg"),
+            (r"abc\u00e9defg", "defg"),
+            (r"abc\U0001F600defg", "defg"),
+            (r"abc\N{LATIN SMALL LETTER E WITH ACUTE}defg", "defg"),
+            (r"abc\012defg", "defg"),
+            (r"abc\0defg", "defg"),
+            (r"(a)bc\1defg", "defg"),
+            (r"abc\128defg", "8defg"),  # group 12, then 8
+        ],
+    )
+    def test_required_literal_escapes(self, pattern, literal):
+        """ Escapes with a payload end the literal, their payload is not part of it """
+
+        assert _get_required_literal(pattern) == literal
+
+    def test_skipped_line_matcher(self):
+        """ Flags of skipped line patterns are kept, whether they are compile flags or inline flags """
+
+        is_skipped_line = _get_line_matcher(
+            (
+                re.compile(r"^\s*$"),
+                re.compile(r"^attaching to", re.IGNORECASE),
+                re.compile(r"(?i)^exited with code \d+$"),
+                re.compile(r"^Spring"),
+            )
+        )
+
+        assert is_skipped_line("  ")
+        assert is_skipped_line("Attaching to weblog")
+        assert is_skipped_line("EXITED with code 0")
+        assert is_skipped_line("Spring Boot")
+        assert not is_skipped_line("spring boot")
+        assert not is_skipped_line("weblog exited with code 0")
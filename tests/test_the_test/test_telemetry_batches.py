@@ -0,0 +1,109 @@
+import pytest
+from utils.interfaces._agent import AgentInterfaceValidator
+from utils.interfaces._library.core import LibraryInterfaceValidator
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+def _get_message(i, path, content):
+    return {
+        "log_filename": f"{i:05d}_telemetry.json",
+        "path": path,
+        "request": {"headers": [["dd-telemetry-request-type", "message-batch"]], "content": content},
+        "response": {},
+    }
+
+
+class Test_TelemetryBatches:
+    def test_library(self):
+        """ Batch payloads are flattened into views sharing everything but request.content """
+
+        interface = LibraryInterfaceValidator("library")
+        path = "/telemetry/proxy/api/v2/apmtelemetry"
+        batch = {
+            "seq_id": 1,
+            "request_type": "message-batch",
+            "payload": [
+                {"request_type": "app-started", "payload": {"a": 1}},
+                {"request_type": "app-heartbeat", "payload": {}},
+            ],
+        }
+        interface.ingest_data(_get_message(0, path, batch))
+        interface.ingest_data(_get_message(1, path, {"seq_id": 2, "request_type": "app-closing", "payload": {}}))
+
+        flattened = list(interface.get_telemetry_data())
+        assert [data["request"]["content"]["request_type"] for data in flattened] == [
+            "app-started",
+            "app-heartbeat",
+            "app-closing",
+        ]
+        assert flattened[0]["request"]["content"]["seq_id"] == 1
+        assert flattened[0]["request"]["content"]["payload"] is batch["payload"][0]["payload"]
+        assert flattened[0]["request"]["headers"] is flattened[1]["request"]["headers"]
+        assert batch["request_type"] == "message-batch"  # the original message is untouched
+
+        assert list(interface.get_telemetry_data(flatten_message_batches=False))[0]["request"]["content"] is batch
+
+        # views are fresh on each call: a test altering one does not impact the next ones
+        flattened[0]["request"]["content"]["payload"] = None
+        assert list(interface.get_telemetry_data())[0]["request"]["content"]["payload"] == {"a": 1}
+        interface.ingest_data(_get_message(2, path, {"seq_id": 3, "request_type": "app-closing", "payload": {}}))
+        assert len(list(interface.get_telemetry_data())) == 4
+
+    def test_agent(self):
+        """ Batches are flattened on agent interface too """
+
+        interface = AgentInterfaceValidator()
+        batch = {"request_type": "message-batch", "payload": [{"request_type": "app-started", "payload": {}}]}
+        interface.ingest_data(_get_message(0, "/api/v2/apmtelemetry", batch))
+
+        assert list(interface.get_telemetry_data(flatten_message_batches=False))[0]["request"]["content"] is batch
+        data = list(interface.get_telemetry_data())
+        assert [d["request"]["content"]["request_type"] for d in data] == ["app-started"]
+
+
+class Test_TelemetryIndex:
+    def test_main(self):
+        """ Series, messages and seq_ids are indexed by the first lookup, in message order """
+
+        interface = LibraryInterfaceValidator("library")
+        path = "/telemetry/proxy/api/v2/apmtelemetry"
+
+        def metrics(seq_id, series):
+            payload = {"namespace": "tracers", "series": series}
+            return {"seq_id": seq_id, "request_type": "generate-metrics", "payload": payload}
+
+        batch = {"seq_id": 2, "request_type": "message-batch", "payload": [metrics(None, [{"metric": "m"}])]}
+        batch["payload"].append({"request_type": "app-heartbeat", "payload": {}})
+
+        messages = [
+            (2, batch),
+            (0, metrics(1, [{"metric": "m", "points": [1]}, {"metric": "m", "namespace": "appsec"}])),
+            (3, {"seq_id": 4, "request_type": "app-heartbeat", "payload": {}}),
+        ]
+        for i, content in messages:
+            data = _get_message(i, path, content)
+            data["response"] = {"status_code": 202}
+            interface.ingest_data(data)
+
+        assert "_computed_namespace" not in messages[1][1]["payload"]["series"][0]  # not indexed yet
+
+        series = interface.get_telemetry_metric_series("tracers", "m")
+        assert series == [
+            {"metric": "m", "points": [1], "_computed_namespace": "tracers"},
+            {"metric": "m", "_computed_namespace": "tracers"},
+        ]
+        assert len(interface.get_telemetry_metric_series("appsec", "m")) == 1
+        assert interface.get_telemetry_metric_series("appsec", "other") == []
+
+        heartbeats = interface.get_telemetry_messages("app-heartbeat")
+        assert [data["log_filename"][:5] for data in heartbeats] == ["00002", "00003"]
+
+        with pytest.raises(ValueError, match="non conscutive seq_ids"):
+            interface.assert_no_skipped_seq_ids()
+
+        data = _get_message(1, path, {"seq_id": 3, "request_type": "app-heartbeat", "payload": {}})
+        data["response"] = {"status_code": 202}
+        interface.ingest_data(data)
+        interface.assert_no_skipped_seq_ids()
@@ -0,0 +1,96 @@
+import json
+
+import msgpack
+import pytest
+from utils.proxy import _deserializer
+from utils.proxy._deserializer import deserialize_http_message
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+def _deserialize(path, content):
+    return deserialize_http_message(
+        path, {"headers": [["Content-Type", "application/msgpack"]]}, msgpack.packb(content), "library", "request"
+    )
+
+
+class Test_TraceDeserialization:
+    def test_v05(self):
+        """ v0.5 payloads are decoded from the string table, in one pass """
+
+        strings = ["weblog", "web.request", "GET /", "_dd.appsec.json", json.dumps({"triggers": []}), "http", "m"]
+        span = [0, 1, 2, -1, 2, 0, 10, 0, 0, {3: 4}, {6: 1.5}, 5]
+
+        traces = _deserialize("/v0.5/traces", [strings, [[span, span]]])
+
+        assert traces[0][0] == {
+            "service": "weblog",
+            "name": "web.request",
+            "resource": "GET /",
+            "trace_id": 2 ** 64 - 1,
+            "span_id": 2,
+            "parent_id": None,
+            "start": 10,
+            "duration": None,
+            "error": 0,
+            "meta": {"_dd.appsec.json": {"triggers": []}},
+            "metrics": {"m": 1.5},
+            "type": "http",
+        }
+
+        # strings are shared between spans
+        assert traces[0][0]["service"] is traces[0][1]["service"]
+
+    def test_v05_compact(self, monkeypatch):
+        """ compact spans are read like dicts, and are equal to them """
+
+        strings = ["weblog", "web.request", "GET /", "_dd.appsec.json", json.dumps({"triggers": []}), "http", "m"]
+        span = [0, 1, 2, -1, 2, 3, 10, 5, 0, {3: 4}, {6: 1.5}, 5]
+        payload = [strings, [[span]]]
+
+        expected = _deserialize("/v0.5/traces", payload)[0][0]
+
+        monkeypatch.setattr(_deserializer, "COMPACT_SPANS", True)
+        compact = _deserialize("/v0.5/traces", payload)[0][0]
+
+        assert isinstance(compact, _deserializer.CompactSpan)
+        assert compact == expected
+        assert list(compact) == list(expected)
+        assert compact["meta"] is compact["meta"]
+        assert json.loads(json.dumps(dict(compact))) == expected
+
+        compact["service"] = "other"
+        compact["new"] = 1
+        del compact["type"]
+        assert compact["service"] == "other"
+        assert "type" not in compact
+        assert list(compact)[-1] == "new"
+        assert len(compact) == 12
+
+        with pytest.raises(KeyError):
+            del compact["type"]
+
+    def test_v04(self):
+        spans = [
+            {"trace_id": -1, "span_id": 1, "meta": {"_dd.iast.json": "{}"}, "meta_struct": {"k": msgpack.packb(1)}}
+        ]
+
+        traces = _deserialize("/v0.4/traces", [spans])
+
+        assert traces == [
+            [{"trace_id": 2 ** 64 - 1, "span_id": 1, "meta": {"_dd.iast.json": {}}, "meta_struct": {"k": 1}}]
+        ]
+
+    def test_v04_bytes_meta(self):
+        """ json meta values sent as non-ASCII bytes are parsed, other non-ASCII bytes values are errors """
+
+        appsec = json.dumps({"triggers": [{"rule": "é"}]}, ensure_ascii=False).encode("utf-8")
+        spans = [{"span_id": 1, "meta": {"_dd.appsec.json": appsec, "http.method": b"GET"}}]
+
+        traces = _deserialize("/v0.4/traces", [spans])
+
+        assert traces[0][0]["meta"] == {"_dd.appsec.json": {"triggers": [{"rule": "é"}]}, "http.method": "GET"}
+
+        with pytest.raises(ValueError):
+            _deserialize("/v0.4/traces", [[{"span_id": 1, "meta": {"http.method": "é".encode("utf-8")}}]])
@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+from utils.interfaces._agent import AgentInterfaceValidator
+from utils.interfaces._core import ProxyBasedInterfaceValidator
+from utils.interfaces._library.core import LibraryInterfaceValidator
+
+
+pytestmark = pytest.mark.scenario("TEST_THE_TEST")
+
+
+def _get_message(i, path):
+    return {"log_filename": f"{i:05d}_{path.replace('/', '_')}.json", "path": path, "request": {}, "response": {}}
+
+
+class Test_WaitFor:
+    def test_main(self):
+        """ Several waiters can wait at the same time, they get the message they were waiting for """
+
+        interface = ProxyBasedInterfaceValidator("wait_for_test")
+        interface.ingest_data(_get_message(0, "/info"))
+
+        checked_paths = []
+
+        def is_telemetry(data):
+            checked_paths.append(data["path"])
+            return True
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            traces = executor.submit(interface.wait_for, lambda data: data["path"] == "/v0.4/traces", 5)
+            telemetry = executor.submit(interface.wait_for, is_telemetry, 5, path_filters="/telemetry")
+            nothing = executor.submit(interface.wait_for, lambda data: False, 0.2)
+
+            time.sleep(0.1)
+            interface.ingest_data(_get_message(1, "/v0.4/traces"))
+            interface.ingest_data(_get_message(2, "/telemetry"))
+
+            assert traces.result()["log_filename"] == "00001__v0.4_traces.json"
+            assert telemetry.result()["log_filename"] == "00002__telemetry.json"
+            assert nothing.result() is None
+
+        # predicates of path-keyed waiters only see their paths
+        assert checked_paths == ["/telemetry"]
+        assert len(interface._waiters) == 0
+
+    def test_existing_data(self):
+        interface = ProxyBasedInterfaceValidator("wait_for_test")
+        interface.ingest_data(_get_message(0, "/info"))
+
+        assert interface.wait_for(lambda data: True, 0, path_filters=["/info"])["path"] == "/info"
+
+    def test_ingested_while_checking(self):
+        """ Existing messages are checked outside of the lock, messages ingested meanwhile are checked too """
+
+        interface = ProxyBasedInterfaceValidator("wait_for_test")
+        interface.ingest_data(_get_message(0, "/info"))
+
+        def is_traces(data):
+            if data["path"] == "/info":
+                thread = threading.Thread(target=interface.ingest_data, args=(_get_message(1, "/v0.4/traces"),))
+                thread.start()
+                thread.join(timeout=1)
+
+            return data["path"] == "/v0.4/traces"
+
+        assert interface.wait_for(is_traces, 0)["path"] == "/v0.4/traces"
+        assert len(interface._waiters) == 0
+
+
+class Test_QuietWait:
+    def test_main(self):
+        """ wait stops once the interface is quiet, and is capped by the timeout """
+
+        interface = ProxyBasedInterfaceValidator("wait_test")
+
+        assert interface.wait(5, quiet_period=0.2) < 1
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            elapsed = executor.submit(interface.wait, 0.5, quiet_period=0.2)
+            for i in range(6):
+                interface.ingest_data(_get_message(i, "/v0.4/traces"))
+                time.sleep(0.1)
+
+            assert elapsed.result() == pytest.approx(0.5, abs=0.1)
+
+    def test_expected_kinds(self):
+        """ The library is quiet once traces, a telemetry heartbeat and a remote config poll have been received """
+
+        interface = LibraryInterfaceValidator("library")
+        interface.expected_kinds = ("traces", "app-heartbeat", "remote_config")
+
+        heartbeat = _get_message(2, "/telemetry/proxy/api/v2/apmtelemetry")
+        heartbeat["request"]["headers"] = [["DD-Telemetry-Request-Type", "app-heartbeat"]]
+
+        interface.ingest_data(_get_message(0, "/v0.7/config"))
+        interface.ingest_data(_get_message(1, "/v0.4/traces"))
+
+        # no heartbeat yet, and the remote config poll was before the last traces
+        assert interface.wait(0.5, quiet_period=0.1) == pytest.approx(0.5, abs=0.1)
+
+        interface.ingest_data(heartbeat)
+        interface.ingest_data(_get_message(3, "/v0.7/config"))
+
+        assert interface.wait(5, quiet_period=0.1) < 1
+
+    def test_expected_kinds_disabled(self):
+        """ Without remote config in the weblog, the library does not wait for a remote config poll """
+
+        interface = LibraryInterfaceValidator("library")
+        interface.expected_kinds = ("traces", "app-heartbeat")
+
+        heartbeat = _get_message(1, "/telemetry/proxy/api/v2/apmtelemetry")
+        heartbeat["request"]["headers"] = [["DD-Telemetry-Request-Type", "app-heartbeat"]]
+
+        interface.ingest_data(_get_message(0, "/v0.4/traces"))
+        interface.ingest_data(heartbeat)
+
+        assert interface.wait(5, quiet_period=0.1) < 1
+
+    def test_agent(self):
+        """ The agent is quiet once it forwarded traces, periodic metrics do not count as activity """
+
+        interface = AgentInterfaceValidator()
+
+        interface.ingest_data(_get_message(0, "/api/v2/series"))
+        assert interface.wait(0.5, quiet_period=0.1) == pytest.approx(0.5, abs=0.1)
+
+        interface.ingest_data(_get_message(1, "/api/v0.2/traces"))
+        interface.ingest_data(_get_message(2, "/api/v2/series"))
+        assert interface.wait(5, quiet_period=0.1) < 1
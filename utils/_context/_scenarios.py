@@ -8,8 +8,6 @@ import json
 import glob
 
 import pytest
-from watchdog.observers.polling import PollingObserver
-from watchdog.events import FileSystemEventHandler
 from utils._context.library_version import LibraryVersion, Version
 
 from utils._context.header_tag_vars import VALID_CONFIGS, INVALID_CONFIGS
@@ -295,6 +293,13 @@ class _DockerScenario(_Scenario):
         for container in reversed(self._required_containers):
             container.configure(self.replay)
 
+    @property
+    def proxy_host(self):
+        """ host of the proxy, seen from the test runner: in docker mode, the runner is in the docker network """
+        from utils.proxy.stats import get_proxy_host
+
+        return get_proxy_host()
+
     def get_container_by_dd_integration_name(self, name):
         for container in self._required_containers:
             if hasattr(container, "dd_integration_service") and container.dd_integration_service == name:
@@ -332,7 +337,9 @@ class EndToEndScenario(_DockerScenario):
         appsec_enabled=True,
         additional_trace_header_tags=(),
         library_interface_timeout=None,
-        agent_interface_timeout=5,
+        library_interface_quiet_period=None,
+        agent_interface_timeout=None,
+        agent_interface_quiet_period=None,
         use_proxy=True,
         proxy_state=None,
         backend_interface_timeout=0,
@@ -417,8 +424,12 @@ class EndToEndScenario(_DockerScenario):
             self._required_containers += self.buddies
 
         self.agent_interface_timeout = agent_interface_timeout
+        self.agent_interface_quiet_period = agent_interface_quiet_period
         self.backend_interface_timeout = backend_interface_timeout
         self.library_interface_timeout = library_interface_timeout
+        self.library_interface_quiet_period = library_interface_quiet_period
+        self._wait_time_saved = 0
+        self._proxy_stream = None
 
     def configure(self, config):
         from utils import interfaces
@@ -435,7 +446,21 @@ class EndToEndScenario(_DockerScenario):
             container.interface = getattr(interfaces, container.name)
             container.interface.configure(self.replay)
 
+        # the quiet period of an interface only starts once it received the kinds of messages the weblog sends
+        interfaces.library.expected_kinds = self._get_library_expected_kinds()
+        interfaces.agent.expected_kinds = self._get_agent_expected_kinds()
+
+        if self.agent_interface_timeout is None:
+            self.agent_interface_timeout = 5
+            if self.agent_interface_quiet_period is None:
+                self.agent_interface_quiet_period = 2
+
         if self.library_interface_timeout is None:
+            if self.library_interface_quiet_period is None:
+                # default timeouts are upper bounds for tracers to flush, stop waiting once they are done: expected
+                # kinds of messages received, and nothing else since. Or at the timeout
+                self.library_interface_quiet_period = 5
+
             if self.weblog_container.library == "java":
                 self.library_interface_timeout = 25
             elif self.weblog_container.library.library in ("golang",):
@@ -450,6 +475,35 @@ class EndToEndScenario(_DockerScenario):
             else:
                 self.library_interface_timeout = 40
 
+    def _is_weblog_env_true(self, *names, default=False):
+        """ True if one of the env vars is set to true in the weblog, default if none is set """
+
+        environment = self.weblog_container.environment
+        values = [environment[name] for name in names if name in environment]
+        if len(values) == 0:
+            return default
+
+        return any(str(value).lower() in ("true", "1") for value in values)
+
+    def _get_library_expected_kinds(self):
+        result = ["traces"]
+
+        if self._is_weblog_env_true("DD_INSTRUMENTATION_TELEMETRY_ENABLED", default=True):
+            result.append("app-heartbeat")
+
+        if self._is_weblog_env_true("DD_REMOTE_CONFIGURATION_ENABLED", "DD_REMOTE_CONFIG_ENABLED"):
+            result.append("remote_config")
+
+        return tuple(result)
+
+    def _get_agent_expected_kinds(self):
+        result = ["traces"]
+
+        if self._is_weblog_env_true("DD_TRACE_STATS_COMPUTATION_ENABLED"):
+            result.append("stats")
+
+        return tuple(result)
+
     def session_start(self):
         super().session_start()
         try:
@@ -488,47 +542,40 @@ class EndToEndScenario(_DockerScenario):
         for interface in ("agent", "library", "backend"):
             self.create_log_subfolder(f"interfaces/{interface}")
 
+        for interface in ("agent", "library"):
+            self.create_log_subfolder(f"interfaces/{interface}/capture")
+
         for container in self.buddies:
-            self.create_log_subfolder(f"interfaces/{container.interface.name}")
+            self.create_log_subfolder(f"interfaces/{container.interface.name}/capture")
 
-    def _start_interface_watchdog(self):
+    def _start_interface_subscriber(self):
         from utils import interfaces
+        from utils.interfaces._stream import ProxyStreamSubscriber
 
-        class Event(FileSystemEventHandler):
-            def __init__(self, interface) -> None:
-                super().__init__()
-                self.interface = interface
-
-            def _ingest(self, event):
-                if event.is_directory:
-                    return
-
-                self.interface.ingest_file(event.src_path)
-
-            on_modified = _ingest
-            on_created = _ingest
-
-        # lot of issue using the default OS dependant notifiers (not working on WSL, reaching some inotify watcher
-        # limits on Linux) -> using the good old bare polling system
-        observer = PollingObserver()
-
-        observer.schedule(Event(interfaces.library), path=f"{self.host_log_folder}/interfaces/library")
-        observer.schedule(Event(interfaces.agent), path=f"{self.host_log_folder}/interfaces/agent")
-
-        for container in self.buddies:
-            observer.schedule(Event(container.interface), path=container.interface._log_folder)
-
-        observer.start()
+        # the proxy pushes every captured message, no need to poll the capture store
+        self._proxy_stream = ProxyStreamSubscriber(
+            [interfaces.library, interfaces.agent] + [container.interface for container in self.buddies],
+            host=self.proxy_host,
+        )
+        self._proxy_stream.start()
 
     def _get_warmups(self):
         warmups = super()._get_warmups()
 
         warmups.insert(0, self._create_interface_folders)
-        warmups.insert(1, self._start_interface_watchdog)
+        warmups.insert(1, self._start_interface_subscriber)
+        if self.backend_interface_timeout:
+            warmups.insert(2, self._start_backend_prefetch)
         warmups.append(self._wait_for_app_readiness)
 
         return warmups
 
+    def _start_backend_prefetch(self):
+        from utils import interfaces
+
+        # backend latency is long, start polling traces of first requests while next setups are running
+        interfaces.backend.start_prefetch()
+
     def _wait_for_app_readiness(self):
         from utils import interfaces  # import here to avoid circular import
 
@@ -556,10 +603,38 @@ class EndToEndScenario(_DockerScenario):
         try:
             self._wait_and_stop_containers()
         finally:
+            if self._proxy_stream is not None:
+                if self.use_proxy and not self.replay:
+                    # the proxy may still process messages sent just before containers stopped
+                    self._proxy_stream.wait_for_flush()
+                self._proxy_stream.stop()
+                if self.use_proxy and not self.replay:
+                    # whatever the stream did, the capture store has all messages
+                    self._proxy_stream.catch_up()
+
             self.close_targets()
 
         interfaces.library_dotnet_managed.load_data()
 
+    def pytest_sessionfinish(self, session):
+        from utils import interfaces
+
+        super().pytest_sessionfinish(session)
+
+        logger.debug(f"Library interface cache: {interfaces.library.get_cache_stats()}")
+        logger.debug(f"Agent interface cache: {interfaces.agent.get_cache_stats()}")
+
+        interfaces.backend.stop_polling()
+
+        if self.replay or not self.use_proxy:
+            return
+
+        # the proxy only writes the capture store, export it in the historical layout for humans
+        interfaces.library.export_capture()
+        for container in self.buddies:
+            container.interface.export_capture()
+        interfaces.agent.export_capture()
+
     def _wait_and_stop_containers(self):
         from utils import interfaces
 
@@ -580,7 +655,9 @@ class EndToEndScenario(_DockerScenario):
             interfaces.backend.load_data_from_logs()
 
         elif self.use_proxy:
-            self._wait_interface(interfaces.library, self.library_interface_timeout)
+            self._wait_interface(
+                interfaces.library, self.library_interface_timeout, quiet_period=self.library_interface_quiet_period
+            )
 
             if self.library in ("nodejs",):
                 # for weblogs who supports it, call the flush endpoint
@@ -602,17 +679,26 @@ class EndToEndScenario(_DockerScenario):
                 container.stop()
                 container.interface.check_deserialization_errors()
 
-            self._wait_interface(interfaces.agent, self.agent_interface_timeout)
+            self._wait_interface(
+                interfaces.agent, self.agent_interface_timeout, quiet_period=self.agent_interface_quiet_period
+            )
             self.agent_container.stop()
             interfaces.agent.check_deserialization_errors()
 
             self._wait_interface(interfaces.backend, self.backend_interface_timeout)
 
-    def _wait_interface(self, interface, timeout):
+            if self._wait_time_saved > 0:
+                logger.stdout(f"Quiescence detection saved {self._wait_time_saved:.1f}s of interface waits")
+
+    def _wait_interface(self, interface, timeout, quiet_period=None):
         logger.terminal.write_sep("-", f"Wait for {interface} ({timeout}s)")
         logger.terminal.flush()
 
-        interface.wait(timeout)
+        elapsed = interface.wait(timeout, quiet_period=quiet_period) if quiet_period else interface.wait(timeout)
+
+        if quiet_period and elapsed < timeout:
+            logger.info(f"{interface} is quiet since {quiet_period}s, stop waiting after {elapsed:.1f}s")
+            self._wait_time_saved += timeout - elapsed
 
     def close_targets(self):
         from utils import weblog
@@ -732,6 +818,7 @@ class OpenTelemetryScenario(_DockerScenario):
         self.include_collector = include_collector
         self.include_intake = include_intake
         self.backend_interface_timeout = backend_interface_timeout
+        self._proxy_stream = None
 
     def configure(self, config):
         super().configure(config)
@@ -751,40 +838,26 @@ class OpenTelemetryScenario(_DockerScenario):
     def _create_interface_folders(self):
         for interface in ("open_telemetry", "backend"):
             self.create_log_subfolder(f"interfaces/{interface}")
+        self.create_log_subfolder("interfaces/open_telemetry/capture")
         if self.include_agent:
-            self.create_log_subfolder("interfaces/agent")
+            self.create_log_subfolder("interfaces/agent/capture")
 
-    def _start_interface_watchdog(self):
+    def _start_interface_subscriber(self):
         from utils import interfaces
+        from utils.interfaces._stream import ProxyStreamSubscriber
 
-        class Event(FileSystemEventHandler):
-            def __init__(self, interface) -> None:
-                super().__init__()
-                self.interface = interface
-
-            def _ingest(self, event):
-                if event.is_directory:
-                    return
-
-                self.interface.ingest_file(event.src_path)
-
-            on_modified = _ingest
-            on_created = _ingest
-
-        observer = PollingObserver()
-        observer.schedule(
-            Event(interfaces.open_telemetry), path=f"{self.host_log_folder}/interfaces/open_telemetry", recursive=True
-        )
+        subscribed_interfaces = [interfaces.open_telemetry]
         if self.include_agent:
-            observer.schedule(Event(interfaces.agent), path=f"{self.host_log_folder}/interfaces/agent")
+            subscribed_interfaces.append(interfaces.agent)
 
-        observer.start()
+        self._proxy_stream = ProxyStreamSubscriber(subscribed_interfaces, host=self.proxy_host)
+        self._proxy_stream.start()
 
     def _get_warmups(self):
         warmups = super()._get_warmups()
 
         warmups.insert(0, self._create_interface_folders)
-        warmups.insert(1, self._start_interface_watchdog)
+        warmups.insert(1, self._start_interface_subscriber)
         warmups.append(self._wait_for_app_readiness)
 
         return warmups
@@ -806,10 +879,33 @@ class OpenTelemetryScenario(_DockerScenario):
             self._wait_interface(interfaces.open_telemetry, 5)
             self._wait_interface(interfaces.backend, self.backend_interface_timeout)
 
+        if self._proxy_stream is not None:
+            if self.use_proxy and not self.replay:
+                self._proxy_stream.wait_for_flush()
+            self._proxy_stream.stop()
+            if self.use_proxy and not self.replay:
+                # whatever the stream did, the capture store has all messages
+                self._proxy_stream.catch_up()
+
         self.close_targets()
 
         interfaces.library_dotnet_managed.load_data()
 
+    def pytest_sessionfinish(self, session):
+        from utils import interfaces
+
+        super().pytest_sessionfinish(session)
+
+        interfaces.backend.stop_polling()
+
+        if self.replay:
+            return
+
+        # the proxy only writes the capture store, export it in the historical layout for humans
+        interfaces.open_telemetry.export_capture()
+        if self.include_agent:
+            interfaces.agent.export_capture()
+
     def _wait_interface(self, interface, timeout):
         logger.terminal.write_sep("-", f"Wait for {interface} ({timeout}s)")
         logger.terminal.flush()
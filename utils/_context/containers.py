@@ -4,6 +4,7 @@ import stat
 import json
 from pathlib import Path
 from subprocess import run
+import threading
 import time
 from functools import lru_cache
 import platform
@@ -78,6 +79,8 @@ class TestedContainer:
         self.kwargs = kwargs
         self._container = None
         self.stdout_interface = stdout_interface
+        self._log_followers = {}  # stdout/stderr -> (thread, stream)
+        self._log_sizes = {"stdout": 0, "stderr": 0}  # bytes written in log files
 
     def configure(self, replay):
 
@@ -144,6 +147,9 @@ class TestedContainer:
             **self.kwargs,
         )
 
+        if self.stdout_interface is not None:
+            self._follow_logs()
+
         self.wait_for_health()
         self.warmup()
 
@@ -215,12 +221,54 @@ class TestedContainer:
     def stop(self):
         self._container.stop()
 
+    def _follow_logs(self):
+        """ Write logs while the container runs, so the stdout interface can parse them early """
+
+        for name in ("stdout", "stderr"):
+            stream = self._container.logs(stdout=name == "stdout", stderr=name == "stderr", stream=True, follow=True)
+            thread = threading.Thread(target=self._write_log_stream, args=(name, stream), daemon=True)
+            self._log_followers[name] = (thread, stream)
+            thread.start()
+
+    def _write_log_stream(self, name, stream):
+        last_read = 0
+
+        try:
+            with open(f"{self.log_folder_path}/{name}.log", "wb") as f:
+                for chunk in stream:
+                    f.write(chunk)
+                    self._log_sizes[name] += len(chunk)
+
+                    if time.time() - last_read > 1:
+                        f.flush()
+                        self.stdout_interface.read_new_logs()
+                        last_read = time.time()
+        except Exception as e:
+            # the stream is closed when logs are collected
+            logger.debug(f"{name} stream of {self.name} is closed: {e}")
+
     def collect_logs(self):
-        with open(f"{self.log_folder_path}/stdout.log", "wb") as f:
-            f.write(self._container.logs(stdout=True, stderr=False))
+        if len(self._log_followers) == 0:
+            with open(f"{self.log_folder_path}/stdout.log", "wb") as f:
+                f.write(self._container.logs(stdout=True, stderr=False))
+
+            with open(f"{self.log_folder_path}/stderr.log", "wb") as f:
+                f.write(self._container.logs(stdout=False, stderr=True))
+
+            return
+
+        for name, (thread, stream) in self._log_followers.items():
+            stream.close()
+            thread.join(timeout=10)
+            if thread.is_alive():
+                logger.warning(f"{name} stream of {self.name} is still running")
+
+            # streamed logs are the beginning of logs, only the end is missing
+            content = self._container.logs(stdout=name == "stdout", stderr=name == "stderr")
+            with open(f"{self.log_folder_path}/{name}.log", "ab") as f:
+                f.write(content[self._log_sizes[name] :])
 
-        with open(f"{self.log_folder_path}/stderr.log", "wb") as f:
-            f.write(self._container.logs(stdout=False, stderr=True))
+            self._log_sizes[name] = len(content)
 
     def remove(self):
         logger.debug(f"Removing container {self.name}")
@@ -330,7 +378,7 @@ class ProxyContainer(TestedContainer):
                 f"./{host_log_folder}/interfaces/": {"bind": f"/app/{host_log_folder}/interfaces", "mode": "rw",},
                 "./utils/": {"bind": "/app/utils/", "mode": "ro"},
             },
-            ports={"11111/tcp": ("127.0.0.1", 11111)},
+            ports={"11111/tcp": ("127.0.0.1", 11111), "11112/tcp": ("127.0.0.1", 11112)},
             command="python utils/proxy/core.py",
         )
 
@@ -7,10 +7,11 @@ This files will validate data flow between agent and backend
 """
 
 import threading
-import copy
 
-from utils.tools import logger, get_rid_from_span, get_rid_from_request
+from utils.tools import logger, get_rid_from_request
 from utils.interfaces._core import ProxyBasedInterfaceValidator
+from utils.interfaces._span_index import RidSpanIndex
+from utils.interfaces._telemetry import get_batch_item_views, get_telemetry_batch_items, get_telemetry_request_types
 from utils.interfaces._schemas_validators import SchemaValidator
 from utils.interfaces._misc_validators import HeadersPresenceValidator, HeadersMatchValidator
 
@@ -18,38 +19,91 @@ from utils.interfaces._misc_validators import HeadersPresenceValidator, HeadersM
 class AgentInterfaceValidator(ProxyBasedInterfaceValidator):
     """Validate agent/backend interface"""
 
+    # sent periodically, even if the weblog is idle
+    periodic_paths = ("/api/v1/validate", "/api/v1/series", "/api/v2/series", "/api/v1/check_run", "/intake/")
+    periodic_telemetry_request_types = ("app-heartbeat", "generate-metrics", "distributions")
+
+    # the agent is quiet once it forwarded traces. The scenario also expects stats when the weblog computes them
+    expected_kinds = ("traces",)
+
     def __init__(self):
         super().__init__("agent")
         self.ready = threading.Event()
+        self._rid_index = RidSpanIndex(self._materialize, self._iter_trace_spans)
 
-    def ingest_file(self, src_path):
+    def ingest_data(self, data):
         self.ready.set()
-        return super().ingest_file(src_path)
+        return super().ingest_data(data)
 
-    def get_appsec_data(self, request):
+    def _append_data(self, data):
+        super()._append_data(data)
 
-        rid = get_rid_from_request(request)
+        if data["path"] == "/api/v0.2/traces":
+            self._rid_index.add(data)
 
-        for data in self.get_data(path_filters="/api/v0.2/traces"):
-            if "tracerPayloads" not in data["request"]["content"]:
-                continue
+    def _classify(self, data):
+        path = data["path"]
+
+        if path == "/api/v0.2/traces":
+            return True, "traces"
+
+        if path == "/api/v0.2/stats":
+            return True, "stats"
+
+        if path in self.periodic_paths:
+            return False, None
+
+        if path != "/api/v2/apmtelemetry":
+            return True, None
+
+        request_types = get_telemetry_request_types(data, self._materialize)
+        if request_types is None:
+            return True, None
+
+        return any(request_type not in self.periodic_telemetry_request_types for request_type in request_types), None
 
-            content = data["request"]["content"]["tracerPayloads"]
+    @staticmethod
+    def _iter_trace_spans(data):
+        content = data["request"]["content"]
+        if not isinstance(content, dict):
+            return
 
-            for payload in content:
-                for chunk in payload["chunks"]:
-                    for span in chunk["spans"]:
-                        appsec_data = span.get("meta", {}).get("_dd.appsec.json", None) or span.get(
-                            "meta_struct", {}
-                        ).get("appsec", None)
-                        if appsec_data is None:
-                            continue
+        for payload in content.get("tracerPayloads", []):
+            for chunk in payload["chunks"]:
+                for span in chunk["spans"]:
+                    yield (payload, chunk), span
 
-                        if rid is None:
-                            yield data, payload, chunk, span, appsec_data
-                        elif get_rid_from_span(span) == rid:
-                            logger.debug(f'Found span with rid={rid} in {data["log_filename"]}')
-                            yield data, payload, chunk, span, appsec_data
+    def _get_trace_spans(self, rid):
+        """ returns [(data, payload, chunk, span)], only spans related to rid if it's not None """
+
+        if rid is None:
+            return self._get_cached(
+                "trace_spans",
+                lambda: [
+                    (data, payload, chunk, span)
+                    for data in self.get_data(path_filters="/api/v0.2/traces")
+                    for (payload, chunk), span in self._iter_trace_spans(data)
+                ],
+            )
+
+        return [(data, payload, chunk, span) for data, (payload, chunk), span in self._rid_index.get(rid)]
+
+    def get_appsec_data(self, request):
+        rid = get_rid_from_request(request)
+        yield from self._get_cached(("appsec_data", rid), lambda: list(self._get_appsec_data(rid)))
+
+    def _get_appsec_data(self, rid):
+        for data, payload, chunk, span in self._get_trace_spans(rid):
+            appsec_data = span.get("meta", {}).get("_dd.appsec.json", None) or span.get("meta_struct", {}).get(
+                "appsec", None
+            )
+            if appsec_data is None:
+                continue
+
+            if rid is not None:
+                logger.debug(f'Found span with rid={rid} in {data["log_filename"]}')
+
+            yield data, payload, chunk, span, appsec_data
 
     def assert_use_domain(self, expected_domain):
         # TODO: Move this in test class
@@ -62,7 +116,7 @@ class AgentInterfaceValidator(ProxyBasedInterfaceValidator):
 
     def assert_schemas(self, allowed_errors=None):
         validator = SchemaValidator("agent", allowed_errors)
-        self.validate(validator, success_by_default=True)
+        validator.validate_all(self.get_data())
 
     def get_profiling_data(self):
         yield from self.get_data(path_filters="/api/v2/profile")
@@ -75,21 +129,17 @@ class AgentInterfaceValidator(ProxyBasedInterfaceValidator):
         raise ValueError("No data validate this test")
 
     def get_telemetry_data(self, flatten_message_batches=True):
-        all_data = self.get_data(path_filters="/api/v2/apmtelemetry")
-        if flatten_message_batches:
-            yield from all_data
+        path_filters = "/api/v2/apmtelemetry"
+
+        if not flatten_message_batches:
+            yield from self.get_data(path_filters=path_filters)
         else:
-            for data in all_data:
-                if data["request"]["content"].get("request_type") == "message-batch":
-                    for batch_payload in data["request"]["content"]["payload"]:
-                        # create a fresh copy of the request for each payload in the
-                        # message batch, as though they were all sent independently
-                        copied = copy.deepcopy(data)
-                        copied["request"]["content"]["request_type"] = batch_payload.get("request_type")
-                        copied["request"]["content"]["payload"] = batch_payload.get("payload")
-                        yield copied
-                else:
-                    yield data
+            # payloads of message batches are returned as though they were all sent independently. Batches are split
+            # once per generation, views on them are built on each call
+            batch_items = self._get_cached(
+                "telemetry_batch_items", lambda: get_telemetry_batch_items(self.get_data(path_filters=path_filters))
+            )
+            yield from get_batch_item_views(batch_items)
 
     def assert_headers_presence(self, path_filter, request_headers=(), response_headers=(), check_condition=None):
         validator = HeadersPresenceValidator(request_headers, response_headers, check_condition)
@@ -127,19 +177,17 @@ class AgentInterfaceValidator(ProxyBasedInterfaceValidator):
         if rid:
             logger.debug(f"Will try to find agent spans related to request {rid}")
 
+        self._get_cached("checked_trace_payloads", self._check_trace_payloads)
+
+        for data, _, _, span in self._get_trace_spans(rid):
+            yield data, span
+
+    def _check_trace_payloads(self):
         for data in self.get_data(path_filters="/api/v0.2/traces"):
             if "tracerPayloads" not in data["request"]["content"]:
                 raise ValueError("Trace property is missing in agent payload")
 
-            content = data["request"]["content"]["tracerPayloads"]
-
-            for payload in content:
-                for chunk in payload["chunks"]:
-                    for span in chunk["spans"]:
-                        if rid is None:
-                            yield data, span
-                        elif get_rid_from_span(span) == rid:
-                            yield data, span
+        return True
 
     def get_dsm_data(self):
         return self.get_data(path_filters="/api/v0.1/pipeline_stats")
@@ -4,14 +4,16 @@
 
 """ This files will validate data flow between agent and backend """
 
+import concurrent.futures
 import json
 import os
 import time
 
 import requests
 
+from utils.interfaces._backend_poller import BackendPoller, Lookup
 from utils.interfaces._core import ProxyBasedInterfaceValidator
-from utils.tools import logger, get_rid_from_span, get_rid_from_request
+from utils.tools import logger, get_rid_from_request, get_rid_from_span
 
 
 class _BackendInterfaceValidator(ProxyBasedInterfaceValidator):
@@ -21,9 +23,25 @@ class _BackendInterfaceValidator(ProxyBasedInterfaceValidator):
         super().__init__("backend")
 
         # Mapping from request ID to the root span trace IDs submitted from tracers to agent.
+        # It's filled from library root spans once the library interface is ready, or as the library receives them
+        # when traces are prefetched
         self.rid_to_library_trace_ids = {}
+        self._library_trace_ids = set()  # (rid, trace_id) already mapped
         self.dd_site_url = self._get_dd_site_api_host()
         self.message_count = 0
+        # requests in flight when the backend is polled for several traces or spans at once
+        self.concurrency = int(os.environ.get("SYSTEM_TESTS_BACKEND_CONCURRENCY", "8"))
+
+        # started on first use, its pooled session is used by all lookups until stop_polling()
+        self._poller = None
+
+        # once started, the backend is polled for each trace the library sends, once it's expected to be ingested.
+        # Prefetch has its own retry budget, traces not ready are polled again by tests
+        self._prefetch = False
+        self._prefetched = {}  # trace_id -> future of the backend data
+        self.prefetch_delay = float(os.environ.get("SYSTEM_TESTS_BACKEND_INGESTION_DELAY", "10"))
+        self.prefetch_retries = 3
+        self._prefetch_stats = {"ready": 0, "polled_again": 0}
 
         self.library_interface = library_interface
 
@@ -53,24 +71,85 @@ class _BackendInterfaceValidator(ProxyBasedInterfaceValidator):
         return dd_app_url
 
     # Called by the test setup to make sure the interface is ready.
-    def wait(self, timeout):
-        super().wait(timeout)
+    def wait(self, timeout, quiet_period=None):
+        elapsed = super().wait(timeout, quiet_period=quiet_period)
         self._init_rid_to_library_trace_ids()
+        return elapsed
 
     def load_data_from_logs(self):
         super().load_data_from_logs()
         self._init_rid_to_library_trace_ids()
 
     def _init_rid_to_library_trace_ids(self):
-
-        # Map each request ID to the spans created and submitted during that request call.
         for _, span in self.library_interface.get_root_spans():
             rid = get_rid_from_span(span)
+            if rid is not None:
+                self._on_library_root_span(rid, span)
+
+    def _on_library_root_span(self, rid, span):
+        # Map each request ID to the spans created and submitted during that request call.
+        trace_id = span["trace_id"]
+
+        with self._lock:
+            if (rid, trace_id) in self._library_trace_ids:
+                return
+
+            self._library_trace_ids.add((rid, trace_id))
+            self.rid_to_library_trace_ids.setdefault(rid, []).append(trace_id)
+
+            if self._prefetch:
+                self._prefetch_trace(trace_id)
+
+    def _prefetch_trace(self, trace_id):
+        with self._lock:
+            if trace_id not in self._prefetched:
+                lookup = self._get_trace_lookup(trace_id, retries=self.prefetch_retries, delay=self.prefetch_delay)
+                self._prefetched[trace_id] = self._get_poller().submit(lookup)
+
+    def _get_poller(self):
+        with self._lock:
+            if self._poller is None:
+                self._poller = BackendPoller(self.dd_site_url, None, self._on_poller_response, self.concurrency)
+                self._poller.start()
+
+            return self._poller
+
+    def start_prefetch(self):
+        """ From now on, polls the backend for traces of requests as soon as the library sends them, while the
+            session goes on. Traces already sent are polled immediately """
+
+        try:
+            self._get_headers()
+        except KeyError:
+            logger.warning("DD_API_KEY or DD_APPLICATION_KEY is missing, backend traces won't be prefetched")
+            return
+
+        with self._lock:
+            if self._prefetch:
+                return
 
-            if not self.rid_to_library_trace_ids.get(rid):
-                self.rid_to_library_trace_ids[rid] = [span["trace_id"]]
-            else:
-                self.rid_to_library_trace_ids[rid].append(span["trace_id"])
+            self._prefetch = True
+
+            for trace_ids in self.rid_to_library_trace_ids.values():
+                for trace_id in trace_ids:
+                    self._prefetch_trace(trace_id)
+
+        # only now, the library indexes traces as it receives them, root spans already received are given too
+        self.library_interface.add_root_span_listener(self._on_library_root_span)
+
+    def stop_polling(self):
+        """ Stops prefetching, cancels lookups still running, and closes the pooled session """
+
+        with self._lock:
+            if self._prefetch:
+                stats = self._prefetch_stats
+                logger.info(f"Backend prefetch: {stats['ready']} traces ready, {stats['polled_again']} polled again")
+
+            self._prefetch = False
+            poller, self._poller = self._poller, None
+
+        if poller is not None:
+            poller.stop()
 
     #################################
     ######### API for tests #########
@@ -171,10 +250,11 @@ class _BackendInterfaceValidator(ProxyBasedInterfaceValidator):
     ############################################
 
     def _get_trace_ids(self, rid):
-        if rid not in self.rid_to_library_trace_ids:
-            raise ValueError("There is no trace id related to this request ")
+        with self._lock:
+            if rid not in self.rid_to_library_trace_ids:
+                raise ValueError("There is no trace id related to this request ")
 
-        return self.rid_to_library_trace_ids[rid]
+            return list(self.rid_to_library_trace_ids[rid])
 
     def _request(self, method, path, host=None, json_payload=None, dd_api_key=None, dd_app_key=None):
         while True:
@@ -196,21 +276,29 @@ class _BackendInterfaceValidator(ProxyBasedInterfaceValidator):
                 continue
             return data
 
-    def _request_one(self, method, path, host=None, json_payload=None, dd_api_key=None, dd_app_key=None):
+    @staticmethod
+    def _get_headers(dd_api_key=None, dd_app_key=None):
         if dd_api_key is None:
             dd_api_key = os.environ["DD_API_KEY"]
         if dd_app_key is None:
             dd_app_key = os.environ.get("DD_APP_KEY", os.environ["DD_APPLICATION_KEY"])
-        headers = {
+
+        return {
             "DD-API-KEY": dd_api_key,
             "DD-APPLICATION-KEY": dd_app_key,
         }
 
+    def _request_one(self, method, path, host=None, json_payload=None, dd_api_key=None, dd_app_key=None):
+        headers = self._get_headers(dd_api_key, dd_app_key)
+
         if host is None:
             host = self.dd_site_url
         r = requests.request(method, url=f"{host}{path}", headers=headers, json=json_payload, timeout=10)
 
-        if r.status_code == 403:
+        return self._save_response(host, path, json_payload, r.status_code, r.content, dict(r.headers))
+
+    def _save_response(self, host, path, json_payload, status_code, content, headers):
+        if status_code == 403:
             raise ValueError(
                 "Request to the backend returned error 403: check DD_API_KEY and DD_APP_KEY environment variables"
             )
@@ -224,63 +312,95 @@ class _BackendInterfaceValidator(ProxyBasedInterfaceValidator):
             "path": path,
             "query": query,
             "request": {"content": json_payload},
-            "response": {"status_code": r.status_code, "content": r.content, "headers": dict(r.headers),},
-            "log_filename": f"{self._log_folder}/{self.message_count:03d}_{path.replace('/', '_')}.json",
+            "response": {"status_code": status_code, "content": content, "headers": headers,},
         }
-        self.message_count += 1
+
+        with self._lock:  # responses may be saved by the prefetch thread
+            data["log_filename"] = f"{self._log_folder}/{self.message_count:03d}_{path.replace('/', '_')}.json"
+            self.message_count += 1
 
         try:
-            data["response"]["content"] = r.json()
-        except:
-            data["response"]["content"] = r.text
+            data["response"]["content"] = json.loads(content)
+        except ValueError:
+            data["response"]["content"] = content.decode("utf-8", errors="replace")
 
         with open(data["log_filename"], mode="w", encoding="utf-8") as f:
             json.dump(data, f, indent=2)
 
         return data
 
-    def _get_backend_trace_data(self, rid, trace_id, dd_api_key=None, dd_app_key=None):
-        path = f"/api/v1/trace/{trace_id}"
-        result = self._request("GET", path=path, dd_api_key=dd_api_key, dd_app_key=dd_app_key)
-        result["rid"] = rid
+    def _on_poller_response(self, lookup, host, status_code, content, headers):
+        return self._save_response(host, lookup.path, lookup.json_payload, status_code, content, headers)
 
-        return result
+    def _poll(self, lookups):
+        """ Sends all lookups concurrently, and returns their data. Raises the first error """
 
-    def _wait_for_trace(self, rid, trace_id, retries, sleep_interval_multiplier, dd_api_key=None, dd_app_key=None):
-        sleep_interval_s = 1
-        current_retry = 1
-        while current_retry <= retries:
-            logger.info(f"Retry {current_retry}")
-            current_retry += 1
+        poller = self._get_poller()
+        futures = [poller.submit(lookup) for lookup in lookups]
+        concurrent.futures.wait(futures)
 
-            data = self._get_backend_trace_data(rid, trace_id, dd_api_key, dd_app_key)
+        return [future.result() for future in futures]
 
+    def _get_trace_lookup(
+        self, trace_id, retries=5, sleep_interval_multiplier=2.0, dd_api_key=None, dd_app_key=None, delay=0.0
+    ):
+        def is_ready(data):
             # We should retry fetching from the backend as long as the response is 404.
             status_code = data["response"]["status_code"]
             if status_code not in (404, 200):
                 raise ValueError(f"Backend did not provide trace: {data['path']}. Status is {status_code}.")
-            if status_code != 404:
-                return data
 
-            logger.debug(f"Sleeping {sleep_interval_s} seconds")
-            time.sleep(sleep_interval_s)
-            sleep_interval_s *= sleep_interval_multiplier  # increase the sleep time with each retry
+            return status_code == 200
 
-        raise ValueError(
-            f"Backend did not provide trace after {retries} retries: {data['path']}. Status is {status_code}."
+        return Lookup(
+            "GET",
+            f"/api/v1/trace/{trace_id}",
+            is_ready,
+            headers=self._get_headers(dd_api_key, dd_app_key),
+            retries=retries,
+            sleep_interval_multiplier=sleep_interval_multiplier,
+            delay=delay,
         )
 
+    def _wait_for_trace(self, rid, trace_id, retries, sleep_interval_multiplier, dd_api_key=None, dd_app_key=None):
+        logger.info(f"Waiting for trace {trace_id} to become available from request {rid} with {retries} retries...")
+
+        lookup = self._get_trace_lookup(trace_id, retries, sleep_interval_multiplier, dd_api_key, dd_app_key)
+        data = self._poll([lookup])[0]
+        data["rid"] = rid
+
+        return data
+
     def _wait_for_request_traces(self, rid, retries=5, sleep_interval_multiplier=2.0):
 
         trace_ids = self._get_trace_ids(rid)
         logger.info(
             f"Waiting for {len(trace_ids)} traces to become available from request {rid} with {retries} retries..."
         )
+
+        result = {}
         for trace_id in trace_ids:
-            logger.info(
-                f"Waiting for trace {trace_id} to become available from request {rid} with {retries} retries..."
-            )
-            yield self._wait_for_trace(rid, trace_id, retries, sleep_interval_multiplier)
+            with self._lock:
+                future = self._prefetched.get(trace_id)
+
+            if future is not None:
+                try:
+                    result[trace_id] = future.result()
+                    self._prefetch_stats["ready"] += 1
+                except Exception as e:
+                    logger.info(f"Prefetch of trace {trace_id} failed, polling it again: {e}")
+                    self._prefetch_stats["polled_again"] += 1
+
+        # other traces are polled at once
+        missing = [trace_id for trace_id in trace_ids if trace_id not in result]
+        if len(missing) != 0:
+            lookups = [self._get_trace_lookup(trace_id, retries, sleep_interval_multiplier) for trace_id in missing]
+            result.update(zip(missing, self._poll(lookups)))
+
+        for trace_id in trace_ids:
+            data = result[trace_id]
+            data["rid"] = rid
+            yield data
 
     def _extract_trace_from_backend_response(self, response):
         trace = response["content"].get("trace")
@@ -295,30 +415,31 @@ class _BackendInterfaceValidator(ProxyBasedInterfaceValidator):
             f"Waiting until spans (non-empty response) become available with "
             f"query '{query_filter}' with {retries} retries..."
         )
-        sleep_interval_s = 1
-        current_retry = 1
-        while current_retry <= retries:
-            logger.info(f"Retry {current_retry}")
-            current_retry += 1
-
-            data = self._get_event_platform_spans(query_filter, limit)
 
+        def is_ready(data):
             # We should retry fetching from the backend as long as the response has empty data.
             status_code = data["response"]["status_code"]
             if status_code != 200:
                 raise ValueError(f"Fetching spans from Event Platform failed: {data['path']}. Status is {status_code}.")
 
-            parsed = data["response"]["content"]
-            if parsed["result"]["count"] > 0:
-                return data
-
-            time.sleep(sleep_interval_s)
-            sleep_interval_s *= sleep_interval_multiplier  # increase the sleep time with each retry
+            return data["response"]["content"]["result"]["count"] > 0
+
+        path, request_data = self._get_event_platform_request(query_filter, limit)
+        lookup = Lookup(
+            "POST",
+            path,
+            is_ready,
+            headers=self._get_headers(),
+            json_payload=request_data,
+            retries=retries,
+            sleep_interval_multiplier=sleep_interval_multiplier,
+            required=False,  # the last response is returned, and checked by the caller
+        )
 
-        # We always try once so `data` should have not be None.
-        return data
+        return self._poll([lookup])[0]
 
-    def _get_event_platform_spans(self, query_filter, limit):
+    @staticmethod
+    def _get_event_platform_request(query_filter, limit):
         # Example of this query can be seen in the `events-ui` internal website (see Jira ATI-2419).
         path = "/api/unstable/event-platform/analytics/list?type=trace"
 
@@ -338,7 +459,7 @@ class _BackendInterfaceValidator(ProxyBasedInterfaceValidator):
             }
         }
 
-        return self._request("POST", path, json_payload=request_data)
+        return path, request_data
 
     # Queries the backend metric timeseries API and returns the matched series.
     def query_timeseries(
@@ -0,0 +1,235 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Polls the backend for many lookups at once: traces by id, span searches...
+
+Lookups run concurrently over one pooled session. Each lookup is retried with its own backoff, jittered so that
+lookups started together do not hit the backend together. On a rate limit (429), all lookups pause until it resets.
+
+poll() sends a batch of lookups and waits for all of them. Once start() is called, lookups can also be submitted one
+by one from any thread, they run in a background event loop until stop().
+
+Usage:
+    PYTHONPATH=. python utils/interfaces/_backend_poller.py --traces 100 --latency 0.2
+        => benchmark against sequential polling, on a local backend stand-in
+"""
+
+import argparse
+import asyncio
+import random
+import threading
+import time
+
+import aiohttp
+
+from utils.tools import logger
+
+
+class Lookup:
+    """ A request sent until is_ready(data) returns True, at most retries times, the first one after delay seconds.
+
+        is_ready can raise if the response shows that the lookup will never succeed. If the lookup is not ready
+        after all retries, a ValueError is raised, or the last data is returned if required is False """
+
+    def __init__(
+        self,
+        method,
+        path,
+        is_ready,
+        host=None,
+        headers=None,
+        json_payload=None,
+        retries=5,
+        sleep_interval_multiplier=2.0,
+        required=True,
+        delay=0.0,
+    ):
+        self.method = method
+        self.path = path
+        self.is_ready = is_ready
+        self.host = host
+        self.headers = headers
+        self.json_payload = json_payload
+        self.retries = retries
+        self.sleep_interval_multiplier = sleep_interval_multiplier
+        self.required = required
+        self.delay = delay
+
+
+class BackendPoller:
+    """ on_response(lookup, host, status_code, content, headers) returns the data given to lookup.is_ready. It's
+        called in the event loop, and must not block for long """
+
+    def __init__(self, host, headers, on_response, concurrency=8, timeout=10, jitter=0.5, rng=None):
+        self.host = host
+        self.headers = headers
+        self.on_response = on_response
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.jitter = jitter
+        self._rng = rng or random.Random()
+        self._resume_at = 0  # event loop time, when rate limited
+
+        # background mode
+        self._loop = None
+        self._thread = None
+        self._session = None
+
+    def poll(self, lookups):
+        """ returns, for each lookup, the data that satisfied it, or the exception that ended it """
+
+        return asyncio.run(self.poll_async(lookups))
+
+    async def poll_async(self, lookups):
+        async with self._create_session() as session:
+            tasks = [self._poll_one(session, lookup) for lookup in lookups]
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="backend-poller", daemon=True)
+        self._thread.start()
+
+        async def create_session():
+            return self._create_session()
+
+        self._session = asyncio.run_coroutine_threadsafe(create_session(), self._loop).result()
+
+    def submit(self, lookup):
+        """ returns a concurrent.futures.Future of the lookup data """
+
+        return asyncio.run_coroutine_threadsafe(self._poll_one(self._session, lookup), self._loop)
+
+    def stop(self):
+        """ cancels lookups still running """
+
+        async def close():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._session.close()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result(timeout=10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def get_sleep_interval(self, sleep_interval):
+        """ spreads sleep_interval over [1 - jitter / 2, 1 + jitter / 2] """
+
+        return sleep_interval * (1 + self.jitter * (self._rng.random() - 0.5))
+
+    async def _poll_one(self, session, lookup):
+        if lookup.delay:
+            await asyncio.sleep(lookup.delay)
+
+        sleep_interval_s = 1
+
+        for current_retry in range(1, lookup.retries + 1):
+            data = await self._request(session, lookup)
+
+            if lookup.is_ready(data):
+                return data
+
+            if current_retry != lookup.retries:
+                await asyncio.sleep(self.get_sleep_interval(sleep_interval_s))
+                sleep_interval_s *= lookup.sleep_interval_multiplier  # increase the sleep time with each retry
+
+        if lookup.required:
+            status_code = data["response"]["status_code"]
+            raise ValueError(
+                f"Backend did not provide {lookup.path} after {lookup.retries} retries. Status is {status_code}."
+            )
+
+        return data
+
+    async def _request(self, session, lookup):
+        loop = asyncio.get_running_loop()
+        host = lookup.host or self.host
+
+        while True:
+            if self._resume_at > loop.time():
+                await asyncio.sleep(self._resume_at - loop.time())
+
+            async with session.request(
+                lookup.method, f"{host}{lookup.path}", headers=lookup.headers or self.headers, json=lookup.json_payload
+            ) as response:
+                content = await response.read()
+                status_code = response.status
+                headers = dict(response.headers)
+                rate_limit_reset = response.headers.get("x-ratelimit-reset", "1")  # case insensitive
+
+            if status_code == 429:
+                # https://docs.datadoghq.com/api/latest/rate-limits/
+                sleep_time_s = int(rate_limit_reset)
+                logger.warning(f"Rate limit hit, pausing backend requests for {sleep_time_s}s")
+                self._resume_at = max(self._resume_at, loop.time() + self.get_sleep_interval(sleep_time_s))
+                continue
+
+            return self.on_response(lookup, host, status_code, content, headers)
+
+
+def _get_json_data(lookup, host, status_code, content, headers):  # pylint: disable=unused-argument
+    return {"path": lookup.path, "response": {"status_code": status_code, "content": content}}
+
+
+def _is_trace_ready(data):
+    return data["response"]["status_code"] == 200
+
+
+def _poll_sequentially(host, trace_ids, retries):
+    """ one trace after the other, sleeping between retries, as before the poller """
+
+    import requests
+
+    for trace_id in trace_ids:
+        sleep_interval_s = 1
+        for _ in range(retries):
+            if requests.get(f"{host}/api/v1/trace/{trace_id}", timeout=10).status_code == 200:
+                break
+            time.sleep(sleep_interval_s)
+            sleep_interval_s *= 2.0
+
+
+def _main():
+    from utils.interfaces._backend_stand_in import BackendStandIn, run_in_thread
+
+    parser = argparse.ArgumentParser(description="Benchmark of the backend poller, on a local stand-in")
+    parser.add_argument("--traces", type=int, default=100)
+    parser.add_argument("--ingestion-delay", type=float, default=3.0, help="max seconds before a trace is available")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds to answer a request")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    trace_ids = list(range(1, args.traces + 1))
+    rng = random.Random(0)
+    ingestion_delays = [rng.uniform(0, args.ingestion_delay) for _ in trace_ids]
+
+    for name in ("sequential", "poller"):
+        stand_in = BackendStandIn(latency=args.latency)
+        for trace_id, ingestion_delay in zip(trace_ids, ingestion_delays):
+            stand_in.add_trace(trace_id, rid="A" * 36, ingestion_delay=ingestion_delay)
+
+        with run_in_thread(stand_in) as host:
+            start = time.time()
+            if name == "sequential":
+                _poll_sequentially(host, trace_ids, retries=5)
+            else:
+                poller = BackendPoller(host, {}, _get_json_data, concurrency=args.concurrency)
+                lookups = [Lookup("GET", f"/api/v1/trace/{trace_id}", _is_trace_ready) for trace_id in trace_ids]
+                poller.poll(lookups)
+
+            print(f"{name:<10} {time.time() - start:6.2f}s, {stand_in.request_count} requests")
+
+
+if __name__ == "__main__":
+    _main()
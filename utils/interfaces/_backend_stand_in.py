@@ -0,0 +1,143 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Local HTTP server answering like the backend trace and span search endpoints, to test and benchmark the backend
+interface offline.
+
+A trace is available ingestion_delay seconds after it's added, until then the trace endpoint answers 404, and the
+span search returns no event. Every answer is delayed by latency seconds.
+"""
+
+import asyncio
+import contextlib
+import re
+import threading
+import time
+
+from aiohttp import web
+
+
+class BackendStandIn:
+    def __init__(self, ingestion_delay=0.0, latency=0.0, rate_limit=None, rate_limit_reset=1):
+        self.ingestion_delay = ingestion_delay
+        self.latency = latency
+        self.rate_limit = rate_limit  # requests per rate_limit_reset seconds, then 429
+        self.rate_limit_reset = rate_limit_reset
+
+        self.request_count = 0
+        self.rate_limited_count = 0
+
+        self._traces = {}  # trace_id -> (available_at, trace)
+        self._window_start = 0
+        self._window_count = 0
+        self._runner = None
+
+    def add_trace(self, trace_id, rid, span_count=1, ingestion_delay=None):
+        if ingestion_delay is None:
+            ingestion_delay = self.ingestion_delay
+
+        spans = {}
+        for i in range(span_count):
+            span_id = str(trace_id * 1000 + i)
+            spans[span_id] = {
+                "trace_id": str(trace_id),
+                "span_id": span_id,
+                "parent_id": "0" if i == 0 else str(trace_id * 1000),
+                "name": "web.request" if i == 0 else "child.span",
+                "service": "weblog",
+                "meta": {"http.useragent": f"system_tests rid/{rid}"},
+            }
+
+        trace = {"trace_id": str(trace_id), "root_id": str(trace_id * 1000), "spans": spans}
+        self._traces[str(trace_id)] = (time.time() + ingestion_delay, trace)
+
+    def _get_available_traces(self):
+        now = time.time()
+        return {trace_id: trace for trace_id, (available_at, trace) in self._traces.items() if available_at <= now}
+
+    def _is_rate_limited(self):
+        if self.rate_limit is None:
+            return False
+
+        now = time.time()
+        if now - self._window_start >= self.rate_limit_reset:
+            self._window_start = now
+            self._window_count = 0
+
+        self._window_count += 1
+        return self._window_count > self.rate_limit
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.request_count += 1
+        await request.read()
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self._is_rate_limited():
+            self.rate_limited_count += 1
+            return web.json_response(
+                {"errors": ["Rate limit exceeded"]},
+                status=429,
+                headers={"x-ratelimit-reset": str(self.rate_limit_reset)},
+            )
+
+        return await handler(request)
+
+    async def _get_trace(self, request):
+        trace = self._get_available_traces().get(request.match_info["trace_id"])
+
+        if trace is None:
+            return web.json_response({"errors": ["Not found"]}, status=404)
+
+        return web.json_response({"trace": trace})
+
+    async def _search_spans(self, request):
+        query = (await request.json())["list"]["search"]["query"]
+        match = re.search(r"@http\.useragent:\*(\w+)", query)
+
+        events = []
+        for trace in self._get_available_traces().values():
+            for span in trace["spans"].values():
+                if match is None or span["meta"]["http.useragent"].endswith(match.group(1)):
+                    events.append({"event": span})
+
+        return web.json_response({"result": {"count": len(events), "events": events}})
+
+    async def start(self, host="127.0.0.1", port=0):
+        """ returns the URL of the server """
+
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get("/api/v1/trace/{trace_id}", self._get_trace)
+        app.router.add_post("/api/unstable/event-platform/analytics/list", self._search_spans)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+@contextlib.contextmanager
+def run_in_thread(stand_in, host="127.0.0.1", port=0):
+    """ runs stand_in in an event loop of its own thread, yields its URL """
+
+    loop = asyncio.new_event_loop()
+    url = loop.run_until_complete(stand_in.start(host, port))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield url
+    finally:
+        asyncio.run_coroutine_threadsafe(stand_in.stop(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
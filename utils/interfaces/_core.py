@@ -4,16 +4,22 @@
 
 """ This file contains base class used to validate interfaces """
 
+import bisect
+from collections import OrderedDict, defaultdict
+import functools
+import heapq
 import threading
 import json
-from os import listdir
-from os.path import isfile, join
+from os.path import basename
 import re
 import time
 
 import pytest
 
 from utils._context.core import context
+from utils.proxy._deserializer import materialize
+from utils.proxy.capture_store import CaptureReader, export_to_files, get_capture_folder
+from utils.interfaces._replay import load_messages
 from utils.tools import logger
 
 
@@ -41,52 +47,156 @@ class InterfaceValidator:
 class ProxyBasedInterfaceValidator(InterfaceValidator):
     """ Interfaces based on proxy container """
 
+    cache_size = 256  # results cached by _get_cached, most are per request id
+
+    # kinds of messages (see _classify) the interface must receive after its last activity before it can be quiet
+    expected_kinds = ()
+
     def __init__(self, name):
         super().__init__(name)
 
-        self._wait_for_event = threading.Event()
-        self._wait_for_function = None
+        self._waiters = []
 
         self._lock = threading.RLock()
+        self._materialize_lock = threading.Lock()
+        # messages are kept ordered by sequence number, keys are kept aside for bisection
         self._data_list = []
+        self._data_keys = []
+        self._data_by_path = defaultdict(list)  # path -> messages
+        self._keys_by_path = defaultdict(list)
+        self._matching_paths = {}  # path filters -> paths matching them
         self._ingested_files = set()
+        self._capture_reader = None
+        self._last_activity = 0  # last time a non-periodic message was ingested
+        self._kinds_since_activity = {}  # expected kind -> first time it was received since the last activity
+        self._generation = 0  # incremented for each message, cached results are valid for one generation
+        self._cache = OrderedDict()  # key -> (generation, result), least recently used first
+        self._cache_hits = 0
+        self._cache_misses = 0
 
     @property
     def _log_folder(self):
         return f"{context.scenario.host_log_folder}/interfaces/{self.name}"
 
-    def ingest_file(self, src_path):
+    @property
+    def _capture_folder(self):
+        return get_capture_folder(self._log_folder)
+
+    def ingest_capture(self):
+        """ Ingest all messages appended by the proxy to the capture store since the last call """
 
         with self._lock:
-            if src_path in self._ingested_files:
-                return
+            if self._capture_reader is None:
+                self._capture_reader = CaptureReader(self._capture_folder)
 
-            logger.debug(f"Ingesting {src_path}")
+            messages = self._capture_reader.read_new()
 
-            with open(src_path, "r", encoding="utf-8") as f:
-                try:
-                    data = json.load(f)
-                except json.decoder.JSONDecodeError:
-                    # the file may not be finished
-                    return
+        for data in messages:
+            self.ingest_data(data)
+
+    def ingest_data(self, data):
+
+        with self._lock:
+            if data["log_filename"] in self._ingested_files:
+                return
+
+            logger.debug(f"Ingesting {data['log_filename']}")
 
             self._append_data(data)
-            self._ingested_files.add(src_path)
+            self._ingested_files.add(data["log_filename"])
 
-            # make 100% sure that the list is sorted
-            self._data_list.sort(key=lambda data: data["log_filename"])
+            waiters = [waiter for waiter in self._waiters if waiter.match_path(data["path"])]
 
-        if self._wait_for_function and self._wait_for_function(data):
-            self._wait_for_event.set()
+        # outside of the lock, it may deserialize the message
+        is_activity, kind = self._classify(data)
 
-    def wait(self, timeout):
-        time.sleep(timeout)
+        with self._lock:
+            now = time.time()
+
+            if is_activity:
+                self._last_activity = now
+                self._kinds_since_activity = {}
+
+            if kind is not None:
+                self._kinds_since_activity.setdefault(kind, now)
+
+        for waiter in waiters:
+            if waiter.is_done():
+                continue
+
+            try:
+                self._materialize(data)
+            except ValueError as e:
+                logger.error(str(e))
+                return
+
+            waiter.check(data)
+
+    def _classify(self, data):  # pylint: disable=unused-argument
+        """ returns (is_activity, kind). is_activity is False for messages sent periodically, whatever the test
+            activity is (heartbeats...). kind is one of expected_kinds, or None """
+        return True, None
+
+    def _get_quiet_since(self):
+        """ returns the time since when the interface is quiet, or None if it did not receive yet all expected kinds
+            of messages since its last activity """
+
+        with self._lock:
+            if any(kind not in self._kinds_since_activity for kind in self.expected_kinds):
+                return None
+
+            return max([self._last_activity, *self._kinds_since_activity.values()])
+
+    def wait(self, timeout, quiet_period=None):
+        """ Wait for timeout seconds. If quiet_period is set, stops waiting as soon as the interface has been quiet
+            for quiet_period seconds: after its last activity, it received all expected kinds of messages, and then
+            only periodic messages. Returns the time spent """
+
+        start = time.time()
+
+        if quiet_period is None or quiet_period >= timeout:
+            time.sleep(timeout)
+            return time.time() - start
+
+        deadline = start + timeout
+
+        while True:
+            now = time.time()
+            quiet_since = self._get_quiet_since()
+
+            if quiet_since is None:
+                wake_up = now + min(quiet_period, 1)
+            else:
+                quiet_since = max(quiet_since, start)
+                if now - quiet_since >= quiet_period:
+                    return now - start
+
+                wake_up = quiet_since + quiet_period
+
+            if now >= deadline:
+                return now - start
+
+            time.sleep(min(deadline, wake_up) - now)
+
+    def get_message_count(self):
+        with self._lock:
+            return len(self._data_list)
 
     def check_deserialization_errors(self):
-        """ Verify that all proxy deserialization are successful """
+        """ Verify that all proxy deserialization are successful. Messages not deserialized yet are deserialized, so
+            that a bad payload stops the session here, rather than failing the first test reading it """
 
-        for data in self._data_list:
+        with self._lock:
+            data_list = list(self._data_list)
+
+        for data in data_list:
             filename = data["log_filename"]
+
+            try:
+                self._materialize(data)
+            except ValueError:
+                pass  # the traceback is reported below
+
             if "content" not in data["request"]:
                 traceback = data["request"].get("traceback", "no traceback")
                 pytest.exit(reason=f"Unexpected error while deserialize {filename}:\n {traceback}", returncode=1)
@@ -97,32 +207,102 @@ class ProxyBasedInterfaceValidator(InterfaceValidator):
 
     def load_data_from_logs(self):
 
-        for filename in sorted(listdir(self._log_folder)):
-            file_path = join(self._log_folder, filename)
-            if isfile(file_path):
+        for data in load_messages(self._log_folder, self._capture_folder, self.name):
+            self._append_data(data)
+
+        logger.info(f"{self.name} interface gets {len(self._data_list)} messages from {self._log_folder}")
 
-                with open(file_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
+    def export_capture(self):
+        """ Export captured messages to one file per message, easier to read for humans """
 
-                self._append_data(data)
-                logger.info(f"{self.name} interface gets {file_path}")
+        count = export_to_files(self._log_folder, materialize=lambda data: materialize(data, self.name))
+        logger.debug(f"{count} messages of {self.name} interface exported to {self._log_folder}")
 
     def _append_data(self, data):
-        self._data_list.append(data)
+        self._generation += 1
+
+        key = get_message_key(data)
+        _insert_ordered(self._data_list, self._data_keys, data, key)
+
+        path = data["path"]
+        if path not in self._data_by_path:
+            for path_filters, paths in self._matching_paths.items():
+                if _match_path(path, path_filters):
+                    paths.append(path)
+
+        _insert_ordered(self._data_by_path[path], self._keys_by_path[path], data, key)
+
+    def _get_data_list(self, path_filters):
+        """ returns messages whose path matches one of path_filters (already normalized), ordered """
+
+        with self._lock:
+            if path_filters not in self._matching_paths:
+                self._matching_paths[path_filters] = [
+                    path for path in self._data_by_path if _match_path(path, path_filters)
+                ]
+
+            buckets = [list(self._data_by_path[path]) for path in self._matching_paths[path_filters]]
+
+        if len(buckets) == 1:
+            return buckets[0]
+
+        return heapq.merge(*buckets, key=get_message_key)
+
+    def _get_cached(self, key, compute):
+        """ returns compute(), computed once per generation of the interface. Errors are not cached """
+
+        with self._lock:
+            generation = self._generation
+            cached = self._cache.get(key)
+
+            if cached is not None and cached[0] == generation:
+                self._cache.move_to_end(key)
+                self._cache_hits += 1
+                return cached[1]
+
+            self._cache_misses += 1
+
+        # messages ingested meanwhile may be included, the result will just be computed once more
+        result = compute()
+
+        with self._lock:
+            self._cache[key] = (generation, result)
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return result
+
+    def get_cache_stats(self):
+        with self._lock:
+            return {"hits": self._cache_hits, "misses": self._cache_misses, "size": len(self._cache)}
+
+    def _materialize(self, data):
+        """ Messages captured by the proxy keep raw bodies, they are deserialized the first time they are read """
+
+        with self._materialize_lock:
+            materialize(data, self.name)
+
+        for key in ("request", "response"):
+            if data.get(key) and "traceback" in data[key]:
+                filename, traceback = data["log_filename"], data[key]["traceback"]
+                raise ValueError(f"Unexpected error while deserializing {filename}:\n {traceback}")
+
+        return data
 
     def get_data(self, path_filters=None):
 
-        if path_filters is not None:
+        if path_filters is None:
+            data_list = self._data_list
+        else:
             if isinstance(path_filters, str):
                 path_filters = [path_filters]
 
-            path_filters = [re.compile(path) for path in path_filters]
-
-        for data in self._data_list:
-            if path_filters is not None and all((path.fullmatch(data["path"]) is None for path in path_filters)):
-                continue
+            data_list = self._get_data_list(tuple(path_filters))
 
-            yield data
+        for data in data_list:
+            yield self._materialize(data)
 
     def validate(self, validator, path_filters=None, success_by_default=False):
         for data in self.get_data(path_filters=path_filters):
@@ -143,28 +323,112 @@ class ProxyBasedInterfaceValidator(InterfaceValidator):
         if not success_by_default:
             raise ValueError("Test has not been validated by any data")
 
-    def wait_for(self, wait_for_function, timeout):
+    def wait_for(self, wait_for_function, timeout, path_filters=None):
+        """ Wait for a message validating wait_for_function, and returns it. Returns None on timeout.
+            If path_filters is set, only messages on those paths are checked """
 
         if self.replay:
-            return
+            return None
 
-        # first, try existing data
-        with self._lock:
-            for data in self._data_list:
-                if wait_for_function(data):
-                    return
+        if isinstance(path_filters, str):
+            path_filters = [path_filters]
+
+        waiter = _Waiter(wait_for_function, None if path_filters is None else tuple(path_filters))
 
-            # then set the lock, and wait for append_data to release it
-            self._wait_for_event.clear()
-            self._wait_for_function = wait_for_function
+        checked_files = set()
+
+        while True:
+            # first, try existing data, outside of the lock: messages may be deserialized
+            with self._lock:
+                ingested_count = len(self._ingested_files)
+                data_list = list(self._data_list if path_filters is None else self._get_data_list(waiter.path_filters))
+
+            for data in data_list:
+                if data["log_filename"] in checked_files:
+                    continue
+
+                checked_files.add(data["log_filename"])
+                if wait_for_function(self._materialize(data)):
+                    return data
+
+            # then register the waiter, ingest_data will check new messages. If some were ingested meanwhile,
+            # check them first
+            with self._lock:
+                if len(self._ingested_files) == ingested_count:
+                    self._waiters.append(waiter)
+                    break
 
         # release the main lock, and sleep !
-        if self._wait_for_event.wait(timeout):
+        try:
+            result = waiter.wait(timeout)
+        finally:
+            with self._lock:
+                self._waiters.remove(waiter)
+
+        if result is not None:
             logger.info(f"wait for {wait_for_function} finished in success")
         else:
             logger.error(f"Wait for {wait_for_function} finished in error")
 
-        self._wait_for_function = None
+        return result
+
+
+class _Waiter:
+    def __init__(self, function, path_filters):
+        self.function = function
+        self.path_filters = path_filters
+
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+
+    def match_path(self, path):
+        return self.path_filters is None or _match_path(path, self.path_filters)
+
+    def is_done(self):
+        return self._event.is_set()
+
+    def check(self, data):
+        """ called from ingestion threads, with a materialized message """
+
+        if self.function(data):
+            with self._lock:
+                if not self._event.is_set():
+                    self._result = data
+                    self._event.set()
+
+    def wait(self, timeout):
+        self._event.wait(timeout)
+        return self._result
+
+
+def get_message_key(data):
+    """ messages are ordered by their sequence number, which prefixes their file name """
+
+    name = basename(data["log_filename"])
+    prefix = name.split("_", 1)[0]
+
+    return (int(prefix) if prefix.isdigit() else -1, name)
+
+
+def _insert_ordered(data_list, keys, data, key):
+    # messages mostly come in order
+    if len(keys) == 0 or keys[-1] <= key:
+        keys.append(key)
+        data_list.append(data)
+    else:
+        index = bisect.bisect_right(keys, key)
+        keys.insert(index, key)
+        data_list.insert(index, data)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_path_filters(path_filters):
+    return [re.compile(path) for path in path_filters]
+
+
+def _match_path(path, path_filters):
+    return any(pattern.fullmatch(path) is not None for pattern in _compile_path_filters(path_filters))
 
 
 class ValidationError(Exception):
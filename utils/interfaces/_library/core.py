@@ -2,12 +2,18 @@
 # This product includes software developed at Datadog (https://www.datadoghq.com/).
 # Copyright 2021 Datadog, Inc.
 
-import copy
 import json
 import threading
 
-from utils.tools import logger, get_rid_from_user_agent, get_rid_from_span, get_rid_from_request
+from utils.tools import logger, get_rid_from_user_agent, get_rid_from_request
 from utils.interfaces._core import ProxyBasedInterfaceValidator
+from utils.interfaces._span_index import RidSpanIndex
+from utils.interfaces._telemetry import (
+    TelemetryIndex,
+    get_batch_item_views,
+    get_telemetry_batch_items,
+    get_telemetry_request_types,
+)
 from utils.interfaces._library._utils import get_trace_request_path
 from utils.interfaces._library.appsec import _WafAttack, _ReportedHeader
 from utils.interfaces._library.miscs import _SpanTagValidator
@@ -23,13 +29,69 @@ from utils.interfaces._schemas_validators import SchemaValidator
 class LibraryInterfaceValidator(ProxyBasedInterfaceValidator):
     """Validate library/agent interface"""
 
+    trace_paths = ("/v0.4/traces", "/v0.5/traces")
+
+    # sent periodically, even if the weblog is idle
+    periodic_paths = ("/info", "/v0.7/config")
+    periodic_telemetry_request_types = ("app-heartbeat", "generate-metrics", "distributions")
+
+    # the library is quiet once it flushed traces. The scenario also expects a telemetry heartbeat and a remote config
+    # poll when they are enabled in the weblog
+    expected_kinds = ("traces",)
+
     def __init__(self, name):
         super().__init__(name)
         self.ready = threading.Event()
+        self._rid_index = RidSpanIndex(self._materialize, self._iter_trace_spans)
+        self._telemetry_index = TelemetryIndex(self._materialize)
 
-    def ingest_file(self, src_path):
+    def ingest_data(self, data):
         self.ready.set()
-        return super().ingest_file(src_path)
+        super().ingest_data(data)
+
+        if self._rid_index.has_listeners:
+            # listeners get root spans as soon as they are received, outside of the interface lock
+            self._rid_index.update()
+
+    def _append_data(self, data):
+        super()._append_data(data)
+
+        if data["path"] in self.trace_paths:
+            self._rid_index.add(data)
+        elif data["path"] == "/telemetry/proxy/api/v2/apmtelemetry":
+            self._telemetry_index.add(data)
+
+    def _classify(self, data):
+        path = data["path"]
+
+        if path in self.trace_paths:
+            return True, "traces"
+
+        if path == "/v0.7/config":
+            return False, "remote_config"
+
+        if path in self.periodic_paths:
+            return False, None
+
+        if path != "/telemetry/proxy/api/v2/apmtelemetry":
+            return True, None
+
+        request_types = get_telemetry_request_types(data, self._materialize)
+        if request_types is None:
+            return True, None
+
+        is_activity = any(request_type not in self.periodic_telemetry_request_types for request_type in request_types)
+        return is_activity, "app-heartbeat" if "app-heartbeat" in request_types else None
+
+    @staticmethod
+    def _iter_trace_spans(data):
+        traces = data["request"]["content"]
+        if not isinstance(traces, list):
+            return
+
+        for trace in traces:
+            for span in trace:
+                yield trace, span
 
     ################################################################
     def wait_for_remote_config_request(self, timeout=30):
@@ -42,27 +104,27 @@ class LibraryInterfaceValidator(ProxyBasedInterfaceValidator):
 
             return False
 
-        self.wait_for(wait_function, timeout)
+        self.wait_for(wait_function, timeout, path_filters="/v0.7/config")
 
     ############################################################
     def get_traces(self, request=None):
-        paths = ["/v0.4/traces", "/v0.5/traces"]
-
         rid = get_rid_from_request(request)
 
-        if rid:
-            logger.debug(f"Try to find traces related to request {rid}")
-
-        for data in self.get_data(path_filters=paths):
-            traces = data["request"]["content"]
-            for trace in traces:
-                if rid is None:
+        if rid is None:
+            for data in self.get_data(path_filters=self.trace_paths):
+                for trace in data["request"]["content"]:
                     yield data, trace
-                else:
-                    for span in trace:
-                        if rid == get_rid_from_span(span):
-                            yield data, trace
-                            break
+
+            return
+
+        logger.debug(f"Try to find traces related to request {rid}")
+
+        last_trace = None
+        for data, trace, _ in self._rid_index.get(rid):
+            # spans of a trace are contiguous in the index, yield each trace once
+            if trace is not last_trace:
+                last_trace = trace
+                yield data, trace
 
     def get_spans(self, request=None, full_trace=False):
         """Iterate over all spans reported by the tracer to the agent.
@@ -74,23 +136,43 @@ class LibraryInterfaceValidator(ProxyBasedInterfaceValidator):
         """
         rid = get_rid_from_request(request)
 
-        if rid:
+        if rid is not None and not full_trace:
             logger.debug(f"Try to find spans related to request {rid}")
 
+            for data, trace, span in self._rid_index.get(rid):
+                logger.debug(f"A span is found in {data['log_filename']}")
+                yield data, trace, span
+
+            return
+
         for data, trace in self.get_traces(request=request):
             for span in trace:
-                if rid is None or full_trace:
-                    yield data, trace, span
-                elif rid == get_rid_from_span(span):
-                    logger.debug(f"A span is found in {data['log_filename']}")
-                    yield data, trace, span
+                yield data, trace, span
 
     def get_root_spans(self, request=None):
-        for data, _, span in self.get_spans(request=request):
+        def compute():
+            spans = self.get_spans(request=request)
+            return [(data, span) for data, _, span in spans if span.get("parent_id") in (0, None)]
+
+        yield from self._get_cached(("root_spans", get_rid_from_request(request)), compute)
+
+    def add_root_span_listener(self, listener):
+        """ listener(rid, span) is called for each root span related to a request, including the ones already received.
+            It's called in the thread ingesting messages, it must be fast """
+
+        def on_span(rid, span):
             if span.get("parent_id") in (0, None):
-                yield data, span
+                listener(rid, span)
+
+        self._rid_index.add_listener(on_span)
 
     def get_appsec_events(self, request=None, full_trace=False):
+        yield from self._get_cached(
+            ("appsec_events", get_rid_from_request(request), full_trace),
+            lambda: list(self._get_appsec_events(request, full_trace)),
+        )
+
+    def _get_appsec_events(self, request, full_trace):
         for data, trace, span in self.get_spans(request=request, full_trace=full_trace):
             if "appsec" in span.get("meta_struct", {}):
 
@@ -144,38 +226,24 @@ class LibraryInterfaceValidator(ProxyBasedInterfaceValidator):
                                 break
 
     def get_telemetry_data(self, flatten_message_batches=True):
-        all_data = self.get_data(path_filters="/telemetry/proxy/api/v2/apmtelemetry")
+        path_filters = "/telemetry/proxy/api/v2/apmtelemetry"
+
         if not flatten_message_batches:
-            yield from all_data
+            yield from self.get_data(path_filters=path_filters)
         else:
-            for data in all_data:
-                if data["request"]["content"].get("request_type") == "message-batch":
-                    for batch_payload in data["request"]["content"]["payload"]:
-                        # create a fresh copy of the request for each payload in the
-                        # message batch, as though they were all sent independently
-                        copied = copy.deepcopy(data)
-                        copied["request"]["content"]["request_type"] = batch_payload.get("request_type")
-                        copied["request"]["content"]["payload"] = batch_payload.get("payload")
-                        yield copied
-                else:
-                    yield data
+            # payloads of message batches are returned as though they were all sent independently. Batches are split
+            # once per generation, views on them are built on each call
+            batch_items = self._get_cached(
+                "telemetry_batch_items", lambda: get_telemetry_batch_items(self.get_data(path_filters=path_filters))
+            )
+            yield from get_batch_item_views(batch_items)
 
     def get_telemetry_metric_series(self, namespace, metric):
-        relevantSeries = []
-        for data in self.get_telemetry_data():
-            content = data["request"]["content"]
-            if content.get("request_type") != "generate-metrics":
-                continue
-            fallback_namespace = content["payload"].get("namespace")
+        return self._telemetry_index.get_metric_series(namespace, metric)
 
-            for series in content["payload"]["series"]:
-                computed_namespace = series.get("namespace", fallback_namespace)
-
-                # Inject here the computed namespace considering the fallback. This simplifies later assertions.
-                series["_computed_namespace"] = computed_namespace
-                if computed_namespace == namespace and series["metric"] == metric:
-                    relevantSeries.append(series)
-        return relevantSeries
+    def get_telemetry_messages(self, request_type):
+        """ returns telemetry messages of a given request type, payloads of message batches being flattened """
+        return self._telemetry_index.get_messages(request_type)
 
     ############################################################
 
@@ -235,7 +303,7 @@ class LibraryInterfaceValidator(ProxyBasedInterfaceValidator):
 
     def assert_schemas(self, allowed_errors=None):
         validator = SchemaValidator("library", allowed_errors)
-        self.validate(validator, success_by_default=True)
+        validator.validate_all(self.get_data())
 
     def assert_all_traces_requests_forwarded(self, paths):
         # TODO : move this in test class
@@ -350,7 +418,7 @@ class LibraryInterfaceValidator(ProxyBasedInterfaceValidator):
 
     def assert_no_skipped_seq_ids(self):
         validator = _NoSkippedSeqId()
-        self.validate_telemetry(validator, success_by_default=True)
+        validator.seq_ids = self._telemetry_index.get_seq_ids()
 
         validator.final_check()
 
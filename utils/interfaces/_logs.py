@@ -4,9 +4,13 @@
 
 """Check data that are sent to logs file on weblog"""
 
+from collections import defaultdict
+from collections.abc import Mapping
+import functools
 import json
 import re
 import os
+import threading
 
 from utils._context.core import context
 from utils.tools import logger
@@ -23,7 +27,10 @@ class _LogsInterfaceValidator(InterfaceValidator):
         self._new_log_line_pattern = re.compile(new_log_line_pattern or ".")
         self._parsers = []
         self.timeout = 0
-        self._data_list = []
+
+        self._lock = threading.Lock()
+        self._readers = {}  # filename -> _LogFileReader, in the order of _get_files()
+        self._layouts = {}  # parser -> _RecordLayout
 
     def _get_files(self):
         raise NotImplementedError()
@@ -35,68 +42,105 @@ class _LogsInterfaceValidator(InterfaceValidator):
         return self._new_log_line_pattern.search(line)
 
     def _is_skipped_line(self, line):
-        for pattern in self._skipped_patterns:
-            if pattern.search(line):
-                return True
+        return self._get_skipped_line_matcher()(line)
 
-        return False
+    def _get_skipped_line_matcher(self):
+        # patterns may be added by configure(), they are compiled when they are used
+        return _get_line_matcher(tuple(self._skipped_patterns))
 
     def _get_standardized_level(self, level):
         return level
 
-    def _read(self):
-        for filename in self._get_files():
-            logger.info(f"For {self}, reading {filename}")
-            log_count = 0
-            try:
-                with open(filename, "r", encoding="utf-8") as f:
-                    buffer = []
-                    for line in f:
-                        if line.endswith("\n"):
-                            line = line[:-1]  # remove tailing \n
-                        line = self._clean_line(line)
+    def _parse(self, log_line):
+        for parser in self._parsers:
+            m = parser.match(log_line)
+            if m:
+                if parser not in self._layouts:
+                    self._layouts[parser] = _RecordLayout(parser, self._get_standardized_level)
 
-                        if self._is_skipped_line(line):
-                            continue
+                return _LogRecord(log_line, self._layouts[parser], sum(m.regs[1:], ()))
 
-                        if self._is_new_log_line(line) and len(buffer) != 0:
-                            log_count += 1
-                            yield "\n".join(buffer) + "\n"
-                            buffer = []
+        return _LogRecord(log_line, None, None)
 
-                        buffer.append(line)
+    def _get_reader(self, filename):
+        if filename not in self._readers:
+            self._readers[filename] = _LogFileReader(filename, self)
 
-                    log_count += 1
-                    yield "\n".join(buffer) + "\n"
+        return self._readers[filename]
 
-                logger.info(f"Reading {filename} is finished, {log_count} has been treated")
-            except FileNotFoundError:
-                logger.debug(f"File not found, skipping it: {filename}")
+    def read_new_logs(self):
+        """ Parse lines appended to log files since the last call, it can be called while the container runs """
+
+        with self._lock:
+            for filename in self._get_files():
+                self._get_reader(filename).read()
 
     def load_data(self):
         logger.debug(f"Load data for log interface {self.name}")
 
-        for log_line in self._read():
-
-            parsed = {}
-            for parser in self._parsers:
-                m = parser.match(log_line)
-                if m:
-                    parsed = m.groupdict()
-                    if "level" in parsed:
-                        parsed["level"] = self._get_standardized_level(parsed["level"])
-                    break
-
-            parsed["raw"] = log_line
-
-            self._data_list.append(parsed)
-
-    def get_data(self):
-        yield from self._data_list
-
-    def validate(self, validator, success_by_default=False):
-
-        for data in self.get_data():
+        with self._lock:
+            for filename in self._get_files():
+                logger.info(f"For {self}, reading {filename}")
+                reader = self._get_reader(filename)
+
+                if reader.read(final=True):
+                    logger.info(f"Reading {filename} is finished, {len(reader.records)} has been treated")
+                else:
+                    logger.debug(f"File not found, skipping it: {filename}")
+
+    def get_data(self, **fields):
+        """ yields log entries. If fields are given (level="ERROR", rid=..., trace_id=...), only entries having
+            these values are returned, using an index of each field """
+
+        with self._lock:
+            if len(fields) == 0:
+                records = [record for reader in self._readers.values() for record in reader.records]
+            else:
+                records = []
+                for reader in self._readers.values():
+                    # the most selective index gives candidates, other fields are checked on each candidate
+                    indexes = [reader.get_index(field).get(value, []) for field, value in fields.items()]
+                    for position in min(indexes, key=len):
+                        record = reader.records[position]
+                        if all(value in _get_field_values(field, record) for field, value in fields.items()):
+                            records.append(record)
+
+        yield from records
+
+    def _get_candidates(self, pattern, **conditions):
+        """ returns log entries that may contain pattern: the ones containing the literal part of pattern. If
+            conditions are given (field -> pattern searched in the field), only entries matching them are returned,
+            conditions being checked once per distinct value, using the index of each field """
+
+        literal = _get_required_literal(pattern)
+        conditions = {field: re.compile(condition) for field, condition in conditions.items()}
+        records = []
+
+        with self._lock:
+            for reader in self._readers.values():
+                positions = None
+
+                for field, condition in conditions.items():
+                    matching = {
+                        position
+                        for value, value_positions in reader.get_index(field).items()
+                        if condition.search(value)
+                        for position in value_positions
+                    }
+                    positions = matching if positions is None else positions & matching
+
+                if positions is None:
+                    candidates = reader.records
+                else:
+                    candidates = [reader.records[position] for position in sorted(positions)]
+
+                records.extend(record for record in candidates if literal in record.raw)
+
+        return records
+
+    def validate(self, validator, success_by_default=False, data_list=None):
+
+        for data in self.get_data() if data_list is None else data_list:
             try:
                 if validator(data) is True:
                     return
@@ -109,11 +153,324 @@ class _LogsInterfaceValidator(InterfaceValidator):
 
     def assert_presence(self, pattern, **extra_conditions):
         validator = _LogPresence(pattern, **extra_conditions)
-        self.validate(validator.check, success_by_default=False)
+        # message is a part of the log entry, the literal part of pattern must be in the log entry
+        data_list = self._get_candidates(pattern, **extra_conditions)
+        self.validate(validator.check, success_by_default=False, data_list=data_list)
 
     def assert_absence(self, pattern, allowed_patterns=None):
         validator = _LogAbsence(pattern, allowed_patterns)
-        self.validate(validator.check, success_by_default=True)
+        self.validate(validator.check, success_by_default=True, data_list=self._get_candidates(pattern))
+
+
+class _LogFileReader:
+    """ Reads a log file incrementally: each read only parses bytes appended since the previous one. The last log
+        entry is kept aside until the final read, as next lines may belong to it """
+
+    def __init__(self, filename, interface):
+        self.filename = filename
+        self._interface = interface
+        self._reset()
+
+    def _reset(self):
+        self.records = []
+        self._indexes = {}  # field -> (count of indexed records, value -> positions)
+        self._offset = 0
+        self._pending = b""  # last line, not terminated yet
+        self._buffer = []  # lines of the current log entry
+
+    def read(self, final=False):
+        """ returns False if the file does not exist """
+
+        try:
+            with open(self.filename, "rb") as f:
+                if os.fstat(f.fileno()).st_size < self._offset:
+                    logger.debug(f"{self.filename} has been truncated, reading it again")
+                    self._reset()
+
+                f.seek(self._offset)
+                content = f.read()
+        except FileNotFoundError:
+            return False
+
+        self._offset += len(content)
+
+        content = self._pending + content
+        end = len(content) if final else content.rfind(b"\n") + 1
+        self._pending = content[end:]
+
+        lines = content[:end].decode("utf-8", errors="replace").split("\n")
+        if lines[-1] == "":
+            lines.pop()  # content ends with a new line
+
+        interface = self._interface
+        clean_line = interface._clean_line  # pylint: disable=protected-access
+        is_skipped_line = interface._get_skipped_line_matcher()  # pylint: disable=protected-access
+        is_new_log_line = interface._is_new_log_line  # pylint: disable=protected-access
+        buffer = self._buffer
+
+        for line in lines:
+            if line.endswith("\r"):
+                line = line[:-1]
+
+            line = clean_line(line)
+
+            if is_skipped_line(line):
+                continue
+
+            if is_new_log_line(line) and len(buffer) != 0:
+                self._add_record()
+                buffer = self._buffer
+
+            buffer.append(line)
+
+        if final and len(self._buffer) != 0:
+            self._add_record()
+
+        return True
+
+    def _add_record(self):
+        self.records.append(self._interface._parse("\n".join(self._buffer) + "\n"))  # pylint: disable=protected-access
+        self._buffer = []
+
+    def get_index(self, field):
+        """ returns value -> positions of records having this value for field. Indexes are built on first use,
+            and updated with records parsed since """
+
+        count, positions = self._indexes.get(field, (0, defaultdict(list)))
+
+        for position in range(count, len(self.records)):
+            for value in _get_field_values(field, self.records[position]):
+                positions[value].append(position)
+
+        self._indexes[field] = (len(self.records), positions)
+
+        return positions
+
+
+class _RecordLayout:
+    """ Shared by records parsed by the same parser """
+
+    def __init__(self, parser, get_standardized_level):
+        self.keys = tuple(parser.groupindex) + ("raw",)
+        self.positions = {name: (group - 1) * 2 for name, group in parser.groupindex.items()}
+        self.get_standardized_level = get_standardized_level
+
+
+class _LogRecord(Mapping):
+    """ A parsed log entry, read as a dict. Only the log entry and the spans of parsed fields are kept, fields are
+        extracted when they are read """
+
+    __slots__ = ("raw", "_layout", "_spans")
+
+    def __init__(self, raw, layout, spans):
+        self.raw = raw
+        self._layout = layout
+        self._spans = spans
+
+    def __getitem__(self, key):
+        if key == "raw":
+            return self.raw
+
+        if self._layout is None or key not in self._layout.positions:
+            raise KeyError(key)
+
+        position = self._layout.positions[key]
+        start, end = self._spans[position], self._spans[position + 1]
+
+        if start == -1:
+            return None
+
+        if key == "level":
+            return self._layout.get_standardized_level(self.raw[start:end])
+
+        return self.raw[start:end]
+
+    def __iter__(self):
+        return iter(self._layout.keys if self._layout is not None else ("raw",))
+
+    def __len__(self):
+        return len(self._layout.keys) if self._layout is not None else 1
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+_RID_PATTERN = re.compile(r"(?<![A-Z])[A-Z]{36}(?![A-Z])")  # see utils/_weblog.py
+_TRACE_ID_PATTERN = re.compile(r"dd\.trace_id\W{1,3}(\d+)")
+
+
+def _get_field_values(field, record):
+    """ returns values of field in a log entry. rid and trace_id are not parsed, but found in the raw entry """
+
+    if field == "rid":
+        return set(_RID_PATTERN.findall(record.raw))
+
+    if field == "trace_id":
+        return set(_TRACE_ID_PATTERN.findall(record.raw))
+
+    value = record.get(field)
+    return () if value is None else (value,)
+
+
+def _get_required_literal(pattern):
+    """ returns the longest string that any match of pattern contains, or "" if it's not found.
+
+        It's conservative: groups, classes, escapes like \\d or \\x41, and characters followed by a quantifier that
+        allows zero occurrences end the literal. Alternatives and inline flags give "" """
+
+    if not isinstance(pattern, str) or re.search(r"\(\?[aiLmsux]+\)", pattern):
+        return ""
+
+    literals = []
+    current = []
+    i = 0
+
+    while i < len(pattern):
+        c = pattern[i]
+
+        if c == "\\":
+            following = pattern[i + 1 : i + 2]
+            char = following if following and not following.isalnum() else None
+            i = _skip_escape(pattern, i)
+        elif c == "[":
+            i = _skip_class(pattern, i)
+            char = None
+        elif c == "(":
+            i = _skip_group(pattern, i)
+            char = None
+        elif c == "|":
+            return ""
+        elif c in "*?{":
+            if len(current) != 0:
+                current.pop()  # the previous character may not be present, or repeated
+            if c == "{":
+                i = pattern.find("}", i) if "}" in pattern[i:] else len(pattern)
+            i += 1
+            char = None
+        elif c in ".^$+)":
+            i += 1
+            char = None
+        else:
+            i += 1
+            char = c
+
+        if char is None:
+            literals.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+
+    literals.append("".join(current))
+
+    return max(literals, key=len)
+
+
+_ESCAPE_PAYLOAD_PATTERNS = {
+    "x": re.compile(r"[0-9a-fA-F]{0,2}"),
+    "u": re.compile(r"[0-9a-fA-F]{0,4}"),
+    "U": re.compile(r"[0-9a-fA-F]{0,8}"),
+    "N": re.compile(r"(\{[^}]*\})?"),
+}
+_ESCAPE_DIGITS_PATTERN = re.compile(r"0[0-7]{0,2}|[0-7]{3}|\d{1,2}")  # octal, or group reference
+
+
+def _skip_escape(pattern, i):
+    """ returns the position after the escape starting at i, including its payload: \\x41, \\u00e9, \\N{...}... """
+
+    following = pattern[i + 1 : i + 2]
+
+    if "0" <= following <= "9":
+        return i + 1 + len(_ESCAPE_DIGITS_PATTERN.match(pattern, i + 1).group())
+
+    if following in _ESCAPE_PAYLOAD_PATTERNS:
+        return _ESCAPE_PAYLOAD_PATTERNS[following].match(pattern, i + 2).end()
+
+    return i + 2
+
+
+def _skip_class(pattern, i):
+    """ returns the position after the character class starting at i """
+
+    i += 1
+    if pattern[i : i + 1] == "^":
+        i += 1
+    if pattern[i : i + 1] == "]":
+        i += 1
+
+    while i < len(pattern) and pattern[i] != "]":
+        i += 2 if pattern[i] == "\\" else 1
+
+    return i + 1
+
+
+def _skip_group(pattern, i):
+    """ returns the position after the group starting at i """
+
+    depth = 0
+
+    while i < len(pattern):
+        c = pattern[i]
+
+        if c == "\\":
+            i += 2
+            continue
+
+        if c == "[":
+            i = _skip_class(pattern, i)
+            continue
+
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+
+        i += 1
+
+    return i
+
+
+def _is_anchored(pattern):
+    """ True if the pattern can only match at the beginning of a line """
+
+    if re.search(r"\(\?[aiLmsux]+\)", pattern):
+        return False  # inline flags apply to the whole pattern, it can't be a part of an alternation
+
+    # escaped characters and character sets may contain a |
+    pattern = re.sub(r"\\.", "", pattern)
+    pattern = re.sub(r"\[[^\]]*\]", "", pattern)
+
+    return pattern.startswith("^") and "|" not in pattern
+
+
+@functools.lru_cache()
+def _get_line_matcher(patterns):
+    """ returns a function telling if a line matches any of patterns (compiled).
+
+        Patterns anchored at the beginning of lines are compiled in one alternation per set of flags, tried only at
+        the beginning. Others are searched one by one: an alternation of unanchored patterns is slower, as re does
+        not scan for the literal prefix of each pattern anymore """
+
+    anchored = defaultdict(list)  # flags -> patterns
+    unanchored = []
+
+    for pattern in patterns:
+        if _is_anchored(pattern.pattern):
+            anchored[pattern.flags].append(pattern.pattern)
+        else:
+            unanchored.append(pattern)
+
+    alternations = [
+        re.compile("|".join(f"(?:{pattern})" for pattern in group), flags) for flags, group in anchored.items()
+    ]
+
+    if len(unanchored) == 0 and len(alternations) == 1:
+        return alternations[0].match
+
+    return lambda line: any(alternation.match(line) for alternation in alternations) or any(
+        pattern.search(line) for pattern in unanchored
+    )
 
 
 class _StdoutLogsInterfaceValidator(_LogsInterfaceValidator):
@@ -19,9 +19,9 @@ class OpenTelemetryInterfaceValidator(ProxyBasedInterfaceValidator):
         super().__init__("open_telemetry")
         self.ready = threading.Event()
 
-    def ingest_file(self, src_path):
+    def ingest_data(self, data):
         self.ready.set()
-        return super().ingest_file(src_path)
+        return super().ingest_data(data)
 
     def get_otel_trace_id(self, request):
         paths = ["/api/v0.2/traces", "/v1/traces"]
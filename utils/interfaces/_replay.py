@@ -0,0 +1,120 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Load messages of an interface from logs, in replay mode.
+
+Records (or files) are parsed and deserialized in a process pool, by chunks: a segment of the capture store, or a
+batch of files. Chunks are returned in order, so messages come out in the same order as a sequential read.
+orjson is used to parse records if it's installed.
+
+Usage:
+    PYTHONPATH=. python utils/interfaces/_replay.py logs/interfaces/library
+        => benchmark against a sequential load
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import sys
+import time
+
+from utils.proxy._deserializer import materialize
+from utils.proxy.capture_store import CaptureReader, iter_segment_payloads
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+# below this, the pool costs more than it saves
+MIN_PARALLEL_SIZE = 4 * 1024 * 1024
+FILES_PER_CHUNK = 200
+
+
+def _load_segment(path, interface):
+    with open(path, "rb") as f:
+        content = f.read()
+
+    result = []
+    for payload in iter_segment_payloads(content):
+        data = _loads(payload)
+        materialize(data, interface)
+        result.append(data)
+
+    return result
+
+
+def _load_files(paths, interface):
+    result = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = _loads(f.read())
+
+        materialize(data, interface)
+        result.append(data)
+
+    return result
+
+
+def _get_chunks(log_folder, capture_folder):
+    """ returns (function, paths) to load, and the total size """
+
+    reader = CaptureReader(capture_folder)
+    if reader.exists():
+        paths = [os.path.join(capture_folder, name) for name in reader.get_segments()]
+        return [(_load_segment, path) for path in paths], sum(os.path.getsize(path) for path in paths)
+
+    # logs produced before the capture store: one file per message
+    paths = [os.path.join(log_folder, name) for name in sorted(os.listdir(log_folder))]
+    paths = [path for path in paths if os.path.isfile(path)]
+    chunks = [paths[i : i + FILES_PER_CHUNK] for i in range(0, len(paths), FILES_PER_CHUNK)]
+
+    return [(_load_files, chunk) for chunk in chunks], sum(os.path.getsize(path) for path in paths)
+
+
+def load_messages(log_folder, capture_folder, interface, max_workers=None):
+    """ yields deserialized messages of an interface, in capture order """
+
+    chunks, size = _get_chunks(log_folder, capture_folder)
+
+    if max_workers is None:
+        max_workers = int(os.environ.get("SYSTEM_TESTS_REPLAY_WORKERS", os.cpu_count() or 1))
+
+    if len(chunks) < 2 or size < MIN_PARALLEL_SIZE or max_workers < 2:
+        for function, paths in chunks:
+            yield from function(paths, interface)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+        futures = [executor.submit(function, paths, interface) for function, paths in chunks]
+        for future in futures:
+            yield from future.result()
+
+
+def _main():
+    for log_folder in sys.argv[1:]:
+        capture_folder = os.path.join(log_folder, "capture")
+        interface = os.path.basename(os.path.normpath(log_folder))
+
+        start = time.time()
+        sequential = list(load_messages(log_folder, capture_folder, interface, max_workers=1))
+        sequential_time = time.time() - start
+
+        start = time.time()
+        parallel = list(load_messages(log_folder, capture_folder, interface))
+        parallel_time = time.time() - start
+
+        assert [data["log_filename"] for data in sequential] == [data["log_filename"] for data in parallel]
+
+        print(
+            f"{log_folder}: {len(parallel)} messages, sequential: {sequential_time:.2f}s, "
+            f"parallel: {parallel_time:.2f}s, parser: {_loads.__module__}"
+        )
+
+
+if __name__ == "__main__":
+    _main()
@@ -3,26 +3,54 @@
 # Copyright 2021 Datadog, Inc.
 
 """
+Payloads made of plain JSON types are first checked by a code-generated validator (fastjsonschema). Its formats are
+checked by the format checker of jsonschema, so both accept the same payloads. Other payloads (tuples, bytes, compact
+spans...) are only checked by jsonschema, as fastjsonschema accepts any sequence as an array. jsonschema is used to
+report errors, so error messages (and allowed_errors patterns) are the same with or without the fast path.
+Results are cached per schema and payload, and large batches are validated in a process pool.
+
 Usage:
     PYTHONPATH=. python utils/interfaces/_schemas_validators.py
 """
 
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import itertools
 import os
 import json
 import re
 import functools
 
+import fastjsonschema
 from jsonschema import Draft7Validator, RefResolver
 from jsonschema.validators import extend
 
 from utils.tools import logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# below this, the pool costs more than it saves
+MIN_PARALLEL_MESSAGES = 500
+
+# types validated the same way by fastjsonschema and jsonschema
+_PLAIN_JSON_TYPES = (dict, list, str, int, float, bool, type(None))
+
 
 def _is_bytes_or_string(_checker, instance):
     return Draft7Validator.TYPE_CHECKER.is_type(instance, "string") or isinstance(instance, bytes)
 
 
-_type_checker = Draft7Validator.TYPE_CHECKER.redefine("string", _is_bytes_or_string)
+def _is_mapping(_checker, instance):
+    # compact spans are mappings, not dicts
+    return isinstance(instance, Mapping)
+
+
+_type_checker = Draft7Validator.TYPE_CHECKER.redefine_many({"string": _is_bytes_or_string, "object": _is_mapping})
 _ApiObjectValidator = extend(Draft7Validator, type_checker=_type_checker)
 
 
@@ -70,6 +98,105 @@ def _get_schema_validator(schema_id):
     return _ApiObjectValidator(schema, resolver=resolver, format_checker=Draft7Validator.FORMAT_CHECKER)
 
 
+def _get_format_checks():
+    """ format -> check, for all formats known by jsonschema or fastjsonschema, as checked by jsonschema """
+
+    format_checker = Draft7Validator.FORMAT_CHECKER
+    formats = set(format_checker.checkers) | set(fastjsonschema.draft07.CodeGeneratorDraft07.FORMAT_REGEXS) | {"regex"}
+
+    # formats unknown by jsonschema conform
+    return {name: functools.partial(format_checker.conforms, format=name) for name in formats}
+
+
+@functools.lru_cache()
+def _get_compiled_validator(schema_id):
+    """ returns a code-generated validator, or None if fastjsonschema can't compile the schema """
+
+    store = _get_schemas_store()
+
+    if schema_id not in store:
+        return None
+
+    try:
+        # refs are ids of the store, without scheme
+        return fastjsonschema.compile(
+            store[schema_id], handlers={"": store.__getitem__}, formats=_get_format_checks(), use_default=False
+        )
+    except fastjsonschema.JsonSchemaDefinitionException as e:
+        logger.debug(f"Can't compile {schema_id}, jsonschema will be used: {e}")
+        return None
+
+
+def _is_plain_json(content):
+    """ True if content is only made of dicts, lists, strings, numbers, booleans and None """
+
+    stack = [content]
+
+    while stack:
+        item = stack.pop()
+        item_type = type(item)  # exact types: subclasses and other mappings or sequences are not plain
+
+        if item_type not in _PLAIN_JSON_TYPES:
+            return False
+
+        if item_type is dict:
+            if not all(isinstance(key, str) for key in item):
+                return False
+            stack.extend(item.values())
+        elif item_type is list:
+            stack.extend(item)
+
+    return True
+
+
+def _get_errors(schema_id, content):
+    """ returns error messages of content """
+
+    compiled_validator = _get_compiled_validator(schema_id) if _is_plain_json(content) else None
+    if compiled_validator is not None:
+        try:
+            compiled_validator(content)
+            return []
+        except Exception:  # pylint: disable=broad-except
+            pass  # it stops on the first error: let jsonschema report errors
+
+    validator = _get_schema_validator(schema_id)
+
+    return [
+        f"{error.message} on instance " + "".join([f"[{repr(i)}]" for i in error.path])
+        for error in validator.iter_errors(content)
+    ]
+
+
+def _get_errors_chunk(items):
+    return [_get_errors(schema_id, content) for schema_id, content in items]
+
+
+def _json_default(o):
+    if isinstance(o, Mapping):
+        return dict(o)
+
+    return str(o)
+
+
+def _get_content_hash(content):
+    """ returns a hash of content, or None if it can't be serialized """
+
+    try:
+        if orjson is not None:
+            serialized = orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+        else:
+            serialized = json.dumps(content, default=_json_default).encode("utf-8")
+    except (TypeError, ValueError):
+        return None
+
+    return hashlib.sha1(serialized).digest()
+
+
+# (schema id, content hash) -> error messages, before allowed_errors are applied
+_errors_cache = {}
+
+
 class SchemaValidator:
     def __init__(self, interface, allowed_errors=None):
         self.interface = interface
@@ -78,24 +205,75 @@ class SchemaValidator:
         for pattern in allowed_errors or []:
             self.allowed_errors.append(re.compile(pattern))
 
-    def __call__(self, data):
+    def _get_schema_id(self, data):
         path = "/" if data["path"] == "" else data["path"]
-        schema_id = f"/{self.interface}{path}-request.json"
+        return f"/{self.interface}{path}-request.json"
 
-        validator = _get_schema_validator(schema_id)
-        if not validator.is_valid(data["request"]["content"]):
-            messages = []
+    def __call__(self, data):
+        self.validate_all([data], max_workers=1)
 
-            for error in validator.iter_errors(data["request"]["content"]):
-                message = f"{error.message} on instance " + "".join([f"[{repr(i)}]" for i in error.path])
-                if not any(pattern.fullmatch(message) for pattern in self.allowed_errors):
-                    messages.append(message)
+    def validate_all(self, data_list, max_workers=None):
+        """ validates all messages, in order, and raises on the first invalid one """
 
-            if len(messages) != 0:
-                for message in messages:
-                    logger.error(f"* {message}")
+        for data, errors in self._iter_errors(list(data_list), max_workers):
+            self._check(data, errors)
 
-                raise ValueError(f"Schema is invalid in {data['log_filename']}")
+    def _iter_errors(self, data_list, max_workers):
+        """ yields (data, error messages), errors are computed once per schema and payload """
+
+        items = []  # (data, cache key, True if errors must be computed)
+        missing = []  # (schema id, content) to compute
+        seen = set()
+
+        for data in data_list:
+            schema_id = self._get_schema_id(data)
+            content = data["request"]["content"]
+            content_hash = _get_content_hash(content)
+            key = None if content_hash is None else (schema_id, content_hash)
+
+            compute = key is None or (key not in _errors_cache and key not in seen)
+            if compute:
+                missing.append((schema_id, content))
+                seen.add(key)
+
+            items.append((data, key, compute))
+
+        if max_workers is None:
+            max_workers = int(os.environ.get("SYSTEM_TESTS_SCHEMA_WORKERS", os.cpu_count() or 1))
+
+        if len(missing) < MIN_PARALLEL_MESSAGES or max_workers < 2:
+            yield from self._merge_errors(items, (_get_errors(schema_id, content) for schema_id, content in missing))
+            return
+
+        chunk_size = max(1, len(missing) // (max_workers * 4))
+        chunks = [missing[i : i + chunk_size] for i in range(0, len(missing), chunk_size)]
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = itertools.chain.from_iterable(executor.map(_get_errors_chunk, chunks))
+            yield from self._merge_errors(items, results)
+
+    @staticmethod
+    def _merge_errors(items, results):
+        for data, key, compute in items:
+            if compute:
+                errors = next(results)
+                if key is not None:
+                    _errors_cache[key] = errors
+            else:
+                errors = _errors_cache[key]
+
+            yield data, errors
+
+    def _check(self, data, errors):
+        messages = [
+            message for message in errors if not any(pattern.fullmatch(message) for pattern in self.allowed_errors)
+        ]
+
+        if len(messages) != 0:
+            for message in messages:
+                logger.error(f"* {message}")
+
+            raise ValueError(f"Schema is invalid in {data['log_filename']}")
 
         logger.debug(f"{data['log_filename']} schema validation ok")
 
@@ -105,12 +283,15 @@ def _main():
         validator = SchemaValidator(interface)
         path = f"logs/interfaces/{interface}"
         files = [file for file in os.listdir(path) if os.path.isfile(os.path.join(path, file))]
+        data_list = []
         for file in files:
             with open(os.path.join(path, file), encoding="utf-8") as f:
                 data = json.load(f)
 
             if "request" in data and data["request"]["length"] != 0:
-                validator(data)
+                data_list.append(data)
+
+        validator.validate_all(data_list)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,119 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Index of spans by request id, built lazily, on the first lookup after messages are ingested """
+
+from collections import defaultdict
+import threading
+
+from utils.interfaces._core import get_message_key
+from utils.tools import get_rid_from_span, logger
+
+
+class RidSpanIndex:
+    """ rid -> [(data, context, span)], in the order of messages, then in the order of spans inside a message.
+
+        materialize(data) deserializes the message, and raises a ValueError if it's not possible.
+        iter_spans(data) yields (context, span) for each span of a message, context being what contains the span
+        (the trace for the library, the payload and chunk for the agent...)
+
+        add() only queues the message, it's deserialized and indexed by the next update(), called by get(), so
+        ingesting a message stays cheap. Listeners are called with (rid, span) for each indexed span, in the thread
+        calling update()
+    """
+
+    def __init__(self, materialize, iter_spans):
+        self._materialize = materialize
+        self._iter_spans = iter_spans
+
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()  # one update at a time, lookups wait for the one running
+        self._pending = []  # messages not indexed yet
+        self._entries = defaultdict(list)  # rid -> [(message key, position, data, context, span)]
+        self._unsorted_rids = set()
+        self._errors = []  # messages that can't be deserialized or walked
+        self._listeners = []
+
+    @property
+    def has_listeners(self):
+        return len(self._listeners) != 0
+
+    def add(self, data):
+        with self._lock:
+            self._pending.append(data)
+
+    def update(self):
+        """ index messages added since the last update """
+
+        with self._update_lock:
+            self._index_pending()
+
+    def _index_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        for data in pending:
+            self._index(data)
+
+    def _index(self, data):
+        key = get_message_key(data)
+
+        try:
+            self._materialize(data)
+            spans = [(context, span, get_rid_from_span(span)) for context, span in self._iter_spans(data)]
+        except Exception:
+            # the error will be raised when the index is read, as if messages were read
+            logger.debug(f"{data['log_filename']} can't be indexed")
+            with self._lock:
+                self._errors.append(data)
+            return
+
+        with self._lock:
+            for position, (context, span, rid) in enumerate(spans):
+                if rid is None:
+                    continue
+
+                entries = self._entries[rid]
+                if len(entries) != 0 and (entries[-1][0], entries[-1][1]) > (key, position):
+                    self._unsorted_rids.add(rid)  # message ingested out of order
+
+                entries.append((key, position, data, context, span))
+
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            for _, span, rid in spans:
+                if rid is not None:
+                    listener(rid, span)
+
+    def add_listener(self, listener):
+        """ listener is also called for spans already added """
+
+        with self._update_lock:
+            self._index_pending()
+
+            with self._lock:
+                self._listeners.append(listener)
+                spans = [(rid, entry[4]) for rid, entries in self._entries.items() for entry in entries]
+
+        for rid, span in spans:
+            listener(rid, span)
+
+    def get(self, rid):
+        self.update()
+
+        with self._lock:
+            errors = list(self._errors)
+
+            if rid in self._unsorted_rids:
+                self._entries[rid].sort(key=lambda entry: (entry[0], entry[1]))
+                self._unsorted_rids.discard(rid)
+
+            entries = list(self._entries.get(rid, []))
+
+        for data in errors:
+            self._materialize(data)
+            list(self._iter_spans(data))
+
+        return [(data, context, span) for _, _, data, context, span in entries]
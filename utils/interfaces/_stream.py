@@ -0,0 +1,99 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Subscriber of the proxy push channel: messages are ingested by interfaces as soon as the proxy captures them """
+
+import socket
+import threading
+import time
+
+from utils.proxy.capture_store import decode_record
+from utils.proxy.stats import get_proxy_stats
+from utils.proxy.stream import HELLO_INTERFACE, STREAM_PORT, read_frame
+from utils.tools import logger
+
+
+class ProxyStreamSubscriber:
+    def __init__(self, interfaces, host="127.0.0.1", port=STREAM_PORT, retry_interval=0.5):
+        self.interfaces = {interface.name: interface for interface in interfaces}
+        self.host = host
+        self.port = port
+        self.retry_interval = retry_interval
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="proxy-stream-subscriber", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def catch_up(self):
+        """ Ingest messages of the capture store that the stream did not push (not connected, or late) """
+
+        for interface in self.interfaces.values():
+            interface.ingest_capture()
+
+    def wait_for_flush(self, timeout=10):
+        """ Wait until all messages captured by the proxy are ingested by subscribed interfaces.
+            Returns False if it's not the case after timeout, or if proxy stats are not available.
+            In any case, messages already in the capture store are ingested """
+
+        try:
+            return self._wait_for_flush(timeout)
+        finally:
+            self.catch_up()
+
+    def _wait_for_flush(self, timeout):
+        start = time.time()
+
+        while True:
+            stats = get_proxy_stats(self.host)
+            if stats is None:
+                logger.debug("Proxy stats are not available, can't check that all messages are ingested")
+                return False
+
+            missing = {
+                name: stats["interfaces"].get(name, {}).get("messages", 0) - interface.get_message_count()
+                for name, interface in self.interfaces.items()
+            }
+
+            if stats["pipeline"]["backlog"] == 0 and all(count <= 0 for count in missing.values()):
+                logger.debug(f"All proxy messages are ingested, after {time.time() - start:.2f}s")
+                return True
+
+            if time.time() - start > timeout:
+                logger.error(f"Proxy messages are missing after {timeout}s: {missing}, {stats['pipeline']}")
+                return False
+
+            if stats["pipeline"]["backlog"] == 0:
+                # everything is written in the capture store, but not pushed by the stream
+                self.catch_up()
+
+            time.sleep(0.05)
+
+    def _run(self):
+        # the proxy may not be started yet, or restarted: keep trying to connect
+        while not self._stopped.is_set():
+            try:
+                with socket.create_connection((self.host, self.port)) as sock:
+                    self._consume(sock)
+            except (ConnectionError, OSError) as e:
+                logger.debug(f"Proxy stream is not available: {e}")
+
+            self._stopped.wait(self.retry_interval)
+
+    def _consume(self, sock):
+        while not self._stopped.is_set():
+            interface_name, payload = read_frame(sock)
+
+            if interface_name == HELLO_INTERFACE:
+                # we are now registered, anything captured before is in the capture store
+                logger.debug("Connected to the proxy stream")
+                for interface in self.interfaces.values():
+                    interface.ingest_capture()
+
+            elif interface_name in self.interfaces:
+                self.interfaces[interface_name].ingest_data(decode_record(payload))
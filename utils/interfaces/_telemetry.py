@@ -0,0 +1,195 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Telemetry helpers shared by library and agent interfaces """
+
+from collections import defaultdict
+import threading
+
+from utils.interfaces._core import get_message_key
+from utils.tools import logger
+
+
+def get_batch_item_view(data, batch_payload):
+    """ data, as if batch_payload had been sent on its own. Only dicts on the way to request.content are copied,
+        everything else (headers, response, payloads...) is shared with data """
+
+    content = dict(data["request"]["content"])
+    content["request_type"] = batch_payload.get("request_type")
+    content["payload"] = batch_payload.get("payload")
+
+    request = dict(data["request"])
+    request["content"] = content
+
+    view = dict(data)
+    view["request"] = request
+
+    return view
+
+
+def get_telemetry_request_types(data, materialize):
+    """ request types of a telemetry message, including the ones inside a batch. None if it can't be read """
+
+    for name, value in data["request"].get("headers", []):
+        if name.lower() == "dd-telemetry-request-type" and value != "message-batch":
+            return [value]  # no need to deserialize the message
+
+    try:
+        content = materialize(data)["request"]["content"]
+    except ValueError:
+        return None
+
+    if not isinstance(content, dict):
+        return None
+
+    if content.get("request_type") == "message-batch":
+        return [payload.get("request_type") for payload in content.get("payload", [])]
+
+    return [content.get("request_type")]
+
+
+def get_telemetry_batch_items(data_list):
+    """ returns [(data, batch_payload)], batch_payload being None for messages that are not a message-batch """
+
+    result = []
+
+    for data in data_list:
+        content = data["request"]["content"]
+        if content.get("request_type") == "message-batch":
+            result.extend((data, batch_payload) for batch_payload in content["payload"])
+        else:
+            result.append((data, None))
+
+    return result
+
+
+def get_batch_item_views(batch_items):
+    """ views are built on each call, so replacing a key of a view does not affect the views of other callers """
+
+    for data, batch_payload in batch_items:
+        yield data if batch_payload is None else get_batch_item_view(data, batch_payload)
+
+
+def flatten_telemetry_batches(data_list):
+    """ returns telemetry messages, each payload of a message-batch being returned as a message """
+    return list(get_batch_item_views(get_telemetry_batch_items(data_list)))
+
+
+class TelemetryIndex:
+    """ Telemetry messages indexed lazily, on the first lookup after they are ingested, batches being flattened:
+
+        * (namespace, metric) -> series of generate-metrics messages. The namespace of a series falls back on the one
+          of its payload, it is set in series["_computed_namespace"]
+        * request_type -> messages
+        * seq_id of messages successfully received, except onboarding events
+
+        materialize(data) deserializes the message, and raises a ValueError if it's not possible.
+    """
+
+    def __init__(self, materialize):
+        self._materialize = materialize
+
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()  # one update at a time, lookups wait for the one running
+        self._pending = []  # messages not indexed yet
+        # lists of (message key, position, item), sorted when they are read
+        self._series = defaultdict(list)
+        self._messages = defaultdict(list)
+        self._seq_ids = []
+        self._unsorted = set()  # ids of lists with messages ingested out of order
+        self._errors = []  # messages that can't be deserialized or walked
+
+    def add(self, data):
+        with self._lock:
+            self._pending.append(data)
+
+    def update(self):
+        """ index messages added since the last update """
+
+        with self._update_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+
+            for data in pending:
+                self._index(data)
+
+    def _index(self, data):
+        key = get_message_key(data)
+
+        try:
+            entries = self._get_entries(data)
+        except Exception:
+            # the error will be raised when the index is read, as if messages were read
+            logger.debug(f"{data['log_filename']} can't be indexed")
+            with self._lock:
+                self._errors.append(data)
+            return
+
+        with self._lock:
+            for entry_list, position, item in entries:
+                if len(entry_list) != 0 and (entry_list[-1][0], entry_list[-1][1]) > (key, position):
+                    self._unsorted.add(id(entry_list))
+
+                entry_list.append((key, position, item))
+
+    def _get_entries(self, data):
+        """ returns [(list, position, item)] to add in the index, without touching it """
+
+        content = self._materialize(data)["request"]["content"]
+        result = []
+
+        response = data.get("response") or {}
+        if content.get("request_type") != "apm-onboarding-event" and 200 <= response.get("status_code", 0) < 300:
+            result.append((self._seq_ids, 0, (content.get("seq_id"), data["log_filename"])))
+
+        for position, message in enumerate(flatten_telemetry_batches([data])):
+            content = message["request"]["content"]
+            result.append((self._messages[content.get("request_type")], position, message))
+
+            if content.get("request_type") != "generate-metrics":
+                continue
+
+            fallback_namespace = content["payload"].get("namespace")
+            for series in content["payload"]["series"]:
+                # Inject here the computed namespace considering the fallback. This simplifies later assertions.
+                series["_computed_namespace"] = series.get("namespace", fallback_namespace)
+                result.append((self._series[(series["_computed_namespace"], series["metric"])], position, series))
+
+        return result
+
+    def _get(self, get_entry_list):
+        self.update()
+
+        with self._lock:
+            entry_list = get_entry_list()
+
+            errors = list(self._errors)
+
+            if id(entry_list) in self._unsorted:
+                entry_list.sort(key=lambda entry: (entry[0], entry[1]))
+                self._unsorted.discard(id(entry_list))
+
+            items = [item for _, _, item in entry_list]
+
+        for data in errors:
+            self._get_entries(data)
+
+        return items
+
+    def get_metric_series(self, namespace, metric):
+        return self._get(lambda: self._series.get((namespace, metric), []))
+
+    def get_messages(self, request_type):
+        return self._get(lambda: self._messages.get(request_type, []))
+
+    def get_seq_ids(self):
+        """ returns [(seq_id, log_filename)] sorted by seq_id """
+
+        seq_ids = self._get(lambda: self._seq_ids)
+
+        for seq_id, log_filename in seq_ids:
+            if seq_id is None:
+                raise ValueError(f"{log_filename} has no seq_id")
+
+        return sorted(seq_ids)
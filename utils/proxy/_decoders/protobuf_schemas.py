@@ -2,17 +2,18 @@
 # This product includes software developed at Datadog (https://www.datadoghq.com/).
 # Copyright 2021 Datadog, Inc.
 
+import logging
+from pathlib import Path
+
 from google.protobuf.descriptor_pb2 import FileDescriptorSet
 from google.protobuf.message_factory import GetMessages
 
-from pathlib import Path
-
 
 with open(Path(__file__).parent / "agent.descriptor", "rb") as f:
     _fds = FileDescriptorSet.FromString(f.read())
 _messages = GetMessages([file for file in _fds.file])
 
-print(f"Message types present in protobuf descriptors: {_messages.keys()}")
+logging.getLogger(__name__).debug(f"Message types present in protobuf descriptors: {_messages.keys()}")
 
 TracePayload = _messages["datadog.trace.AgentPayload"]
 MetricPayload = _messages["datadog.agentpayload.MetricPayload"]
@@ -3,9 +3,12 @@
 # Copyright 2021 Datadog, Inc.
 
 import base64
+from collections.abc import MutableMapping
 import gzip
 import json
 import logging
+import os
+import sys
 import traceback
 
 import msgpack
@@ -23,11 +26,25 @@ from opentelemetry.proto.collector.logs.v1.logs_service_pb2 import (
     ExportLogsServiceRequest,
     ExportLogsServiceResponse,
 )
-from _decoders.protobuf_schemas import MetricPayload, TracePayload
+
+try:
+    from _decoders.protobuf_schemas import MetricPayload, TracePayload
+    from capture_policy import HEADERS_ONLY, RAW_ONLY
+    from capture_store import decode_body
+    from scrubber import scrubber
+except ModuleNotFoundError:
+    # messages are deserialized by the test runner, when they are read
+    from utils.proxy._decoders.protobuf_schemas import MetricPayload, TracePayload
+    from utils.proxy.capture_policy import HEADERS_ONLY, RAW_ONLY
+    from utils.proxy.capture_store import decode_body
+    from utils.proxy.scrubber import scrubber
 
 
 logger = logging.getLogger(__name__)
 
+# v0.5 spans are decoded as CompactSpan, rather than dicts
+COMPACT_SPANS = os.environ.get("SYSTEM_TESTS_COMPACT_SPANS") == "true"
+
 
 def get_header_value(name, headers):
     return next((h[1] for h in headers if h[0].lower() == name.lower()), None)
@@ -48,33 +65,67 @@ def _parse_as_unsigned_int(value, size_in_bits):
     return value if value >= 0 else (-value ^ (2 ** size_in_bits - 1)) + 1
 
 
-def _decode_unsigned_int_traces(content):
-    for span in (span for trace in content for span in trace):
-        for sub_key in ("trace_id", "parent_id", "span_id"):
-            if sub_key in span:
-                span[sub_key] = _parse_as_unsigned_int(span[sub_key], 64)
+_UNSIGNED_INT_KEYS = ("trace_id", "parent_id", "span_id")
+_JSON_META_KEYS = ("_dd.appsec.json", "_dd.iast.json")
+
+
+def _decode_v_0_4_traces(content):
+    # one pass on each span, rather than one walk of the entire payload per decoding step
+    for trace in content:
+        for span in trace:
+            for sub_key in _UNSIGNED_INT_KEYS:
+                if sub_key in span:
+                    span[sub_key] = _parse_as_unsigned_int(span[sub_key], 64)
+
+            # json meta values may be non-ASCII bytes, they are parsed before remaining bytes are converted
+            _deserialize_meta(span)
+            _convert_bytes_values(span, "[][]")
+
+    return content
+
+
+def _decode_string_table(strings):
+    """ v0.5 string table entries are decoded once, and interned: spans reference them instead of copying them """
+
+    result = []
+    for i, value in enumerate(strings):
+        if isinstance(value, bytes):
+            try:
+                value = value.decode("ascii")
+            except UnicodeDecodeError as e:
+                raise ValueError(f"Error decoding string table entry {i}") from e
+
+        result.append(sys.intern(value) if isinstance(value, str) else value)
+
+    return result
 
 
 def _decode_v_0_5_traces(content):
     # https://github.com/DataDog/architecture/blob/master/rfcs/apm/agent/v0.5-endpoint/rfc.md
     strings, payload = content
+    strings = _decode_string_table(strings)
 
     result = []
     for spans in payload:
         decoded_spans = []
         result.append(decoded_spans)
         for span in spans:
+            meta = {}
+            for key, value in span[9].items():
+                key = strings[int(key)]
+                meta[key] = _deserialize_meta_value(key, strings[int(value)])
+
             decoded_span = {
                 "service": strings[int(span[0])],
                 "name": strings[int(span[1])],
                 "resource": strings[int(span[2])],
-                "trace_id": span[3],
-                "span_id": span[4],
-                "parent_id": span[5] if span[5] != 0 else None,
+                "trace_id": _parse_as_unsigned_int(span[3], 64),
+                "span_id": _parse_as_unsigned_int(span[4], 64),
+                "parent_id": _parse_as_unsigned_int(span[5], 64) if span[5] != 0 else None,
                 "start": span[6],
                 "duration": span[7] if span[7] != 0 else None,
                 "error": span[8],
-                "meta": {strings[int(key)]: strings[int(value)] for key, value in span[9].items()},
+                "meta": meta,
                 "metrics": {strings[int(key)]: value for key, value in span[10].items()},
                 "type": strings[int(span[11])],
             }
@@ -84,11 +135,137 @@ def _decode_v_0_5_traces(content):
     return result
 
 
+def _flatten_pairs(pairs):
+    return tuple(item for pair in pairs for item in pair)
+
+
+def _decode_v_0_5_compact_traces(content):
+    # meta and metrics are the only maps of v0.5 payloads, they are unpacked as flat tuples (key, value, key, value...)
+    strings, payload = msgpack.unpackb(
+        content, unicode_errors="replace", strict_map_key=False, object_pairs_hook=_flatten_pairs
+    )
+    strings = _decode_string_table(strings)
+
+    return [[CompactSpan(span, strings) for span in spans] for spans in payload]
+
+
+_DELETED = object()
+
+
+class CompactSpan(MutableMapping):
+    """ v0.5 span, backed by its msgpack array and the string table of its payload. Fields are decoded when they
+        are read, meta and metrics are materialized on first access, from flat tuples. Changes are kept aside """
+
+    __slots__ = ("_raw", "_strings", "_meta", "_metrics", "_changes")
+
+    _FIELDS = (
+        "service",
+        "name",
+        "resource",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "start",
+        "duration",
+        "error",
+        "meta",
+        "metrics",
+        "type",
+    )
+    _INDEXES = dict(zip(_FIELDS, range(len(_FIELDS))))
+
+    def __init__(self, raw, strings):
+        self._raw = raw
+        self._strings = strings
+        self._meta = None
+        self._metrics = None
+        self._changes = None
+
+    def _get_field(self, index):
+        raw, strings = self._raw, self._strings
+
+        if index in (0, 1, 2, 11):
+            return strings[int(raw[index])]
+
+        if index in (3, 4):
+            return _parse_as_unsigned_int(raw[index], 64)
+
+        if index == 5:
+            return _parse_as_unsigned_int(raw[5], 64) if raw[5] != 0 else None
+
+        if index == 7:
+            return raw[7] if raw[7] != 0 else None
+
+        if index == 9:
+            if self._meta is None:
+                meta = {}
+                items = iter(raw[9])
+                for key, value in zip(items, items):
+                    key = strings[int(key)]
+                    meta[key] = _deserialize_meta_value(key, strings[int(value)])
+                self._meta = meta
+                raw[9] = None
+
+            return self._meta
+
+        if index == 10:
+            if self._metrics is None:
+                items = iter(raw[10])
+                self._metrics = {strings[int(key)]: value for key, value in zip(items, items)}
+                raw[10] = None
+
+            return self._metrics
+
+        return raw[index]
+
+    def __getitem__(self, key):
+        if self._changes is not None and key in self._changes:
+            value = self._changes[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+
+        if key not in self._INDEXES:
+            raise KeyError(key)
+
+        return self._get_field(self._INDEXES[key])
+
+    def __setitem__(self, key, value):
+        if self._changes is None:
+            self._changes = {}
+
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        self[key] = _DELETED
+
+    def __iter__(self):
+        changes = self._changes or {}
+
+        for key in self._FIELDS:
+            if changes.get(key) is not _DELETED:
+                yield key
+
+        for key, value in changes.items():
+            if key not in self._INDEXES and value is not _DELETED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 def deserialize_dd_appsec_s_meta(payload):
     """ meta value for _dd.appsec.s.<address> are b64 - gzip - json encoded strings """
 
     try:
-        return json.loads(gzip.decompress(base64.b64decode(payload)).decode())
+        # raw bodies are already scrubbed, but here the encoding may hide secrets
+        return json.loads(scrubber.scrub_str(gzip.decompress(base64.b64decode(payload)).decode()))
     except Exception:
         # b64/gzip is optional
         return json.loads(payload)
@@ -123,17 +300,16 @@ def deserialize_http_message(path, message, content: bytes, interface, key):
                 return content
 
     if content_type in ("application/msgpack", "application/msgpack, application/msgpack"):
+        if interface == "library" and path == "/v0.5/traces" and COMPACT_SPANS:
+            return _decode_v_0_5_compact_traces(content)
+
         result = msgpack.unpackb(content, unicode_errors="replace", strict_map_key=False)
 
-        if interface == "library":
-            if path == "/v0.4/traces":
-                _decode_unsigned_int_traces(result)
-                _deserialized_nested_json_from_trace_payloads(result, interface)
+        if interface == "library" and path == "/v0.4/traces":
+            return _decode_v_0_4_traces(result)
 
-            elif path == "/v0.5/traces":
-                result = _decode_v_0_5_traces(result)
-                _decode_unsigned_int_traces(result)
-                _deserialized_nested_json_from_trace_payloads(result, interface)
+        if interface == "library" and path == "/v0.5/traces":
+            return _decode_v_0_5_traces(result)
 
         _convert_bytes_values(result)
 
@@ -202,13 +378,18 @@ def _deserialize_meta(span):
 
     meta = span.get("meta", {})
 
-    keys = ("_dd.appsec.json", "_dd.iast.json")
-
     for key in list(meta):
-        if key.startswith("_dd.appsec.s."):
-            meta[key] = deserialize_dd_appsec_s_meta(meta[key])
-        elif key in keys:
-            meta[key] = json.loads(meta[key])
+        meta[key] = _deserialize_meta_value(key, meta[key])
+
+
+def _deserialize_meta_value(key, value):
+    if key.startswith("_dd.appsec.s."):
+        return deserialize_dd_appsec_s_meta(value)
+
+    if key in _JSON_META_KEYS:
+        return json.loads(value)
+
+    return value
 
 
 def _convert_bytes_values(item, path=""):
@@ -244,6 +425,26 @@ def deserialize(data, key, content, interface):
         data[key]["traceback"] = str(traceback.format_exc())
 
 
+def materialize(data, interface):
+    """ deserialize raw bodies kept by the proxy, if it's not already done """
+
+    policy = data.get("capture_policy")
+
+    for key in ("request", "response"):
+        message = data.get(key)
+        if message is None or "body" not in message:
+            continue
+
+        if policy == HEADERS_ONLY:
+            message["content"] = None
+        elif policy == RAW_ONLY:
+            message["content"] = decode_body(message)
+        else:
+            deserialize(data, key=key, content=decode_body(message), interface=interface)
+
+        del message["body"]
+
+
 # if __name__ == "__main__":
 #     content = json.load(open("logs/interfaces/library/005__v0.5_traces.json"))["request"]["content"]
 #     print(json.dumps(_decode_v_0_5_traces(content), indent=2))
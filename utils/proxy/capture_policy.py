@@ -0,0 +1,64 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" What the proxy keeps of each message. Messages are always forwarded, whatever the policy.
+
+Rules are set in the proxy state, and the first matching rule wins:
+
+    proxy_state={
+        "capture_policy": [
+            {"interface": "agent", "path": "/api/v2/profile", "policy": "headers-only"},
+            {"interface": "library", "path": "/profiling/.*", "policy": "drop"},
+        ]
+    }
+
+interface and path are optional, path is a regular expression that must match the entire path.
+
+This file is used by the proxy container (as a script) and by the test runner (as utils.proxy.capture_policy).
+"""
+
+import re
+
+
+FULL = "full"  # default: bodies are kept, and deserialized when they are read
+RAW_ONLY = "raw-only"  # bodies are kept, but never deserialized
+HEADERS_ONLY = "headers-only"  # bodies are not kept
+DROP = "drop"  # message is not captured
+
+POLICIES = (FULL, RAW_ONLY, HEADERS_ONLY, DROP)
+
+
+class CapturePolicy:
+    def __init__(self, rules=None):
+        self._rules = []
+
+        for rule in rules or []:
+            if rule.get("policy") not in POLICIES:
+                raise ValueError(f"Unknown capture policy in {rule}, must be one of {POLICIES}")
+
+            path = re.compile(rule["path"]) if "path" in rule else None
+            self._rules.append((rule.get("interface"), path, rule["policy"]))
+
+        # (interface, path) -> policy, paths are few and called often
+        self._cache = {}
+
+    def get(self, interface, path):
+        key = (interface, path)
+
+        if key not in self._cache:
+            self._cache[key] = self._get(interface, path)
+
+        return self._cache[key]
+
+    def _get(self, interface, path):
+        for rule_interface, rule_path, policy in self._rules:
+            if rule_interface is not None and rule_interface != interface:
+                continue
+
+            if rule_path is not None and not rule_path.fullmatch(path):
+                continue
+
+            return policy
+
+        return FULL
@@ -0,0 +1,247 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Append-only store used by the proxy to persist captured messages.
+
+Each interface has its own stream, made of segment files. A segment is a sequence of records, each record
+being a 4 bytes big-endian length followed by a compact JSON payload. Segments are rotated once they reach
+SEGMENT_MAX_SIZE, and a small index lists the segments with their first sequence number and record count.
+
+Request and response bodies are kept raw (base64) in records, with their content type, and only deserialized
+when they are read.
+
+This file is used by the proxy container (as a script) and by the test runner (as utils.proxy.capture_store). The
+store only depends on the standard library. The export command below also deserializes bodies with _deserializer,
+so it needs the dependencies of the proxy (msgpack, protobuf...).
+
+Usage:
+    python utils/proxy/capture_store.py logs/interfaces/library
+        => export the capture of the library interface to the historical one-file-per-message layout
+"""
+
+import base64
+from collections.abc import Mapping
+import functools
+import json
+import os
+import struct
+import sys
+
+
+SEGMENT_MAX_SIZE = 16 * 1024 * 1024
+CAPTURE_FOLDER_NAME = "capture"
+INDEX_FILENAME = "index.json"
+
+_LENGTH = struct.Struct(">I")
+
+
+class ObjectDumpEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, bytes):
+            return str(o)
+        if isinstance(o, Mapping):
+            return dict(o)
+        return json.JSONEncoder.default(self, o)
+
+
+def get_capture_folder(interface_folder):
+    return os.path.join(interface_folder, CAPTURE_FOLDER_NAME)
+
+
+def encode_record(data) -> bytes:
+    return json.dumps(data, separators=(",", ":"), cls=ObjectDumpEncoder).encode("utf-8")
+
+
+def decode_record(payload: bytes):
+    return json.loads(payload)
+
+
+def get_content_type(headers):
+    return next((v.lower() for k, v in headers if k.lower() == "content-type"), None)
+
+
+def encode_body(message, content: bytes):
+    """ keep the raw body in the record, with a descriptor of its content type """
+
+    message["content_type"] = get_content_type(message["headers"])
+    message["body"] = base64.b64encode(content).decode("ascii") if content else None
+
+
+def decode_body(message) -> bytes:
+    return base64.b64decode(message["body"]) if message["body"] else b""
+
+
+def _get_segment_name(index):
+    return f"{index:05d}.segment"
+
+
+def _open_shared(path, flags):
+    # files are read by the host, which may run with another user
+    return os.open(path, flags, 0o777)
+
+
+class CaptureWriter:
+    """ Single writer of one interface stream. Not thread-safe, the proxy writes from its event loop """
+
+    def __init__(self, folder, segment_max_size=SEGMENT_MAX_SIZE):
+        self.folder = folder
+        self.segment_max_size = segment_max_size
+
+        self._segments = []  # index entries
+        self._file = None
+        self._size = 0
+        self._seq = 0
+
+        os.makedirs(folder, exist_ok=True)
+
+    def append(self, payload: bytes):
+        if self._file is None or self._size >= self.segment_max_size:
+            self._rotate()
+
+        record = _LENGTH.pack(len(payload)) + payload
+
+        # one write per record, and flushed, so readers never see a record split in two writes
+        self._file.write(record)
+        self._file.flush()
+
+        self._size += len(record)
+        self._segments[-1]["count"] += 1
+        self._seq += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._write_index()
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+
+        name = _get_segment_name(len(self._segments))
+        self._segments.append({"segment": name, "first_seq": self._seq, "count": 0})
+        self._write_index()
+
+        path = os.path.join(self.folder, name)
+        self._file = open(path, "ab", opener=_open_shared)  # pylint: disable=consider-using-with
+        self._size = 0
+
+    def _write_index(self):
+        tmp_path = os.path.join(self.folder, f".{INDEX_FILENAME}.tmp")
+        with open(tmp_path, "w", encoding="utf-8", opener=_open_shared) as f:
+            json.dump(self._segments, f)
+
+        os.replace(tmp_path, os.path.join(self.folder, INDEX_FILENAME))
+
+
+class CaptureReader:
+    """ Read records of one interface stream, possibly while the proxy is still writing it """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+        self._segment_index = 0
+        self._offset = 0
+
+    def exists(self):
+        return os.path.isdir(self.folder)
+
+    def get_segments(self):
+        """ returns the names of all segments, ordered """
+
+        try:
+            with open(os.path.join(self.folder, INDEX_FILENAME), "r", encoding="utf-8") as f:
+                indexed = [entry["segment"] for entry in json.load(f)]
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            indexed = []
+
+        try:
+            # the index is only written at rotation time, the last segment may not be in it yet
+            on_disk = sorted(name for name in os.listdir(self.folder) if name.endswith(".segment"))
+        except FileNotFoundError:
+            on_disk = []
+
+        return on_disk if len(on_disk) >= len(indexed) else indexed
+
+    def __iter__(self):
+        for name in self.get_segments():
+            with open(os.path.join(self.folder, name), "rb") as f:
+                content = f.read()
+
+            for payload in _iter_payloads(content, 0):
+                yield decode_record(payload)
+
+    def read_new(self):
+        """ returns all records appended since the last call. Incomplete records are left for the next call """
+
+        result = []
+        segments = self.get_segments()
+
+        while self._segment_index < len(segments):
+            with open(os.path.join(self.folder, segments[self._segment_index]), "rb") as f:
+                f.seek(self._offset)
+                content = f.read()
+
+            consumed = 0
+            for payload in _iter_payloads(content, 0):
+                result.append(decode_record(payload))
+                consumed += _LENGTH.size + len(payload)
+
+            self._offset += consumed
+
+            if self._segment_index == len(segments) - 1:
+                break  # last segment, it may still grow
+
+            # the writer never comes back on a rotated segment
+            self._segment_index += 1
+            self._offset = 0
+
+        return result
+
+
+def iter_segment_payloads(content: bytes):
+    """ yields the payload of each complete record of a segment content """
+    yield from _iter_payloads(content, 0)
+
+
+def _iter_payloads(content, offset):
+    while offset + _LENGTH.size <= len(content):
+        (length,) = _LENGTH.unpack_from(content, offset)
+        end = offset + _LENGTH.size + length
+
+        if end > len(content):
+            return  # record is being written
+
+        yield content[offset + _LENGTH.size : end]
+        offset = end
+
+
+def export_to_files(interface_folder, materialize=None):
+    """ Export the capture of an interface to one indented JSON file per message, for humans.
+        materialize(data) is called on each message, to deserialize bodies """
+
+    count = 0
+    for data in CaptureReader(get_capture_folder(interface_folder)):
+        if materialize is not None:
+            materialize(data)
+
+        filename = os.path.join(interface_folder, os.path.basename(data["log_filename"]))
+        with open(filename, "w", encoding="utf-8", opener=_open_shared) as f:
+            json.dump(data, f, indent=2, cls=ObjectDumpEncoder)
+        count += 1
+
+    return count
+
+
+def _main():
+    from _deserializer import materialize
+
+    for folder in sys.argv[1:]:
+        interface = os.path.basename(os.path.normpath(folder))
+        count = export_to_files(folder, materialize=functools.partial(materialize, interface=interface))
+        print(f"{folder}: {count} messages exported")
+
+
+if __name__ == "__main__":
+    _main()
@@ -10,8 +10,11 @@ from mitmproxy.addons import errorcheck, default_addons
 from mitmproxy.flow import Error as FlowError, Flow
 
 import rc_debugger
+from capture_policy import CapturePolicy, DROP, FULL, HEADERS_ONLY
 from rc_mock import MOCKED_RESPONSES
-from _deserializer import deserialize
+from pipeline import MessagePipeline
+from stream import StreamPublisher, STREAM_PORT
+from stats import StatsServer, STATS_PORT
 
 # prevent permission issues on file created by the proxy when the host is linux
 os.umask(0)
@@ -23,29 +26,34 @@ handler.setFormatter(logging.Formatter("%(asctime)s.%(msecs)03d %(levelname)-8s
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
-SIMPLE_TYPES = (bool, int, float, type(None))
-
+# messages are saved by the pipeline, keep its logs
+pipeline_logger = logging.getLogger("pipeline")
+pipeline_logger.addHandler(handler)
+pipeline_logger.setLevel(logging.DEBUG)
 
 messages_counts = defaultdict(int)
 
+# the agent can be replaced, to run the proxy outside of docker (see utils/scripts/proxy_benchmark.py)
+AGENT_HOST = os.environ.get("SYSTEM_TESTS_PROXY_AGENT_HOST", "agent")
+AGENT_PORT = int(os.environ.get("SYSTEM_TESTS_PROXY_AGENT_PORT", "8127"))
 
-class ObjectDumpEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, bytes):
-            return str(o)
-        return json.JSONEncoder.default(self, o)
+_DEBUGGER_RC_CONFIGS = (
+    "DEBUGGER_PROBES_STATUS",
+    "DEBUGGER_LINE_PROBES_SNAPSHOT",
+    "DEBUGGER_METHOD_PROBES_SNAPSHOT",
+    "DEBUGGER_MIX_LOG_PROBE",
+    "DEBUGGER_PII_REDACTION",
+)
 
 
 class _RequestLogger:
-    def __init__(self) -> None:
-        self.dd_api_key = os.environ["DD_API_KEY"]
-        self.dd_application_key = os.environ.get("DD_APPLICATION_KEY")
-        self.dd_app_key = os.environ.get("DD_APP_KEY")
+    def __init__(self, publisher: StreamPublisher) -> None:
         self.state = json.loads(os.environ.get("PROXY_STATE", "{}"))
         self.host_log_folder = os.environ.get("SYSTEM_TESTS_HOST_LOG_FOLDER", "logs")
 
         # for config backend mock
         self.config_request_count = defaultdict(int)
+        self._rc_responses = {}  # (rc scenario, language, version) -> encoded response
 
         logger.debug(f"Proxy state: {self.state}")
 
@@ -55,26 +63,11 @@ class _RequestLogger:
 
         self.original_ports = {}
 
-    def _scrub(self, content):
-        if isinstance(content, str):
-            content = content.replace(self.dd_api_key, "{redacted-by-system-tests-proxy}")
-            if self.dd_app_key:
-                content = content.replace(self.dd_app_key, "{redacted-by-system-tests-proxy}")
-            if self.dd_application_key:
-                content = content.replace(self.dd_application_key, "{redacted-by-system-tests-proxy}")
-            return content
-
-        if isinstance(content, (list, set, tuple)):
-            return [self._scrub(item) for item in content]
-
-        if isinstance(content, dict):
-            return {key: self._scrub(value) for key, value in content.items()}
+        # what is kept of each message
+        self.capture_policy = CapturePolicy(self.state.get("capture_policy"))
 
-        if isinstance(content, SIMPLE_TYPES):
-            return content
-
-        logger.error(f"Can't scrub type {type(content)}")
-        return content
+        # deserialization, scrubbing and persistence happen outside of the event loop
+        self.pipeline = MessagePipeline(self.host_log_folder, publisher)
 
     def request(self, flow: Flow):
 
@@ -107,14 +100,14 @@ class _RequestLogger:
                 else:
                     raise Exception(f"Unknown OTLP ingestion path {otlp_path}")
             else:
-                flow.request.host, flow.request.port = "agent", 8127
+                flow.request.host, flow.request.port = AGENT_HOST, AGENT_PORT
                 flow.request.scheme = "http"
 
             logger.info(f"    => reverse proxy to {flow.request.pretty_url}")
 
     @staticmethod
     def request_is_from_tracer(request):
-        return request.host == "agent"
+        return request.host == AGENT_HOST
 
     def response(self, flow):
 
@@ -153,6 +146,11 @@ class _RequestLogger:
             else:
                 path, query = flow.request.path, ""
 
+            policy = self.capture_policy.get(interface, path)
+            if policy == DROP:
+                logger.info(f"    => Not saved, capture policy is {policy}")
+                return
+
             # get destination
             message_count = messages_counts[interface]
             messages_counts[interface] += 1
@@ -161,6 +159,7 @@ class _RequestLogger:
 
             data = {
                 "log_filename": log_filename,
+                "method": flow.request.method,
                 "path": path,
                 "query": query,
                 "host": flow.request.host,
@@ -177,26 +176,25 @@ class _RequestLogger:
                 },
             }
 
-            deserialize(data, key="request", content=flow.request.content, interface=interface)
-
             if flow.error and flow.error.msg == FlowError.KILLED_MESSAGE:
                 data["response"] = None
-            else:
-                deserialize(data, key="response", content=flow.response.content, interface=interface)
 
-            try:
-                data = self._scrub(data)
-            except:
-                logger.exception("Fail to scrub data")
+            if policy != FULL:
+                data["capture_policy"] = policy
 
             logger.info(f"    => Saving data as {log_filename}")
 
-            with open(log_filename, "w", encoding="utf-8", opener=lambda path, flags: os.open(path, flags, 0o777)) as f:
-                json.dump(data, f, indent=2, cls=ObjectDumpEncoder)
+            if policy == HEADERS_ONLY:
+                self.pipeline.submit(data, interface, None, None)
+            else:
+                self.pipeline.submit(data, interface, flow.request.content, flow.response.content)
 
         except:
             logger.exception("Unexpected error")
 
+    def done(self):
+        self.pipeline.close()
+
     def _modify_response(self, flow):
         rc_config = self.state.get("mock_remote_config_backend")
         if rc_config is None:
@@ -225,28 +223,38 @@ class _RequestLogger:
             logger.info(f"    => modifying rc response for runtime ID {runtime_id}")
             logger.info(f"    => Overwriting /v0.7/config response #{self.config_request_count[runtime_id] + 1}")
 
-            if self.config_request_count[runtime_id] + 1 > len(mocked_responses):
+            flow.response.status_code = 200
+            flow.response.content = self._get_rc_response(
+                mocked_responses,
+                request_content["client"]["client_tracer"]["language"],
+                self.config_request_count[runtime_id],
+            )
+
+            self.config_request_count[runtime_id] += 1
+
+    def _get_rc_response(self, mocked_responses, language, version):
+        """ returns the encoded /v0.7/config response. Responses only depend on the RC scenario, the tracer
+            language (for debugger probes) and the version, they are computed once """
+
+        rc_config = self.state.get("mock_remote_config_backend")
+        is_debugger = rc_config in _DEBUGGER_RC_CONFIGS
+
+        if version >= len(mocked_responses):
+            key = (rc_config, None, None)
+        else:
+            key = (rc_config, language if is_debugger else None, version)
+
+        if key not in self._rc_responses:
+            if version >= len(mocked_responses):
                 response = {}  # default content when there isn't an RC update
+            elif is_debugger:
+                response = rc_debugger.create_rcm_probe_response(language, mocked_responses[version], version)
             else:
-                if self.state.get("mock_remote_config_backend") in (
-                    "DEBUGGER_PROBES_STATUS",
-                    "DEBUGGER_LINE_PROBES_SNAPSHOT",
-                    "DEBUGGER_METHOD_PROBES_SNAPSHOT",
-                    "DEBUGGER_MIX_LOG_PROBE",
-                    "DEBUGGER_PII_REDACTION",
-                ):
-                    response = rc_debugger.create_rcm_probe_response(
-                        request_content["client"]["client_tracer"]["language"],
-                        mocked_responses[self.config_request_count[runtime_id]],
-                        self.config_request_count[runtime_id],
-                    )
-                else:
-                    response = mocked_responses[self.config_request_count[runtime_id]]
+                response = mocked_responses[version]
 
-            flow.response.status_code = 200
-            flow.response.content = json.dumps(response).encode()
+            self._rc_responses[key] = json.dumps(response).encode()
 
-            self.config_request_count[runtime_id] += 1
+        return self._rc_responses[key]
 
 
 def start_proxy() -> None:
@@ -263,11 +271,22 @@ def start_proxy() -> None:
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+
+    publisher = StreamPublisher()
+    loop.run_until_complete(publisher.start(port=STREAM_PORT))
+    logger.info(f"Streaming captured messages on port {STREAM_PORT}")
+
     opts = options.Options(mode=modes, listen_host="0.0.0.0", confdir="utils/proxy/.mitmproxy")
     proxy = master.Master(opts, event_loop=loop)
     proxy.addons.add(*default_addons())
     proxy.addons.add(errorcheck.ErrorCheck())
-    proxy.addons.add(_RequestLogger())
+
+    request_logger = _RequestLogger(publisher)
+    stats_server = StatsServer(request_logger.pipeline.get_stats)
+    loop.run_until_complete(stats_server.start(port=STATS_PORT))
+    logger.info(f"Serving stats on port {STATS_PORT}")
+
+    proxy.addons.add(request_logger)
     loop.run_until_complete(proxy.run())
 
 
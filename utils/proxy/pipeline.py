@@ -0,0 +1,194 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Processing of captured messages, outside of the mitmproxy event loop.
+
+The event loop only builds the message metadata and copies the bodies. Scrubbing and record encoding happen in
+a bounded process pool. Results are then written in the capture store and published, in submission order,
+from the event loop. Bodies are not deserialized by the proxy, but by the test runner when a test reads them.
+
+The backlog of messages sent to the pool is bounded: once it is full, the event loop waits for the oldest message
+to be processed before submitting a new one, so the proxy stops reading new messages instead of keeping their
+bodies in memory.
+"""
+
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import time
+
+from capture_store import CaptureWriter, encode_body, encode_record, get_capture_folder, get_content_type
+from scrubber import scrubber
+from stats import CaptureStats
+
+
+logger = logging.getLogger(__name__)
+
+
+def process_message(data, interface, request_content, response_content):
+    """ Executed in a worker process: returns the encoded record, and some timings """
+
+    started = time.time()
+
+    # bodies are scrubbed in one pass on raw bytes, and kept raw: the test runner deserializes them on demand
+    data = scrubber.scrub_metadata(data)
+    request_type = get_content_type(data["request"]["headers"])
+    encode_body(data["request"], scrubber.scrub_body(request_content, request_type))
+
+    if data["response"] is not None:
+        response_type = get_content_type(data["response"]["headers"])
+        encode_body(data["response"], scrubber.scrub_body(response_content, response_type))
+
+    scrubbed = time.time()
+
+    return encode_record(data), {
+        "started": started,
+        "scrub_time": scrubbed - started,
+    }
+
+
+class PipelineMetrics:
+    def __init__(self):
+        self.backlog = 0
+        self.max_backlog = 0
+        self.processed = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.throttled = 0
+        self.throttled_time = 0.0
+
+    def on_throttle(self, duration):
+        self.throttled += 1
+        self.throttled_time += duration
+
+    def on_submit(self):
+        self.backlog += 1
+        self.max_backlog = max(self.max_backlog, self.backlog)
+
+    def on_done(self, queue_time):
+        self.backlog -= 1
+        self.processed += 1
+        self.total_queue_time += queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+
+    def serialize(self):
+        return {
+            "backlog": self.backlog,
+            "max_backlog": self.max_backlog,
+            "processed": self.processed,
+            "mean_queue_time": self.total_queue_time / self.processed if self.processed else 0,
+            "max_queue_time": self.max_queue_time,
+            "throttled": self.throttled,
+            "throttled_time": self.throttled_time,
+        }
+
+
+class MessagePipeline:
+    """ Lives in the mitmproxy event loop. Not thread-safe """
+
+    def __init__(self, host_log_folder, publisher, max_workers=None, max_backlog=None):
+        self.host_log_folder = host_log_folder
+        self.publisher = publisher
+        self.metrics = PipelineMetrics()
+        self.stats = CaptureStats()
+
+        if max_workers is None:
+            max_workers = int(os.environ.get("SYSTEM_TESTS_PROXY_WORKERS", min(4, os.cpu_count() or 1)))
+
+        if max_backlog is None:
+            max_backlog = int(os.environ.get("SYSTEM_TESTS_PROXY_MAX_BACKLOG", max_workers * 16))
+
+        self.max_backlog = max_backlog
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._pending = deque()  # (future, interface, data, submitted), in submission order
+
+        # interface name -> capture store writer
+        self._capture_writers = {}
+
+    def submit(self, data, interface, request_content, response_content):
+        if self.metrics.backlog >= self.max_backlog:
+            self._throttle()
+
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(process_message, data, interface, request_content, response_content)
+
+        self._pending.append((future, interface, data, time.time()))
+        self.metrics.on_submit()
+
+        # completion callbacks are called from a pool thread, go back in the event loop
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._save_done_messages))
+
+    def _throttle(self):
+        """ blocks the event loop until the backlog is below its limit """
+
+        started = time.time()
+
+        while self.metrics.backlog >= self.max_backlog:
+            self._pending[0][0].exception()  # waits for the oldest message, errors are logged once it's saved
+            self._save_done_messages()
+
+        duration = time.time() - started
+        self.metrics.on_throttle(duration)
+        logger.info(f"    => backlog full, waited {duration * 1000:.1f}ms")
+
+    def _save_done_messages(self):
+        # a message can't be saved before the ones submitted before it
+        while self._pending and self._pending[0][0].done():
+            future, interface, data, submitted = self._pending.popleft()
+            log_filename = data["log_filename"]
+
+            try:
+                payload, timings = future.result()
+            except Exception:
+                logger.exception(f"Fail to process {log_filename}")
+                self.metrics.on_done(0)
+                continue
+
+            queue_time = timings["started"] - submitted
+            self.metrics.on_done(queue_time)
+
+            write_time = self._save(interface, payload)
+            self.stats.on_message(
+                interface,
+                data["path"],
+                request_bytes=data["request"]["length"],
+                response_bytes=data["response"]["length"] if data["response"] else 0,
+                scrub_time=timings["scrub_time"],
+                write_time=write_time,
+                queue_time=queue_time,
+            )
+
+            logger.info(
+                f"    => {log_filename} saved (queued {queue_time * 1000:.1f}ms, "
+                f"scrubbed in {timings['scrub_time'] * 1000:.1f}ms, backlog {self.metrics.backlog})"
+            )
+
+    def _save(self, interface, payload):
+        """ returns the time spent to write the message in the capture store """
+
+        started = time.time()
+
+        if interface not in self._capture_writers:
+            folder = get_capture_folder(f"{self.host_log_folder}/interfaces/{interface}")
+            self._capture_writers[interface] = CaptureWriter(folder)
+
+        self._capture_writers[interface].append(payload)
+        written = time.time()
+
+        self.publisher.publish(interface, payload)
+
+        return written - started
+
+    def get_stats(self):
+        return {"timestamp": time.time(), "pipeline": self.metrics.serialize(), "interfaces": self.stats.serialize()}
+
+    def close(self):
+        # process what is still in the pool, synchronously
+        self._executor.shutdown(wait=True)
+        self._save_done_messages()
+
+        for writer in self._capture_writers.values():
+            writer.close()
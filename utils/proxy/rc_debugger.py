@@ -55,6 +55,8 @@ def create_rcm_probe_response(library, probes, version):
             target = copy.deepcopy(_BASE_TARGET)
             target_file = copy.deepcopy(_BASE_TARGET_FILE)
 
+            # mocked probes are shared by all responses, leave them untouched
+            probe = copy.deepcopy(probe)
             probe["language"] = library
 
             if probe["where"]["typeName"] == "ACTUAL_TYPE_NAME":
@@ -0,0 +1,153 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Remove secrets (API and APP keys) from captured messages.
+
+Scrubbing is done once, on raw bodies, with a single compiled pattern matching all secrets. Secrets are replaced
+by the redaction marker, except in binary bodies (msgpack, protobuf...) where they are replaced by a slice of the
+marker of the same length, so length-prefixed encodings are still valid after scrubbing. Decoded strings only need
+to be scrubbed when the encoding hides the secret (base64, gzip...).
+
+Usage:
+    PYTHONPATH=. python utils/proxy/scrubber.py
+        => benchmark against the historical scrubbing on the decoded content, on large trace payloads
+"""
+
+import os
+import re
+
+
+REDACTED = "{redacted-by-system-tests-proxy}"
+REDACTED_BYTES = REDACTED.encode("utf-8")
+
+# bodies where the redaction marker can be used as is. Other bodies may be length-prefixed encodings
+TEXT_CONTENT_TYPES = ("application/json", "text/", "application/x-www-form-urlencoded")
+
+
+def _get_redaction(length):
+    return (REDACTED * (length // len(REDACTED) + 1))[:length]
+
+
+def _is_text(content_type):
+    return content_type is not None and any(text_type in content_type.lower() for text_type in TEXT_CONTENT_TYPES)
+
+
+class Scrubber:
+    def __init__(self, secrets):
+        # longest first, if a secret contains another one
+        secrets = sorted({secret for secret in secrets if secret}, key=len, reverse=True)
+
+        if len(secrets) == 0:
+            self._bytes_pattern = self._str_pattern = None
+            return
+
+        self._str_pattern = re.compile("|".join(re.escape(secret) for secret in secrets))
+        self._bytes_pattern = re.compile(b"|".join(re.escape(secret.encode("utf-8")) for secret in secrets))
+
+        self._bytes_redactions = {
+            secret.encode("utf-8"): _get_redaction(len(secret.encode("utf-8"))).encode("utf-8") for secret in secrets
+        }
+
+    def scrub_body(self, content, content_type):
+        """ scrub a raw body, keeping its length unless its content type is known to be textual """
+
+        if _is_text(content_type):
+            return self.scrub_bytes(content, keep_length=False)
+
+        return self.scrub_bytes(content)
+
+    def scrub_bytes(self, content, keep_length=True):
+        if self._bytes_pattern is None or not content:
+            return content
+
+        if not keep_length:
+            return self._bytes_pattern.sub(REDACTED_BYTES, content)
+
+        return self._bytes_pattern.sub(lambda m: self._bytes_redactions[m.group()], content)
+
+    def scrub_str(self, content):
+        if self._str_pattern is None or not content:
+            return content
+
+        return self._str_pattern.sub(REDACTED, content)
+
+    def scrub_metadata(self, content):
+        """ scrub all strings of a small object (message without its bodies) """
+
+        if isinstance(content, str):
+            return self.scrub_str(content)
+
+        if isinstance(content, (list, tuple)):
+            return [self.scrub_metadata(item) for item in content]
+
+        if isinstance(content, dict):
+            return {key: self.scrub_metadata(value) for key, value in content.items()}
+
+        return content
+
+
+scrubber = Scrubber([os.environ.get(name) for name in ("DD_API_KEY", "DD_APP_KEY", "DD_APPLICATION_KEY")])
+
+
+def _main():
+    import json
+    import timeit
+
+    import msgpack
+
+    api_key = "0123456789abcdef0123456789abcdef"
+    app_key = "0123456789abcdef0123456789abcdef01234567"
+    bench_scrubber = Scrubber([api_key, app_key])
+
+    def legacy_scrub(content):
+        if isinstance(content, str):
+            for secret in (api_key, app_key, app_key):
+                content = content.replace(secret, REDACTED)
+            return content
+        if isinstance(content, list):
+            return [legacy_scrub(item) for item in content]
+        if isinstance(content, dict):
+            return {key: legacy_scrub(value) for key, value in content.items()}
+        return content
+
+    for trace_count in (100, 1000):
+        traces = [
+            [
+                {
+                    "trace_id": trace_id,
+                    "span_id": span_id,
+                    "parent_id": span_id - 1,
+                    "service": "weblog",
+                    "name": "web.request",
+                    "resource": f"GET /resource/{span_id}",
+                    "meta": {f"tag.{i}": f"value-{i}-{trace_id}" for i in range(20)},
+                    "metrics": {f"metric.{i}": i for i in range(5)},
+                }
+                for span_id in range(1, 11)
+            ]
+            for trace_id in range(trace_count)
+        ]
+        traces[0][0]["meta"]["leak"] = api_key
+        payload = msgpack.packb(traces)
+
+        def legacy():
+            return legacy_scrub(msgpack.unpackb(payload))
+
+        def single_pass():
+            return msgpack.unpackb(bench_scrubber.scrub_bytes(payload))
+
+        assert json.dumps(legacy()) == json.dumps(single_pass())
+
+        legacy_time = min(timeit.repeat(legacy, number=5, repeat=3)) / 5
+        single_pass_time = min(timeit.repeat(single_pass, number=5, repeat=3)) / 5
+        print(
+            f"{trace_count * 10} spans, {len(payload)} bytes: "
+            f"decode + recursive scrub: {legacy_time * 1000:.1f}ms, "
+            f"raw scrub + decode: {single_pass_time * 1000:.1f}ms, "
+            f"scrub only: {min(timeit.repeat(lambda: bench_scrubber.scrub_bytes(payload), number=5)) / 5 * 1000:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    _main()
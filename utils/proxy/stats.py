@@ -0,0 +1,159 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Live statistics of the proxy, served over HTTP on STATS_PORT (GET /stats).
+
+For each interface and path: message and byte counts, time spent to scrub and to write messages, and the timestamp
+of the last message. Queue, scrub and write times are also given as histograms, with fixed log-scale buckets.
+Bodies are not decoded by the proxy, so there is no decode time. The pipeline backlog is the number of messages
+captured but not yet written.
+
+The proxy is reached on SYSTEM_TESTS_PROXY_HOST (in docker mode, the runner is in the docker network), or localhost.
+
+This file is used by the proxy container (as a script) and by the test runner (as utils.proxy.stats).
+"""
+
+import asyncio
+import bisect
+from collections import defaultdict
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+
+STATS_PORT = 11112
+
+# upper bounds of histogram buckets, in ms. The last bucket holds everything above
+HISTOGRAM_BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+HISTOGRAM_STAGES = ("queue", "scrub", "write")
+
+
+def get_proxy_host():
+    return os.environ.get("SYSTEM_TESTS_PROXY_HOST", "localhost")
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, duration):
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS, duration * 1000)] += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+    def serialize(self):
+        return {"bounds_ms": list(HISTOGRAM_BOUNDS), "counts": list(self.counts)}
+
+
+def _get_path_stats():
+    return {
+        "messages": 0,
+        "request_bytes": 0,
+        "response_bytes": 0,
+        "scrub_time": 0.0,
+        "write_time": 0.0,
+        "last_message": None,
+        "histograms": {stage: Histogram() for stage in HISTOGRAM_STAGES},
+    }
+
+
+def _serialize_path_stats(stats):
+    result = dict(stats)
+    result["histograms"] = {stage: histogram.serialize() for stage, histogram in stats["histograms"].items()}
+    return result
+
+
+class CaptureStats:
+    """ Lives in the proxy event loop. Not thread-safe """
+
+    def __init__(self):
+        # interface -> path -> stats
+        self._stats = defaultdict(lambda: defaultdict(_get_path_stats))
+
+    def on_message(self, interface, path, request_bytes, response_bytes, scrub_time, write_time, queue_time=0.0):
+        stats = self._stats[interface][path]
+        stats["messages"] += 1
+        stats["request_bytes"] += request_bytes
+        stats["response_bytes"] += response_bytes
+        stats["scrub_time"] += scrub_time
+        stats["write_time"] += write_time
+        stats["last_message"] = time.time()
+
+        stats["histograms"]["queue"].add(queue_time)
+        stats["histograms"]["scrub"].add(scrub_time)
+        stats["histograms"]["write"].add(write_time)
+
+    def serialize(self):
+        result = {}
+
+        for interface, paths in self._stats.items():
+            histograms = {stage: Histogram() for stage in HISTOGRAM_STAGES}
+            for stats in paths.values():
+                for stage, histogram in stats["histograms"].items():
+                    histograms[stage].merge(histogram)
+
+            result[interface] = {
+                "messages": sum(stats["messages"] for stats in paths.values()),
+                "bytes": sum(stats["request_bytes"] + stats["response_bytes"] for stats in paths.values()),
+                "last_message": max(stats["last_message"] for stats in paths.values()),
+                "histograms": {stage: histogram.serialize() for stage, histogram in histograms.items()},
+                "paths": {path: _serialize_path_stats(stats) for path, stats in paths.items()},
+            }
+
+        return result
+
+
+class StatsServer:
+    """ Minimal HTTP server, running in the proxy event loop. get_stats() must return a JSON-serializable object """
+
+    def __init__(self, get_stats):
+        self.get_stats = get_stats
+        self._server = None
+
+    async def start(self, host="0.0.0.0", port=STATS_PORT):
+        self._server = await asyncio.start_server(self._on_connection, host, port)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _on_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+
+            # headers are ignored
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/stats":
+                status, body = "200 OK", json.dumps(self.get_stats()).encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"{}"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def get_proxy_stats(host=None, port=STATS_PORT, timeout=1):
+    """ returns the stats served by the proxy, or None if it's not reachable """
+
+    if host is None:
+        host = get_proxy_host()
+
+    try:
+        with urllib.request.urlopen(f"http://{host}:{port}/stats", timeout=timeout) as response:
+            return json.load(response)
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return None
@@ -0,0 +1,89 @@
+# Unless explicitly stated otherwise all files in this repository are licensed under the the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2021 Datadog, Inc.
+
+""" Push channel between the proxy and the test runner.
+
+Each captured message is published, right after it has been written in the capture store, to every connected
+subscriber. A frame is the interface name and the capture record, both length-prefixed. Once a subscriber is
+registered, the proxy sends a frame with an empty interface name (hello), so the subscriber knows that it
+can catch up from the capture store without missing anything.
+
+This file is used by the proxy container (as a script) and by the test runner (as utils.proxy.stream).
+"""
+
+import asyncio
+import struct
+
+
+STREAM_PORT = 11111
+HELLO_INTERFACE = ""
+
+_LENGTH = struct.Struct(">I")
+
+
+def encode_frame(interface: str, payload: bytes) -> bytes:
+    interface = interface.encode("utf-8")
+    return _LENGTH.pack(len(interface)) + interface + _LENGTH.pack(len(payload)) + payload
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise ConnectionError("Connection closed by the proxy")
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b"".join(chunks)
+
+
+def read_frame(sock):
+    """ blocking read of one frame on a socket, returns (interface, payload) """
+
+    (length,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    interface = _recv_exactly(sock, length).decode("utf-8")
+    (length,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+
+    return interface, _recv_exactly(sock, length)
+
+
+class StreamPublisher:
+    """ Runs in the proxy event loop """
+
+    def __init__(self):
+        self._writers = set()
+        self._server = None
+
+    async def start(self, host="0.0.0.0", port=STREAM_PORT):
+        self._server = await asyncio.start_server(self._on_connection, host, port)
+
+    async def stop(self):
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+
+        await self._server.wait_closed()
+
+    async def _on_connection(self, reader, writer):
+        self._writers.add(writer)
+        writer.write(encode_frame(HELLO_INTERFACE, b""))
+
+        try:
+            # subscribers never send anything, this only returns when they leave
+            await reader.read()
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def publish(self, interface, payload: bytes):
+        if len(self._writers) == 0:
+            return
+
+        frame = encode_frame(interface, payload)
+        for writer in list(self._writers):
+            if writer.is_closing():
+                self._writers.discard(writer)
+            else:
+                writer.write(frame)
@@ -0,0 +1,110 @@
+""" Lookups in library logs: pattern assertions, with and without the literal prefilter, and field lookups
+(level, rid, trace id), with and without indexes.
+
+Synthetic java logs are written in a temporary folder, then loaded by the library stdout interface.
+
+Usage:
+    PYTHONPATH=. python utils/scripts/log_lookup_benchmark.py --entries 200000
+"""
+
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+from unittest import mock
+
+from utils._context.core import context
+from utils._context.library_version import LibraryVersion
+from utils.interfaces import _logs
+
+
+LEVELS = ("DEBUG", "DEBUG", "DEBUG", "INFO", "WARN", "ERROR")
+
+
+def get_rid(rng):
+    return "".join(rng.choice(string.ascii_uppercase) for _ in range(36))
+
+
+def write_logs(filename, entry_count, rng):
+    """ returns the rids written in logs """
+
+    rids = [get_rid(rng) for _ in range(max(1, entry_count // 100))]
+
+    with open(filename, "w", encoding="utf-8") as f:
+        for i in range(entry_count):
+            level = rng.choice(LEVELS)
+            rid = rng.choice(rids)
+            f.write(
+                f"[dd.trace 2021-11-29 17:10:22:{i % 1000:03d} +0000] [dd-task-scheduler] {level} "
+                f"datadog.trace.agent.core.DDSpan - Finished span: DDSpan [ t_id={i}, s_id={i + 1}, p_id=0 ] "
+                f"trace=weblog/servlet.request/GET /waf tags={{http.useragent=system_tests rid/{rid}, "
+                f"dd.trace_id={i}, language=jvm}}\n"
+            )
+            if i % 5000 == 0:
+                f.write("java.lang.IllegalStateException: Logger retrieved for: datadog.appsec.Waf\n")
+                f.write("\tat datadog.trace.Main.main(Main.java:42)\n")
+
+    return rids
+
+
+def measure(function, repeat=3):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def run_assertions(stdout):
+    stdout.assert_absence(
+        pattern=r"[A-Za-z]+\.[A-Za-z]*Exception", allowed_patterns=[r"Logger retrieved for: datadog\.appsec\.Waf"]
+    )
+    stdout.assert_presence(r"Finished span: DDSpan \[ t_id=4\d*,", level="DEBUG")
+    stdout.assert_absence(r"Failed to send traces to the agent")
+
+
+def run_field_lookups(stdout, rids, indexed):
+    for rid in rids[:50]:
+        if indexed:
+            list(stdout.get_data(rid=rid, level="DEBUG"))
+        else:
+            [data for data in stdout.get_data() if rid in data["raw"] and data.get("level") == "DEBUG"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of lookups in library logs")
+    parser.add_argument("--entries", type=int, default=200000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    folder = tempfile.mkdtemp(prefix="log_lookup_benchmark_")
+    os.makedirs(os.path.join(folder, "docker", "weblog"))
+    rids = write_logs(os.path.join(folder, "docker", "weblog", "stdout.log"), args.entries, rng)
+
+    context.scenario = mock.Mock(host_log_folder=folder, library=LibraryVersion("java", "1.0.0"))
+    stdout = _logs._LibraryStdout()  # pylint: disable=protected-access
+    stdout.configure(False)
+
+    start = time.perf_counter()
+    stdout.load_data()
+    print(f"{args.entries} entries loaded in {time.perf_counter() - start:.2f}s")
+
+    prefiltered = measure(lambda: run_assertions(stdout))
+    with mock.patch.object(_logs, "_get_required_literal", return_value=""):
+        full_scan = measure(lambda: run_assertions(stdout))
+    print(f"assertions: full scan {full_scan * 1000:.1f}ms, prefiltered {prefiltered * 1000:.1f}ms")
+
+    start = time.perf_counter()
+    run_field_lookups(stdout, rids, indexed=True)
+    first_indexed = time.perf_counter() - start
+    indexed = measure(lambda: run_field_lookups(stdout, rids, indexed=True))
+    full_scan = measure(lambda: run_field_lookups(stdout, rids, indexed=False))
+    print(
+        f"50 rid+level lookups: full scan {full_scan * 1000:.1f}ms, indexed {indexed * 1000:.1f}ms "
+        f"(first run, building indexes: {first_indexed * 1000:.1f}ms)"
+    )
+
+
+if __name__ == "__main__":
+    main()
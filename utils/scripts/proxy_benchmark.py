@@ -0,0 +1,252 @@
+""" Benchmark of the proxy: replays captured requests against it, at a given concurrency and rate.
+
+A stub agent answers in place of the real agent. The same requests are also sent directly to the stub agent,
+the latency added by the proxy is the difference between both runs. The cost of each decoding stage done on
+captured bodies (base64, scrubbing, deserialization) is measured offline, per path, with the cost of pickling a
+body to a worker of the proxy pipeline, and back.
+
+Usage:
+    PYTHONPATH=. python utils/scripts/proxy_benchmark.py logs/interfaces/library --start-proxy
+        => starts the proxy and a stub agent, mitmproxy must be installed
+    PYTHONPATH=. python utils/scripts/proxy_benchmark.py logs/interfaces/library --concurrency 16 --rate 500
+        => uses an already running proxy, started with SYSTEM_TESTS_PROXY_AGENT_HOST=127.0.0.1
+"""
+
+import argparse
+import asyncio
+from collections import defaultdict
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from utils.proxy._deserializer import deserialize_http_message
+from utils.proxy.capture_store import CaptureReader, decode_body, get_capture_folder
+from utils.proxy.scrubber import scrubber
+
+
+STUB_AGENT_HOST = "127.0.0.1"
+STUB_AGENT_PORT = 8127
+PROXY_URL = "http://localhost:8126"
+
+# recomputed by the client
+_SKIPPED_HEADERS = ("host", "content-length", "transfer-encoding", "connection", "accept-encoding")
+
+
+def load_requests(interface_folder):
+    result = []
+
+    for data in CaptureReader(get_capture_folder(interface_folder)):
+        request = data["request"]
+        if "body" not in request:
+            continue
+
+        content = decode_body(request)
+        result.append(
+            {
+                "method": data.get("method") or ("POST" if content else "GET"),
+                "path": data["path"] + (f"?{data['query']}" if data.get("query") else ""),
+                "raw_path": data["path"],
+                "headers": [(k, v) for k, v in request["headers"] if k.lower() not in _SKIPPED_HEADERS],
+                "message": request,
+                "content": content,
+            }
+        )
+
+    return result
+
+
+def _get_percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))] if values else 0
+
+
+async def _stub_agent_handler(request):
+    await request.read()
+
+    if request.path == "/info":
+        return web.json_response({"endpoints": ["/v0.4/traces", "/v0.5/traces", "/v0.7/config", "/telemetry/proxy/"]})
+
+    if "traces" in request.path:
+        return web.json_response({"rate_by_service": {}})
+
+    return web.json_response({})
+
+
+async def start_stub_agent(host=STUB_AGENT_HOST, port=STUB_AGENT_PORT):
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_route("*", "/{path:.*}", _stub_agent_handler)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    return runner
+
+
+async def replay(base_url, requests, concurrency, rate):
+    """ returns the latency of each request, the error count and the elapsed time """
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        started = time.perf_counter()
+
+        async def send(i, request):
+            nonlocal errors
+
+            if rate:
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            async with semaphore:
+                request_started = time.perf_counter()
+                try:
+                    url = base_url + request["path"]
+                    async with session.request(
+                        request["method"], url, headers=request["headers"], data=request["content"]
+                    ) as response:
+                        await response.read()
+                        if response.status >= 500:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+
+                latencies.append(time.perf_counter() - request_started)
+
+        await asyncio.gather(*(send(i, request) for i, request in enumerate(requests)))
+
+        return latencies, errors, time.perf_counter() - started
+
+
+def measure_decode_costs(requests, interface):
+    """ returns path -> stage -> cumulated time, and path -> message count """
+
+    costs = defaultdict(lambda: defaultdict(float))
+    counts = defaultdict(int)
+
+    for request in requests:
+        path = request["raw_path"]
+        counts[path] += 1
+
+        started = time.perf_counter()
+        content = decode_body(request["message"])
+        decoded = time.perf_counter()
+        pickle.loads(pickle.dumps((request["message"], content), protocol=pickle.HIGHEST_PROTOCOL))
+        pickled = time.perf_counter()
+        content = scrubber.scrub_body(content, request["message"]["content_type"])
+        scrubbed = time.perf_counter()
+        deserialize_http_message(path, request["message"], content, interface, "request")
+        deserialized = time.perf_counter()
+
+        costs[path]["base64"] += decoded - started
+        costs[path]["pickle"] += pickled - decoded
+        costs[path]["scrub"] += scrubbed - pickled
+        costs[path]["deserialize"] += deserialized - scrubbed
+
+    return costs, counts
+
+
+def _wait_for_port(host, port, timeout):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+
+    raise TimeoutError(f"{host}:{port} is not reachable after {timeout}s")
+
+
+def start_proxy(host_log_folder):
+    env = dict(os.environ)
+    env["SYSTEM_TESTS_HOST_LOG_FOLDER"] = host_log_folder
+    env["SYSTEM_TESTS_PROXY_AGENT_HOST"] = STUB_AGENT_HOST
+    env["SYSTEM_TESTS_PROXY_AGENT_PORT"] = str(STUB_AGENT_PORT)
+    env.setdefault("PROXY_STATE", "{}")
+
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, "utils/proxy/core.py"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    _wait_for_port("localhost", 8126, timeout=30)
+
+    return process
+
+
+def _print_run(name, latencies, errors, elapsed, byte_count):
+    print(
+        f"{name:<8} {len(latencies) / elapsed:8.1f} req/s  {byte_count / elapsed / 1024 / 1024:7.2f} MB/s  "
+        f"p50 {_get_percentile(latencies, 50) * 1000:7.2f}ms  p99 {_get_percentile(latencies, 99) * 1000:7.2f}ms  "
+        f"errors {errors}"
+    )
+
+
+async def run(args):
+    requests = load_requests(args.interface_folder)
+    if len(requests) == 0:
+        raise ValueError(f"No captured request in {get_capture_folder(args.interface_folder)}")
+
+    requests = requests * args.repeat
+    byte_count = sum(len(request["content"]) for request in requests)
+    print(
+        f"{len(requests)} requests, {byte_count / 1024 / 1024:.1f} MB, "
+        f"concurrency {args.concurrency}, rate {args.rate or 'unlimited'}"
+    )
+
+    stub_agent = await start_stub_agent()
+    proxy = start_proxy(tempfile.mkdtemp(prefix="proxy_benchmark_")) if args.start_proxy else None
+
+    try:
+        direct = await replay(f"http://{STUB_AGENT_HOST}:{STUB_AGENT_PORT}", requests, args.concurrency, args.rate)
+        proxied = await replay(args.proxy_url, requests, args.concurrency, args.rate)
+    finally:
+        if proxy is not None:
+            proxy.terminate()
+            proxy.wait()
+        await stub_agent.cleanup()
+
+    _print_run("direct", *direct, byte_count)
+    _print_run("proxy", *proxied, byte_count)
+    for percentile in (50, 99):
+        added = _get_percentile(proxied[0], percentile) - _get_percentile(direct[0], percentile)
+        print(f"added latency p{percentile}: {added * 1000:.2f}ms")
+
+    interface = os.path.basename(os.path.normpath(args.interface_folder))
+    costs, counts = measure_decode_costs(requests[: len(requests) // args.repeat], interface)
+
+    print(
+        f"\n{'path':<40} {'count':>6} {'base64':>10} {'pickle':>10} {'scrub':>10} {'deserialize':>12}  "
+        "(mean ms per message)"
+    )
+    for path in sorted(costs, key=lambda p: -sum(costs[p].values())):
+        means = {stage: cost / counts[path] * 1000 for stage, cost in costs[path].items()}
+        print(
+            f"{path:<40} {counts[path]:>6} {means['base64']:>10.3f} {means['pickle']:>10.3f} {means['scrub']:>10.3f} "
+            f"{means['deserialize']:>12.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured requests against the proxy")
+    parser.add_argument("interface_folder", help="e.g. logs/interfaces/library")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second, 0 for no limit")
+    parser.add_argument("--repeat", type=int, default=1, help="replay captured requests N times")
+    parser.add_argument("--proxy-url", default=PROXY_URL)
+    parser.add_argument("--start-proxy", action="store_true", help="start the proxy in a subprocess")
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+""" Memory used by v0.5 spans, decoded as dicts or as compact spans (SYSTEM_TESTS_COMPACT_SPANS=true).
+
+A synthetic payload is decoded, then the memory held by decoded spans is measured with tracemalloc, before and
+after meta/metrics of every span are read.
+
+Usage:
+    PYTHONPATH=. python utils/scripts/span_memory_benchmark.py --spans 100000 --tags 20
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+import msgpack
+
+from utils.proxy import _deserializer
+
+
+def get_payload(span_count, tag_count, spans_per_trace=10):
+    strings = ["", "weblog", "web.request", "GET /", "http", "_dd.appsec.json", "{}"]
+    tags = []
+    for i in range(tag_count):
+        strings += [f"tag.{i}", f"value.{i % 5}"]
+        tags.append((len(strings) - 2, len(strings) - 1))
+
+    traces = []
+    for trace_index in range(0, span_count, spans_per_trace):
+        trace = []
+        for span_index in range(trace_index, min(span_count, trace_index + spans_per_trace)):
+            meta = dict(tags)
+            meta[5] = 6
+            trace.append([1, 2, 3, trace_index + 1, span_index + 1, 0, 1700000000000000000, 1000, 0, meta, {7: 1.0}, 4])
+        traces.append(trace)
+
+    return msgpack.packb([strings, traces])
+
+
+def measure(content, compact):
+    """ returns the decode time, and the bytes held by decoded spans, before and after meta is read """
+
+    _deserializer.COMPACT_SPANS = compact
+    message = {"headers": [["Content-Type", "application/msgpack"]]}
+
+    # tracemalloc slows allocations down, time is measured on a separate run
+    started = time.perf_counter()
+    _deserializer.deserialize_http_message("/v0.5/traces", message, content, "library", "request")
+    elapsed = time.perf_counter() - started
+
+    gc.collect()
+    tracemalloc.start()
+    traces = _deserializer.deserialize_http_message("/v0.5/traces", message, content, "library", "request")
+    decoded, _ = tracemalloc.get_traced_memory()
+
+    for trace in traces:
+        for span in trace:
+            _ = span["meta"], span["metrics"]
+
+    read, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, decoded, read
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory used by decoded v0.5 spans")
+    parser.add_argument("--spans", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=20, help="meta entries per span")
+    args = parser.parse_args()
+
+    content = get_payload(args.spans, args.tags)
+    print(f"{args.spans} spans, {args.tags} tags, payload {len(content) / 1024 / 1024:.1f} MB")
+
+    for name, compact in (("dict", False), ("compact", True)):
+        elapsed, decoded, read = measure(content, compact)
+        print(
+            f"{name:<8} decode {elapsed:6.2f}s  {decoded / args.spans:7.0f} B/span  "
+            f"{read / args.spans:7.0f} B/span once meta is read"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 # This product includes software developed at Datadog (https://www.datadoghq.com/).
 # Copyright 2021 Datadog, Inc.
 
+from collections.abc import Mapping
 import logging
 import os
 import re
@@ -107,7 +108,7 @@ def get_rid_from_request(request):
 
 def get_rid_from_span(span):
 
-    if not isinstance(span, dict):
+    if not isinstance(span, Mapping):
         logger.error(f"Span should be an object, not {type(span)}")
         return None
 